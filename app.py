@@ -1,21 +1,30 @@
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for, flash
+from flask import Flask, Response, render_template, request, jsonify, session, redirect, url_for, flash
 from werkzeug.security import generate_password_hash, check_password_hash
 from dotenv import load_dotenv  
-import csv
 import os
 import json
-import urllib.request
-import urllib.error
-import ssl
+import hashlib
 import markdown
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
 from datetime import datetime
-from functools import lru_cache
 from sentence_transformers import SentenceTransformer
-from sklearn.metrics.pairwise import cosine_similarity
 import numpy as np
+from search_engine import TrialSearchEngine
+from embedding_store import EmbeddingStore, STORE_DIR_NAME
+from facets import FacetIndex, ACTIVE_STATUSES, age_group_for
+from catalog import load_catalog
+from cache import LRUCache, SharedCache, QueryEmbeddingCache, ResultCache, normalize_query
+from embedding_service import EmbeddingBatcher
+from patient_matching import PatientMatcher, PatientEmbeddings
+from singleflight import SingleFlight
+from http_client import HTTPClient, HTTPStatusError
+from summaries import SummaryStore, SUMMARY_NAMESPACE, fallback_summary, post_cohere_chat
+from chat_stream import MarkdownStream, sse_event, stream_cohere_chat
+from trial_api import TrialApiCache, TrialApiStore, NOT_HARVESTED, fetch_study, DEFAULT_BASE_URL
+from precompute import trial_text
+from trial_context import TrialContextCache, CONTEXT_NAMESPACE
+from email_outbox import EmailOutbox, EmailSender
+from sqlite_pool import SQLitePool
+from migrations import migrate
 
 # Load environment variables from the .env file
 load_dotenv()
@@ -23,92 +32,35 @@ load_dotenv()
 app = Flask(__name__)
 app.secret_key = os.getenv("FLASK_SECRET_KEY", "supersecretkey")
 
-def send_actual_email(to_email, subject, body):
-    """Sends an actual email using SMTP settings from environment variables."""
-    smtp_server = os.getenv("SMTP_SERVER")
-    smtp_port = os.getenv("SMTP_PORT", "587")
-    smtp_user = os.getenv("SMTP_USERNAME")
-    smtp_pass = os.getenv("SMTP_PASSWORD")
-
-    if not all([smtp_server, smtp_user, smtp_pass]):
-        print("[EMAIL] Skipping real email sending: SMTP credentials missing in environment.")
-        return False
-
-    try:
-        msg = MIMEMultipart()
-        msg['From'] = smtp_user
-        msg['To'] = to_email
-        msg['Subject'] = subject
-        msg.attach(MIMEText(body, 'plain'))
-
-        server = smtplib.SMTP(smtp_server, int(smtp_port))
-        server.starttls()
-        server.login(smtp_user, smtp_pass)
-        server.send_message(msg)
-        server.quit()
-        print(f"[EMAIL] Successfully sent email to {to_email}")
-        return True
-    except Exception as e:
-        print(f"[EMAIL ERROR] Failed to send email to {to_email}: {e}")
-        return False
-
 # ── Persistent storage ──────────────────────────────────────────────────────
 DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
 os.makedirs(DATA_DIR, exist_ok=True)
 
 DB_FILE = os.path.join(DATA_DIR, 'database.db')
+CACHE_DB_FILE = os.path.join(DATA_DIR, 'cache.db')
+
+# Connections to database.db are pooled and reused (WAL mode, tuned pragmas, see
+# sqlite_pool.py); conn.close() hands a connection back to the pool.
+db_pool = SQLitePool(
+    DB_FILE,
+    max_idle=int(os.getenv("DB_POOL_SIZE", "16")),
+    busy_timeout=float(os.getenv("DB_BUSY_TIMEOUT", "10")),
+    cache_size_kib=int(os.getenv("DB_CACHE_KIB", "65536")),
+    mmap_size=int(os.getenv("DB_MMAP_BYTES", str(256 << 20))),
+)
 
 def get_db_connection():
-    import sqlite3
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    return conn
+    return db_pool.connection()
 
 def init_db():
-    import sqlite3
     conn = get_db_connection()
+    # Schema changes live in migrations.py
+    migrate(conn)
     c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS patients (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    name TEXT,
-                    email TEXT UNIQUE,
-                    condition TEXT,
-                    organization TEXT,
-                    password TEXT
-                 )''')
-    c.execute('''CREATE TABLE IF NOT EXISTS doctors (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    name TEXT,
-                    email TEXT UNIQUE,
-                    organization TEXT,
-                    password TEXT
-                 )''')
-    c.execute('''CREATE TABLE IF NOT EXISTS consents (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    patient_name TEXT,
-                    patient_email TEXT,
-                    condition TEXT,
-                    patient_age TEXT,
-                    patient_gender TEXT,
-                    trial_id TEXT,
-                    trial_title TEXT,
-                    decision TEXT,
-                    timestamp TEXT,
-                    enrolled BOOLEAN
-                 )''')
-
-    # Check if organization column exists in patients table
-    c.execute("PRAGMA table_info(patients)")
-    columns = [column[1] for column in c.fetchall()]
-    if 'organization' not in columns:
-        c.execute('ALTER TABLE patients ADD COLUMN organization TEXT')
 
-    conn.commit()
-    
     # Migration logic
     c.execute('SELECT COUNT(*) FROM patients')
     if c.fetchone()[0] == 0:
-        import json
         for table, file_name in [('patients', 'patients.json'), ('doctors', 'doctors.json'), ('consents', 'consents.json')]:
             file_path = os.path.join(DATA_DIR, file_name)
             if os.path.exists(file_path):
@@ -125,7 +77,7 @@ def init_db():
                                              VALUES (?, ?, ?, ?)''', 
                                           (item.get('name'), item.get('email'), item.get('organization'), item.get('password')))
                             elif table == 'consents':
-                                c.execute('''INSERT INTO consents (patient_name, patient_email, condition, patient_age, patient_gender, trial_id, trial_title, decision, timestamp, enrolled)
+                                c.execute('''INSERT OR REPLACE INTO consents (patient_name, patient_email, condition, patient_age, patient_gender, trial_id, trial_title, decision, timestamp, enrolled)
                                              VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
                                           (item.get('patient_name'), item.get('patient_email'), item.get('condition'), item.get('patient_age'), item.get('patient_gender'), str(item.get('trial_id')), item.get('trial_title'), item.get('decision'), item.get('timestamp'), item.get('enrolled')))
                     except Exception as e:
@@ -135,108 +87,245 @@ def init_db():
 
 init_db()
 
-# ── Load trials from CSV ────────────────────────────────────────────────────
-def load_trials():
-    trials = []
-    csv_path = os.path.join(os.path.dirname(__file__), 'trials.csv')
-    if not os.path.exists(csv_path):
-        print(f"WARNING: trials.csv not found at {csv_path}")
-        return []
-    with open(csv_path, newline='', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
-        for i, row in enumerate(reader):
-            trials.append({
-                "id":              i + 1,
-                "title":           row.get("Brief Title") or "No Title Available",
-                "full_title":      row.get("Full Title") or "",
-                "condition":       row.get("Conditions") or "",
-                "description":     row.get("Intervention Description") or "",
-                "interventions":   row.get("Interventions") or "",
-                "eligibility":     row.get("Standard Age") or "",
-                "phase":           row.get("Phases") or "",
-                "status":          row.get("Overall Status") or "",
-                "location":        row.get("Organization Full Name") or "",
-                "duration":        row.get("Start Date") or "N/A",
-                "compensation":    "Contact sponsor",
-                "outcome_measure": row.get("Outcome Measure") or "",
-                "study_type":      row.get("Study Type") or "",
-                "primary_purpose": row.get("Primary Purpose") or "",
-            })
-    return trials
-
-ALL_TRIALS = load_trials()
-ACTIVE_TRIALS = [t for t in ALL_TRIALS if t["status"] in ("RECRUITING", "NOT_YET_RECRUITING")]
+# Outgoing email is queued in database.db and sent by background threads that
+# reuse one SMTP connection per thread (EMAIL_SENDER_WORKERS=0: none in this
+# process, e.g. when `python email_outbox.py` runs separately).
+email_outbox = EmailOutbox(get_db_connection)
+email_sender = EmailSender(
+    email_outbox,
+    workers=int(os.getenv("EMAIL_SENDER_WORKERS", "2")),
+    batch_size=int(os.getenv("EMAIL_BATCH_SIZE", "20")),
+    max_attempts=int(os.getenv("EMAIL_MAX_ATTEMPTS", "6")),
+    backoff=float(os.getenv("EMAIL_RETRY_BACKOFF", "30")),
+    log_path="server.log",
+)
+if email_sender.workers:
+    email_sender.start()
+
+# ── Load trials ─────────────────────────────────────────────────────────────
+TRIALS_CSV = os.path.join(os.path.dirname(__file__), 'trials.csv')
+TRIALS_SNAPSHOT = os.path.join(DATA_DIR, 'trials.snapshot')
+
+# Column-backed catalog; ALL_TRIALS[i] and ALL_TRIALS.get(trial_id) return
+# lightweight row views that templates render like the old trial dicts.
+ALL_TRIALS = load_catalog(TRIALS_SNAPSHOT, TRIALS_CSV)
+trial_facets = FacetIndex(ALL_TRIALS)
+ACTIVE_TRIALS = ALL_TRIALS.view(np.flatnonzero(trial_facets.mask(status=ACTIVE_STATUSES)))
 print(f"[STARTUP] Loaded {len(ALL_TRIALS)} total trials, {len(ACTIVE_TRIALS)} active")
 
 # ── NLP Startup Logic ───────────────────────────────────────────────────────
 print("[STARTUP] Loading SentenceTransformer model...")
 model = SentenceTransformer('all-MiniLM-L6-v2') 
 
+# Query embeddings are cached per process (LRU) and in data/cache.db, which all
+# workers share, so repeated conditions skip the SentenceTransformer forward pass.
+# Cache misses from concurrent requests are encoded together, in batches of up to
+# EMBED_BATCH_SIZE texts collected over at most EMBED_MAX_WAIT_MS milliseconds.
+embedding_batcher = EmbeddingBatcher(
+    encode=lambda texts: model.encode(texts, show_progress_bar=False),
+    max_batch_size=int(os.getenv("EMBED_BATCH_SIZE", "32")),
+    max_wait_ms=float(os.getenv("EMBED_MAX_WAIT_MS", "5")),
+    max_queue=int(os.getenv("EMBED_QUEUE_DEPTH", "1024")),
+)
+
+query_embeddings = QueryEmbeddingCache(
+    encode=embedding_batcher.encode,
+    memory=LRUCache(maxsize=int(os.getenv("QUERY_CACHE_SIZE", "4096")),
+                    ttl=float(os.getenv("QUERY_CACHE_TTL", "604800"))),
+    shared=SharedCache(CACHE_DB_FILE, namespace="query_embedding:all-MiniLM-L6-v2",
+                       ttl=float(os.getenv("QUERY_CACHE_TTL", "604800"))),
+)
+
 def embed_text(text):
-    return model.encode([str(text)], show_progress_bar=False)[0]
+    return query_embeddings.get(text)
 
-@lru_cache(maxsize=128)
-def fetch_trial_from_api(title):
-    """Fetches detailed trial information from clinicaltrials.gov API V2 using the title."""
-    import urllib.parse
-    base_url = "https://clinicaltrials.gov/api/v2/studies"
-    params = {
-        "query.term": title,
-        "pageSize": 1
-    }
-    url = f"{base_url}?{urllib.parse.urlencode(params)}"
+def patient_query_text(condition, gender):
+    """The text /patient embeds for a patient's search."""
+    return " ".join(filter(None, [condition.lower(), gender]))
 
-    try:
-        headers = {
-            "Accept": "application/json",
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
-        }
-        req = urllib.request.Request(url, headers=headers)
-        ctx = ssl.create_default_context()
-        with urllib.request.urlopen(req, context=ctx, timeout=15) as resp:
-            data = json.loads(resp.read().decode("utf-8"))
-            if data.get("studies"):
-                study = data["studies"][0]
-                protocol = study.get("protocolSection", {})
-
-                # Extract relevant modules for RAG
-                description_module = protocol.get("descriptionModule", {})
-                conditions_module = protocol.get("conditionsModule", {})
-                design_module = protocol.get("designModule", {})
-                arms_interventions_module = protocol.get("armsInterventionsModule", {})
-                eligibility_module = protocol.get("eligibilityModule", {})
-
-                api_data = {
-                    "detailed_description": description_module.get("detailedDescription", ""),
-                    "brief_summary": description_module.get("briefSummary", ""),
-                    "conditions": ", ".join(conditions_module.get("conditions", [])),
-                    "study_type": design_module.get("studyType", ""),
-                    "phases": ", ".join(design_module.get("phases", [])),
-                    "eligibility_criteria": eligibility_module.get("eligibilityCriteria", ""),
-                    "interventions": [
-                        f"{i.get('type')}: {i.get('name')} ({i.get('description', '')})"
-                        for i in arms_interventions_module.get("interventions", [])
-                    ]
-                }
-                return api_data
-    except Exception as e:
-        print(f"[API ERROR] Failed to fetch from clinicaltrials.gov: {e}")
-    return None
+def warm_query_cache(limit=int(os.getenv("QUERY_CACHE_WARM", "200"))):
+    """Pre-loads embeddings for the most common /patient searches.
+
+    Gender is only stored with consents, so each patient's condition is paired
+    with the gender of their consents, or none if they have not given one.
+    """
+    conn = get_db_connection()
+    rows = conn.execute("""
+        SELECT trim(p.condition) AS condition, IFNULL(trim(c.patient_gender), '') AS gender,
+               COUNT(DISTINCT p.email) AS n
+        FROM patients p LEFT JOIN consents c ON c.patient_email = p.email
+        WHERE p.condition IS NOT NULL AND trim(p.condition) != ''
+        GROUP BY lower(trim(p.condition)), 2 ORDER BY n DESC LIMIT ?
+    """, (limit,)).fetchall()
+    conn.close()
+    total, encoded = query_embeddings.warm([patient_query_text(row["condition"], row["gender"]) for row in rows])
+    print(f"[STARTUP] Query cache warmed with {total} patient searches ({encoded} newly encoded)")
+
+warm_query_cache()
+
+# Shared keep-alive client for Cohere and clinicaltrials.gov: per-host connection
+# pools, retries with jittered backoff and a circuit breaker per host.
+outbound = HTTPClient(
+    timeout=float(os.getenv("HTTP_TIMEOUT", "15")),
+    retries=int(os.getenv("HTTP_RETRIES", "2")),
+    pool_size=int(os.getenv("HTTP_POOL_SIZE", "10")),
+    failure_threshold=int(os.getenv("HTTP_BREAKER_FAILURES", "5")),
+    reset_timeout=float(os.getenv("HTTP_BREAKER_RESET", "30")),
+)
+
+# Concurrent identical outbound calls share one request; callers that join an
+# in-flight call give up after the per-service timeout.
+api_flights = SingleFlight("clinicaltrials_api", timeout=float(os.getenv("TRIAL_API_WAIT_TIMEOUT", "20")))
+cohere_flights = SingleFlight("cohere", timeout=float(os.getenv("COHERE_WAIT_TIMEOUT", "65")))
+CHAT_HEADERS = {"X-Client-Name": "TrialBridge"}
+
+# Trial summaries generated offline by `python summaries.py`; requests only read them
+trial_summaries = SummaryStore(SharedCache(CACHE_DB_FILE, namespace=SUMMARY_NAMESPACE, max_entries=2000000))
+
+# clinicaltrials.gov lookups, cached in data/cache.db with stale-while-revalidate.
+# CLINICALTRIALS_API_URL points at another API root (e.g. a local stand-in).
+trial_api = TrialApiCache(
+    flights=api_flights,
+    shared=SharedCache(CACHE_DB_FILE, namespace="clinicaltrials_api", max_entries=500000),
+    fetch=lambda title: fetch_study(title, outbound, base_url=os.getenv("CLINICALTRIALS_API_URL", DEFAULT_BASE_URL)),
+    ttl=float(os.getenv("TRIAL_API_TTL", str(7 * 86400))),
+    negative_ttl=float(os.getenv("TRIAL_API_NEGATIVE_TTL", "86400")),
+)
+
+# Prefetched by harvest_trials.py; titles it has not reached go through trial_api
+harvested_api = TrialApiStore(os.path.join(DATA_DIR, 'trial_api.db'))
 
-MATCHING_SAMPLE_SIZE = 50000 
-matching_trials = ALL_TRIALS[:MATCHING_SAMPLE_SIZE]
+def fetch_trial_from_api(title):
+    """Detailed trial information from clinicaltrials.gov API V2, looked up by title."""
+    data = harvested_api.get(title)
+    if data is NOT_HARVESTED:
+        data = trial_api.get(title)
+    return data
+
+# Per-trial /chat context, compiled once per version of the trial and its API
+# data and trimmed to CHAT_CONTEXT_TOKENS (estimated) tokens per message. With
+# CHAT_CONTEXT_RETRIEVAL=1 the long sections are chunked and embedded, and
+# each message gets the chunks closest to the user's question.
+CHAT_CONTEXT_TOKENS = int(os.getenv("CHAT_CONTEXT_TOKENS", "1200"))
+CHAT_CONTEXT_RETRIEVAL = os.getenv("CHAT_CONTEXT_RETRIEVAL", "1") == "1"
+trial_contexts = TrialContextCache(
+    memory=LRUCache(maxsize=int(os.getenv("CHAT_CONTEXT_CACHE_SIZE", "512"))),
+    shared=SharedCache(CACHE_DB_FILE, namespace=f"{CONTEXT_NAMESPACE}:all-MiniLM-L6-v2", max_entries=200000),
+    chunk_tokens=int(os.getenv("CHAT_CONTEXT_CHUNK_TOKENS", "120")),
+    embed_many=embedding_batcher.encode if CHAT_CONTEXT_RETRIEVAL else None,
+)
+trial_contexts.shared.drop_older_versions("trial_context:")
 
 print("[STARTUP] Loading pre-computed trial embeddings...")
+# Approximate (IVF) index when precompute.py has built one, exact search otherwise.
+# VECTOR_INDEX=exact forces brute force; VECTOR_INDEX_NPROBE trades latency for
+# recall (more clusters scored per query). Measure recall@k for your embeddings
+# with `python bench_search.py --recall` before relying on the default of 8.
+# Brute-force scans are split into SEARCH_SHARDS row ranges scored in parallel
+# (default: one per CPU core).
+index_options = dict(index_path=os.path.join(DATA_DIR, 'trial_index_ivf.npz'),
+                     index_kind=os.getenv("VECTOR_INDEX", "auto"),
+                     nprobe=int(os.getenv("VECTOR_INDEX_NPROBE", "8")),
+                     shards=int(os.getenv("SEARCH_SHARDS", str(os.cpu_count() or 1))))
+
+store_dir = os.path.join(DATA_DIR, STORE_DIR_NAME)
 embeddings_path = os.path.join(DATA_DIR, 'trial_embeddings.npy')
-try:
-    # Load the vectors directly from disk in milliseconds
-    trial_vectors = np.load(embeddings_path)
-    print(f"[STARTUP] Successfully loaded {len(trial_vectors)} trial embeddings!")
-except FileNotFoundError:
-    print(f"\n[ERROR] Could not find {embeddings_path}!")
-    print("Please run `python precompute.py` first to generate the embeddings.\n")
-    # Fallback empty array so the app doesn't crash entirely, but search won't work
-    trial_vectors = np.empty((0, 384))
+manifest_path = os.path.join(DATA_DIR, 'trial_embeddings_manifest.npz')
+store = None
+if EmbeddingStore.exists(store_dir):
+    # Memory-mapped, shared by all gunicorn workers through the page cache.
+    # EMBEDDING_PRECISION picks the copy used for full scans: int8, float16 or float32.
+    store = EmbeddingStore.open(store_dir, precision=os.getenv("EMBEDDING_PRECISION", "int8"))
+    # precompute.py writes the manifest after the store, so a store of another
+    # size is left over from an older or unfinished run
+    manifest_rows = None
+    if os.path.exists(manifest_path):
+        with np.load(manifest_path) as manifest:
+            manifest_rows = len(manifest["ids"])
+    if len(store) != manifest_rows or len(store) > len(ALL_TRIALS):
+        print(f"[STARTUP] WARNING: {store_dir} has {len(store)} trial embeddings, the last precompute.py run "
+              f"covered {manifest_rows} and the catalog has {len(ALL_TRIALS)} trials. Not using it; "
+              "run `python precompute.py` to rebuild it.")
+        store = None
+if store is not None:
+    trial_engine = TrialSearchEngine.from_store(store, **index_options)
+    print(f"[STARTUP] Memory-mapped {len(store)} trial embeddings from {store_dir}")
+else:
+    try:
+        # Load the vectors directly from disk in milliseconds
+        trial_vectors = np.load(embeddings_path)
+        print(f"[STARTUP] Successfully loaded {len(trial_vectors)} trial embeddings!")
+    except FileNotFoundError:
+        print(f"\n[ERROR] Could not find {embeddings_path}!")
+        print("Please run `python precompute.py` first to generate the embeddings.\n")
+        # Fallback empty array so the app doesn't crash entirely, but search won't work
+        trial_vectors = np.empty((0, 384))
+    if len(trial_vectors) > len(ALL_TRIALS):
+        print(f"[STARTUP] WARNING: {embeddings_path} has {len(trial_vectors)} rows for {len(ALL_TRIALS)} trials. "
+              "Not using it; run `python precompute.py` to rebuild it.")
+        trial_vectors = np.empty((0, 384))
+    trial_engine = TrialSearchEngine(trial_vectors, **index_options)
+
+trial_vectors = trial_engine.vectors  # the engine's normalized copy (or memmap)
+print(f"[STARTUP] Using {trial_engine.kind} vector index over {len(trial_engine)} trials")
+if len(trial_engine) < len(ALL_TRIALS):
+    print(f"[STARTUP] WARNING: only {len(trial_engine)} of {len(ALL_TRIALS)} trials have embeddings. "
+          "Run `python precompute.py` to make the rest searchable.")
+
+def search_version():
+    """Fingerprint of everything search results depend on: catalog, embeddings, index."""
+    parts = [ALL_TRIALS.version, trial_engine.kind, index_options["index_kind"], str(index_options["nprobe"])]
+    for path in (embeddings_path, os.path.join(store_dir, 'float32.npy'), index_options["index_path"]):
+        if os.path.exists(path):
+            stat = os.stat(path)
+            parts.append(f"{stat.st_size}:{stat.st_mtime_ns}")
+    return hashlib.sha1("|".join(parts).encode('utf-8')).hexdigest()[:16]
+
+# Final /patient match lists (trial ids), shared by all workers. The namespace
+# carries the search version, so rebuilding the catalog, embeddings or index
+# starts a fresh cache; the previous version's entries are dropped at startup.
+patient_results = ResultCache(
+    memory=LRUCache(maxsize=int(os.getenv("RESULT_CACHE_SIZE", "2048"))),
+    shared=SharedCache(CACHE_DB_FILE, namespace=f"patient_results:{search_version()}",
+                       max_entries=int(os.getenv("RESULT_CACHE_SHARED_SIZE", "50000"))),
+)
+patient_results.shared.drop_older_versions("patient_results:")
+
+def search_trials(query_vec, k, **filters):
+    """Top-k semantic matches restricted by facet filters (see facets.py)."""
+    return trial_engine.search(query_vec, k, mask=trial_facets.mask(**filters))
+
+# Best trials for every patient of an organization, cached per organization
+patient_matches = PatientMatcher(trial_engine, trial_facets, query_embeddings.get_many,
+                                 k=int(os.getenv("PATIENT_MATCHES_K", "5")),
+                                 max_organizations=int(os.getenv("PATIENT_MATCHES_ORGS", "256")))
+
+# Stored patient embeddings for the reverse (trial -> patients) direction
+patient_embeddings = PatientEmbeddings(get_db_connection, query_embeddings.get_many)
+
+def trial_vector(trial_id):
+    """Embedding of a trial: its precomputed row, or the trial text encoded on demand."""
+    row = ALL_TRIALS.row_of(trial_id)
+    if 0 <= row < len(trial_engine):
+        return np.asarray(trial_vectors[row], dtype=np.float32)
+    return embed_text(trial_text(ALL_TRIALS[row]))
+
+MAX_CANDIDATES = 100
+
+def candidate_count(value, default):
+    """A requested number of candidates clamped to 1..MAX_CANDIDATES; ValueError if not an integer."""
+    k = default if value is None or value == "" else int(value)
+    return max(1, min(k, MAX_CANDIDATES))
+
+def candidate_patients(organization, trial_id, k):
+    """The organization's patients whose conditions best fit a trial, best first."""
+    return patient_embeddings.top_patients(organization, trial_vector(trial_id), k)
+
+def org_patient_matches(organization, patients):
+    """{email: [{"trial": row, "score": cosine}, ...]} for the given patient rows."""
+    matches = patient_matches.for_organization(organization, patients)
+    return {email: [{"trial": ALL_TRIALS[int(row)], "score": float(score)} for row, score in zip(rows, scores)]
+            for email, (rows, scores) in matches.items()}
 
 # ── Routes ───────────────────────────────────────────────────────────────────
 
@@ -258,7 +347,7 @@ def consent_detail(consent_id):
         return redirect(url_for("doctor"))
 
     trial_id = int(consent["trial_id"])
-    trial = next((t for t in ALL_TRIALS if t["id"] == trial_id), None)
+    trial = ALL_TRIALS.get(trial_id)
 
     if not trial:
         flash("Trial not found.")
@@ -271,7 +360,7 @@ def consent_detail(consent_id):
 
 @app.route("/trial/<int:trial_id>")
 def trial_detail(trial_id):
-    trial = next((t for t in ALL_TRIALS if t["id"] == trial_id), None)
+    trial = ALL_TRIALS.get(trial_id)
     if not trial:
         flash("Trial not found.")
         return redirect(url_for("home"))
@@ -313,6 +402,7 @@ def patient_signup():
         name = request.form.get("name", "").strip()
         email = request.form.get("email", "").strip()
         condition = request.form.get("condition", "").strip()
+        age = request.form.get("age", "").strip()
         organization = request.form.get("organization", "").strip()
         password = request.form.get("password", "")
         
@@ -323,14 +413,17 @@ def patient_signup():
             flash("Email already exists. Please log in.")
             return redirect(url_for("patient_login"))
             
-        conn.execute("INSERT INTO patients (name, email, condition, organization, password) VALUES (?, ?, ?, ?, ?)",
-                     (name, email, condition, organization, generate_password_hash(password)))
+        conn.execute("INSERT INTO patients (name, email, condition, age, organization, password) VALUES (?, ?, ?, ?, ?, ?)",
+                     (name, email, condition, age or None, organization, generate_password_hash(password)))
         conn.commit()
         conn.close()
+        patient_matches.update_patient(organization, {"email": email, "condition": condition, "age": age})
+        patient_embeddings.update(email, condition)
         session["role"] = "patient"
         session["email"] = email
         session["name"] = name
         session["condition"] = condition
+        session["age"] = age
         session["organization"] = organization
         return redirect(url_for("patient"))
     return render_template("patient_signup.html")
@@ -400,6 +493,19 @@ def patient():
         session["age"] = request.form.get("age", "").strip()
         session["gender"] = request.form.get("gender", "").strip()
 
+        # Keep the patient record current so the doctor dashboard matches on it
+        conn = get_db_connection()
+        updated = conn.execute("UPDATE patients SET condition = ?, age = ? WHERE email = ? AND "
+                               "(IFNULL(condition, '') != ? OR IFNULL(age, '') != ?)",
+                               (session["condition"], session["age"], session.get("email"),
+                                session["condition"], session["age"])).rowcount
+        conn.commit()
+        conn.close()
+        if updated:
+            patient_matches.update_patient(session.get("organization"), {
+                "email": session.get("email"), "condition": session["condition"], "age": session["age"]})
+            patient_embeddings.update(session.get("email"), session["condition"])
+
     name = session.get("name", "")
     email = session.get("email", "")
     condition = session.get("condition", "")
@@ -411,34 +517,22 @@ def patient():
     # Matching algorithm
     filtered = []
     if user_condition or age or gender:
-        query_text = " ".join(filter(None, [user_condition, gender]))
+        query_text = patient_query_text(condition, gender)
         
-        age_group = ""
-        if age and age.isdigit():
-            age_int = int(age)
-            if age_int < 18:
-                age_group = "CHILD"
-            elif age_int >= 65:
-                age_group = "OLDER_ADULT"
-            else:
-                age_group = "ADULT"
-
-        if query_text and len(trial_vectors) > 0:
-            # Semantic search using SentenceTransformer cosine similarity
-            query_vec = embed_text(query_text)
-            sims = cosine_similarity([query_vec], trial_vectors).flatten()
-            
-            # Get top matches where similarity is > 0, ordered by best match
-            top_indices = np.argsort(sims)[::-1]
-            
-            for idx in top_indices:
-                trial = matching_trials[idx]
-                if age_group and trial.get("eligibility") and age_group not in trial.get("eligibility", ""):
-                    continue
-                if sims[idx] > 0.01:
-                    filtered.append(trial)
-                if len(filtered) >= 15:
-                    break
+        age_group = age_group_for(age)
+
+        if query_text and len(trial_engine) > 0:
+            result_key = f"{age_group}|{normalize_query(query_text)}"
+            trial_ids = patient_results.get(result_key)
+            if trial_ids is None:
+                # Semantic search using SentenceTransformer cosine similarity
+                query_vec = embed_text(query_text)
+
+                # Nearest trials open to the patient's age group, ordered by best match
+                top_indices, top_sims = search_trials(query_vec, 15, age_group=age_group)
+                trial_ids = [ALL_TRIALS[idx]["id"] for idx, sim in zip(top_indices, top_sims) if sim > 0.01]
+                patient_results.put(result_key, trial_ids)
+            filtered = [ALL_TRIALS.get(trial_id) for trial_id in trial_ids]
     
     trials_to_show = filtered if filtered else ALL_TRIALS[:15]
 
@@ -474,15 +568,19 @@ def consent():
     age       = data.get("age", "")
     gender    = data.get("gender", "")
 
-    trial = next((t for t in ALL_TRIALS if t["id"] == trial_id), None)
+    trial = ALL_TRIALS.get(trial_id)
     trial_title = trial["title"] if trial else "Unknown Trial"
 
     conn = get_db_connection()
-    conn.execute("DELETE FROM consents WHERE patient_email = ? AND trial_id = ?", (email, str(trial_id)))
-    
+    # One row per patient and trial (UNIQUE index); a new decision replaces the old one
     conn.execute("""
         INSERT INTO consents (patient_name, patient_email, condition, patient_age, patient_gender, trial_id, trial_title, decision, timestamp, enrolled)
         VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (patient_email, trial_id) DO UPDATE SET
+            patient_name = excluded.patient_name, condition = excluded.condition,
+            patient_age = excluded.patient_age, patient_gender = excluded.patient_gender,
+            trial_title = excluded.trial_title, decision = excluded.decision,
+            timestamp = excluded.timestamp, enrolled = excluded.enrolled
     """, (name, email, condition, age, gender, str(trial_id), trial_title, decision, datetime.now().strftime("%Y-%m-%d %H:%M"), False))
     conn.commit()
 
@@ -549,26 +647,28 @@ def doctor():
 
     patient_count = conn.execute("SELECT COUNT(*) FROM patients").fetchone()[0]
     conn.close()
+
+    # Top trials for each of the organization's patients, scored in one batch
+    if org_patients:
+        matches = org_patient_matches(organization, org_patients)
+        for p in org_patients:
+            p["matches"] = matches.get(p["email"], [])
     
     accepted       = [c for c in all_consents if c["decision"] == "accepted"]
     enrolled_count = len([c for c in all_consents if c.get("enrolled")])
     
     search_query = ""
+    active_only = False
     trials_to_show = ALL_TRIALS[:50]
     
     if request.method == "POST":
         search_query = request.form.get("search_query", "").strip()
-        if search_query and len(trial_vectors) > 0:
+        active_only = request.form.get("active_only") == "on"
+        if search_query and len(trial_engine) > 0:
             query_vec = embed_text(search_query)
-            sims = cosine_similarity([query_vec], trial_vectors).flatten()
-            top_indices = np.argsort(sims)[::-1]
-            
-            filtered = []
-            for idx in top_indices:
-                if sims[idx] > 0.01:
-                    filtered.append(matching_trials[idx])
-                if len(filtered) >= 50:
-                    break
+            top_indices, top_sims = search_trials(query_vec, 50,
+                                                  status=ACTIVE_STATUSES if active_only else None)
+            filtered = [ALL_TRIALS[idx] for idx, sim in zip(top_indices, top_sims) if sim > 0.01]
             if filtered:
                 trials_to_show = filtered
 
@@ -581,68 +681,58 @@ def doctor():
         active_trials  = len(ACTIVE_TRIALS),
         patient_count  = patient_count,
         search_query   = search_query,
+        active_only    = active_only,
         all_consents   = all_consents,
         org_patients   = org_patients,
         organization   = organization
     )
 
 
-@app.route("/request_consent", methods=["POST"])
-def request_consent():
+@app.route("/doctor/matches")
+def doctor_matches():
     if session.get("role") != "doctor":
         return jsonify({"status": "error", "message": "Unauthorized"}), 401
+    organization = session.get("organization")
+    if not organization:
+        return jsonify({"status": "success", "matches": {}})
 
-    data = request.get_json()
-    patient_email = data.get("patient_email")
-    trial_id = int(data.get("trial_id"))
-    doctor_name = session.get("name")
-    doctor_email = session.get("email")
-    doctor_org = session.get("organization")
-
-    # Security check: verify patient belongs to doctor's organization
     conn = get_db_connection()
-    patient = conn.execute("SELECT * FROM patients WHERE email = ? AND organization = ?", (patient_email, doctor_org)).fetchone()
+    org_patients = [dict(row) for row in conn.execute("SELECT * FROM patients WHERE organization = ?", (organization,)).fetchall()]
     conn.close()
 
-    if not patient:
-        return jsonify({"status": "error", "message": "Patient not found in your organization"}), 403
+    matches = org_patient_matches(organization, org_patients)
+    return jsonify({"status": "success", "matches": {
+        email: [{"trial_id": m["trial"]["id"], "title": m["trial"]["title"], "score": round(m["score"], 4)}
+                for m in trial_matches]
+        for email, trial_matches in matches.items()
+    }})
 
-    trial = next((t for t in ALL_TRIALS if t["id"] == trial_id), None)
-    if not trial:
+
+@app.route("/trial/<int:trial_id>/candidates")
+def trial_candidates(trial_id):
+    if session.get("role") != "doctor":
+        return jsonify({"status": "error", "message": "Unauthorized"}), 401
+    if not ALL_TRIALS.get(trial_id):
         return jsonify({"status": "error", "message": "Trial not found"}), 404
 
-    # Summarize trial description using Cohere
-    summary = "No summary available."
-    COHERE_API_KEY = os.getenv("COHERE_API_KEY")
+    try:
+        k = candidate_count(request.args.get("k"), 20)
+    except ValueError:
+        return jsonify({"status": "error", "message": "k must be an integer"}), 400
+    candidates = candidate_patients(session.get("organization"), trial_id, k)
+    return jsonify({"status": "success", "candidates": [
+        {"name": p["name"], "email": p["email"], "condition": p["condition"], "score": round(score, 4)}
+        for p, score in candidates
+    ]})
 
-    if COHERE_API_KEY:
-        prompt = f"Please provide a concise, patient-friendly summary of the following clinical trial description in 2-3 sentences:\n\n{trial['description']}"
-        payload = json.dumps({
-            "model": "command-r7b-12-2024",
-            "message": prompt,
-            "temperature": 0.3,
-        }).encode("utf-8")
-
-        req = urllib.request.Request(
-            "https://api.cohere.com/v1/chat",
-            data=payload,
-            headers={
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {COHERE_API_KEY}",
-            },
-            method="POST",
-        )
 
-        try:
-            ctx = ssl.create_default_context()
-            with urllib.request.urlopen(req, context=ctx, timeout=30) as resp:
-                result = json.loads(resp.read().decode("utf-8"))
-                summary = result["text"]
-        except Exception as e:
-            print(f"[SUMMARIZATION ERROR] {e}")
-            summary = trial["description"][:200] + "..."
+def summarize_trial(trial):
+    """Pre-generated patient-friendly summary (see summaries.py), else the truncated description."""
+    return trial_summaries.get(trial) or fallback_summary(trial)
 
-    # Simulate sending email
+
+def send_consent_request(patient_email, trial, summary, doctor_name, doctor_email):
+    """Queues the consent request email (sent and logged in the background); returns its outbox id."""
     email_content = f"""
     To: {patient_email}
     From: {doctor_email} ({doctor_name})
@@ -662,19 +752,62 @@ def request_consent():
     TrialBridge Team
     """
 
-    # Log the "email"
-    with open("server.log", "a") as f:
-        f.write(f"\n--- EMAIL REQUEST AT {datetime.now()} ---\n")
-        f.write(email_content)
-        f.write("\n-----------------------------------\n")
-
-    # Send actual email
     subject = f"Consent Request for Clinical Trial: {trial['title']}"
-    sent = send_actual_email(patient_email, subject, email_content)
+    email_id = email_outbox.enqueue(patient_email, subject, email_content)
+    if email_sender.workers:
+        email_sender.start()
+        email_sender.wake()
 
-    print(f"[REQUEST CONSENT] Email workflow completed for {patient_email} regarding trial {trial_id}. Actual sent: {sent}")
+    print(f"[REQUEST CONSENT] Email {email_id} queued for {patient_email} regarding trial {trial['id']}.")
+    return email_id
 
-    return jsonify({"status": "success", "summary": summary, "email_sent": sent})
+
+@app.route("/request_consent", methods=["POST"])
+def request_consent():
+    if session.get("role") != "doctor":
+        return jsonify({"status": "error", "message": "Unauthorized"}), 401
+
+    data = request.get_json()
+    patient_email = data.get("patient_email")
+    trial_id = int(data.get("trial_id"))
+    doctor_name = session.get("name")
+    doctor_email = session.get("email")
+    doctor_org = session.get("organization")
+
+    trial = ALL_TRIALS.get(trial_id)
+
+    # Without a patient_email, ask the top_k best-fitting patients of the organization
+    if not patient_email and data.get("top_k"):
+        if not trial:
+            return jsonify({"status": "error", "message": "Trial not found"}), 404
+        try:
+            top_k = candidate_count(data["top_k"], 20)
+            min_score = float(data.get("min_score", 0.0))
+        except (TypeError, ValueError):
+            return jsonify({"status": "error", "message": "top_k must be an integer and min_score a number"}), 400
+        candidates = [(p, score) for p, score in candidate_patients(doctor_org, trial_id, top_k)
+                      if score >= min_score]
+        summary = summarize_trial(trial)
+        requested = [{"email": p["email"], "score": round(score, 4), "email_status": "queued",
+                      "email_id": send_consent_request(p["email"], trial, summary, doctor_name, doctor_email)}
+                     for p, score in candidates]
+        return jsonify({"status": "success", "summary": summary, "requested": requested})
+
+    # Security check: verify patient belongs to doctor's organization
+    conn = get_db_connection()
+    patient = conn.execute("SELECT * FROM patients WHERE email = ? AND organization = ?", (patient_email, doctor_org)).fetchone()
+    conn.close()
+
+    if not patient:
+        return jsonify({"status": "error", "message": "Patient not found in your organization"}), 403
+
+    if not trial:
+        return jsonify({"status": "error", "message": "Trial not found"}), 404
+
+    summary = summarize_trial(trial)
+    email_id = send_consent_request(patient_email, trial, summary, doctor_name, doctor_email)
+
+    return jsonify({"status": "success", "summary": summary, "email_status": "queued", "email_id": email_id})
 
 
 @app.route("/debug")
@@ -690,12 +823,23 @@ def debug():
         "accepted_consents": len(accepted),
         "total_patients":    patient_count,
         "consents":          all_consents,
+        "query_cache":       query_embeddings.stats(),
+        "patient_results":   patient_results.stats(),
+        "trial_api_cache":   trial_api.stats(),
+        "outbound_http":     outbound.stats(),
+        "trial_summaries":   trial_summaries.stats(),
+        "trial_contexts":    trial_contexts.stats(),
+        "email_outbox":      email_outbox.stats(),
+        "email_sender":      email_sender.stats(),
+        "db_pool":           db_pool.stats(),
+        "single_flight":     {"clinicaltrials_api": api_flights.stats(), "cohere": cohere_flights.stats()},
+        "embedding_batches": embedding_batcher.stats(),
+        "patient_matches":   patient_matches.stats(),
     })
 
 
-@app.route("/chat", methods=["POST"])
-def chat():
-    data     = request.get_json()
+def chat_payload(data):
+    """The Cohere chat payload for a /chat request body, or None if its trial does not exist."""
     messages = data.get("messages", [])
     role     = data.get("role", "patient")
     trial_id = data.get("trial_id")
@@ -705,37 +849,14 @@ def chat():
         messages = [{"role": "user", "content": "Hello"}]
 
     if trial_id:
-        trial = next((t for t in ALL_TRIALS if t["id"] == trial_id), None)
+        trial = ALL_TRIALS.get(trial_id)
         if trial:
-            # Data from local CSV
-            trial_info = f"""
-            Title: {trial['title']}
-            Full Title: {trial.get('full_title')}
-            Status: {trial['status']}
-            Phase: {trial['phase']}
-            Condition: {trial['condition']}
-            Study Type: {trial.get('study_type')}
-            Primary Purpose: {trial.get('primary_purpose')}
-            Description: {trial['description']}
-            Interventions: {trial.get('interventions')}
-            Eligibility: {trial['eligibility']}
-            Outcome Measures: {trial.get('outcome_measure')}
-            Location: {trial['location']}
-            """
-
-            # Fetch additional data from clinicaltrials.gov API
-            api_data = fetch_trial_from_api(trial['title'])
-            if api_data:
-                trial_info += f"""
-                --- Additional Details from ClinicalTrials.gov ---
-                Detailed Description: {api_data['detailed_description']}
-                Brief Summary: {api_data['brief_summary']}
-                Conditions: {api_data['conditions']}
-                Study Type: {api_data['study_type']}
-                Phases: {api_data['phases']}
-                Eligibility Criteria: {api_data['eligibility_criteria']}
-                Interventions from API: {'; '.join(api_data['interventions'])}
-                """
+            context = trial_contexts.get(trial, fetch_trial_from_api(trial['title']))
+            query_vec = None
+            if CHAT_CONTEXT_RETRIEVAL and action != "summarize" and context.vectors is not None:
+                # Long sections ranked by relevance to the user's question
+                query_vec = embedding_batcher.encode([messages[-1]["content"]])[0]
+            trial_info = context.render(CHAT_CONTEXT_TOKENS, query_vec)
 
             preamble = (
                 f"You are a dedicated assistant for the clinical trial: '{trial['title']}'. "
@@ -747,7 +868,7 @@ def chat():
             if action == "summarize":
                 messages = [{"role": "user", "content": "Please provide a concise, clear, and patient-friendly summary of this clinical trial based on the provided data."}]
         else:
-            return jsonify({"reply": "Trial not found."}), 404
+            return None
     else:
         trial_context = "\n".join([
             f"- {t['title']} | Condition: {t['condition']} | Phase: {t['phase']} | Location: {t['location']}"
@@ -781,13 +902,40 @@ def chat():
 
     last_message = messages[-1]["content"] if messages else "Hello"
 
-    payload = json.dumps({
+    return {
         "model": "command-r7b-12-2024",
         "message": last_message,
         "chat_history": chat_history,
         "preamble": preamble,
         "temperature": 0.7,
-    }).encode("utf-8")
+    }
+
+
+def chat_error_reply(e):
+    if isinstance(e, HTTPStatusError):
+        body = e.read().decode("utf-8")
+        print(f"[CHAT ERROR] HTTP {e.code}: {body}")
+        return f"AI error {e.code}: {body}"
+    print(f"[CHAT ERROR] {type(e).__name__}: {e}")
+    return f"AI unavailable: {e}"
+
+
+def summarize_chat(payload, api_key):
+    """Cohere's reply to a trial summary request (action "summarize").
+
+    The request is the same for everyone, so concurrent ones share one call.
+    """
+    body = json.dumps(payload).encode("utf-8")
+    return cohere_flights.do(hashlib.sha1(body).hexdigest(), lambda: post_cohere_chat(
+        outbound, body, api_key, timeout=60, headers=CHAT_HEADERS))["text"]
+
+
+@app.route("/chat", methods=["POST"])
+def chat():
+    data    = request.get_json()
+    payload = chat_payload(data)
+    if payload is None:
+        return jsonify({"reply": "Trial not found."}), 404
 
     COHERE_API_KEY = os.getenv("COHERE_API_KEY")
 
@@ -795,31 +943,50 @@ def chat():
         print("[CHAT ERROR] COHERE_API_KEY not found in environment variables.")
         return jsonify({"reply": "AI service is currently unavailable (API key missing)."}), 500
 
-    req = urllib.request.Request(
-        "https://api.cohere.com/v1/chat",
-        data=payload,
-        headers={
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {COHERE_API_KEY}",
-            "X-Client-Name": "TrialBridge",
-        },
-        method="POST",
-    )
-
     try:
-        ctx = ssl.create_default_context()
-        with urllib.request.urlopen(req, context=ctx, timeout=60) as resp:
-            result = json.loads(resp.read().decode("utf-8"))
-            reply = result["text"]
-            html_reply = markdown.markdown(reply)
-            return jsonify({"reply": html_reply})
-    except urllib.error.HTTPError as e:
-        body = e.read().decode("utf-8")
-        print(f"[CHAT ERROR] HTTP {e.code}: {body}")
-        return jsonify({"reply": f"AI error {e.code}: {body}"})
+        if data.get("action") == "summarize":
+            reply = summarize_chat(payload, COHERE_API_KEY)
+        else:
+            reply = post_cohere_chat(outbound, payload, COHERE_API_KEY, timeout=60, headers=CHAT_HEADERS)["text"]
+        html_reply = markdown.markdown(reply)
+        return jsonify({"reply": html_reply})
     except Exception as e:
-        print(f"[CHAT ERROR] {type(e).__name__}: {e}")
-        return jsonify({"reply": f"AI unavailable: {e}"})
+        return jsonify({"reply": chat_error_reply(e)})
+
+
+@app.route("/chat/stream", methods=["POST"])
+def chat_stream():
+    """/chat as Server-Sent Events (see chat_stream.py); errors before the stream starts are JSON like /chat."""
+    data    = request.get_json()
+    payload = chat_payload(data)
+    if payload is None:
+        return jsonify({"reply": "Trial not found."}), 404
+
+    COHERE_API_KEY = os.getenv("COHERE_API_KEY")
+
+    if not COHERE_API_KEY:
+        print("[CHAT ERROR] COHERE_API_KEY not found in environment variables.")
+        return jsonify({"reply": "AI service is currently unavailable (API key missing)."}), 500
+
+    def events():
+        try:
+            if data.get("action") == "summarize":
+                # Coalesced like /chat, so it arrives as one piece
+                yield sse_event("done", {"reply": markdown.markdown(summarize_chat(payload, COHERE_API_KEY))})
+                return
+            rendered = MarkdownStream()
+            for event in stream_cohere_chat(outbound, payload, COHERE_API_KEY, timeout=60, headers=CHAT_HEADERS):
+                if event.get("event_type") == "text-generation":
+                    yield sse_event("token", {"text": event["text"]})
+                    html = rendered.feed(event["text"])
+                    if html:
+                        yield sse_event("block", {"html": html, "rest": rendered.pending})
+            yield sse_event("done", {"reply": rendered.finish()})
+        except Exception as e:
+            yield sse_event("error", {"reply": chat_error_reply(e)})
+
+    return Response(events(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 if __name__ == "__main__":
     app.run(debug=True, use_reloader=False)
\ No newline at end of file
@@ -0,0 +1,151 @@
+import os
+import sys
+import time
+import numpy as np
+from search_engine import TrialSearchEngine
+from vector_index import ExactIndex, build_ivf_index, load_index, normalize_rows
+
+# Micro-benchmark: per-query cost of the old search path (cosine_similarity
+# over the raw embeddings + full argsort) against TrialSearchEngine (GEMV on a
+# pre-normalized float32 matrix + argpartition top-k).
+#
+# Also compares the p99 latency of a sharded scan over all rows against the old
+# single-shard scan over the first 50k.
+#
+# --recall measures what the IVF index gives up for its speed: recall@k
+# against ExactIndex and latency per nprobe. Pure noise is the worst case
+# (no clusters to find); real sentence embeddings cluster by topic, so the
+# run also uses synthetic topic clusters and, when precompute.py has been
+# run, the trial embeddings and IVF index in data/. Pick VECTOR_INDEX_NPROBE
+# from the smallest nprobe with acceptable recall, or VECTOR_INDEX=exact.
+#
+#   python bench_search.py [n_rows ...]            default: 50000 500000
+#   python bench_search.py --recall [n_rows ...]   default: 100000
+
+DIM = 384
+N_QUERIES = 20
+BASELINE_ROWS = 50000
+NPROBES = (1, 2, 4, 8, 16, 32, 64)
+
+try:
+    from sklearn.metrics.pairwise import cosine_similarity
+except ImportError:
+    def cosine_similarity(a, b):
+        a = np.asarray(a, dtype=np.float32)
+        a = a / np.linalg.norm(a, axis=1, keepdims=True)
+        b = b / np.linalg.norm(b, axis=1, keepdims=True)
+        return a @ b.T
+
+
+def old_search(query_vec, trial_vectors, k):
+    sims = cosine_similarity([query_vec], trial_vectors).flatten()
+    top_indices = np.argsort(sims)[::-1]
+    return top_indices[:k]
+
+
+def time_per_query(fn, queries):
+    fn(queries[0])  # warm-up
+    start = time.perf_counter()
+    for q in queries:
+        fn(q)
+    return (time.perf_counter() - start) / len(queries) * 1000
+
+
+def bench(n_rows, rng):
+    vectors = rng.standard_normal((n_rows, DIM), dtype=np.float32)
+    queries = rng.standard_normal((N_QUERIES, DIM), dtype=np.float32)
+    engine = TrialSearchEngine(vectors)
+
+    for k in (15, 50):
+        old_ms = time_per_query(lambda q: old_search(q, vectors, k), queries)
+        new_ms = time_per_query(lambda q: engine.search(q, k), queries)
+        print(f"{n_rows:>8} rows  k={k:<3} old {old_ms:8.2f} ms   engine {new_ms:8.2f} ms   "
+              f"speedup {old_ms / new_ms:5.1f}x")
+
+        old_top = old_search(queries[0], vectors, k)
+        new_top, _ = engine.search(queries[0], k)
+        assert list(old_top) == list(new_top), "engine results differ from the old search"
+
+
+def p99_ms(fn, queries):
+    fn(queries[0])  # warm-up
+    timings = []
+    for q in queries:
+        start = time.perf_counter()
+        fn(q)
+        timings.append((time.perf_counter() - start) * 1000)
+    return np.percentile(timings, 99)
+
+
+def bench_sharded(n_rows, rng, k=15):
+    vectors = rng.standard_normal((n_rows, DIM), dtype=np.float32)
+    queries = rng.standard_normal((N_QUERIES * 5, DIM), dtype=np.float32)
+    shards = os.cpu_count() or 1
+    baseline = TrialSearchEngine(vectors[:BASELINE_ROWS])
+    sharded = TrialSearchEngine(vectors, shards=shards)
+    base_ms = p99_ms(lambda q: baseline.search(q, k), queries)
+    sharded_ms = p99_ms(lambda q: sharded.search(q, k), queries)
+    print(f"{n_rows:>8} rows  p99: single shard over {BASELINE_ROWS} {base_ms:8.2f} ms   "
+          f"{shards} shards over all {sharded_ms:8.2f} ms")
+
+    exact = TrialSearchEngine(vectors)
+    assert list(exact.search(queries[0], k)[0]) == list(sharded.search(queries[0], k)[0]), \
+        "sharded results differ from the exact search"
+
+
+def clustered(n_rows, rng, n_topics=1000, spread=1.2):
+    """Synthetic vectors scattered around topic centres, like embeddings of related texts."""
+    topics = rng.standard_normal((n_topics, DIM), dtype=np.float32)
+    return topics[rng.integers(n_topics, size=n_rows)] + spread * rng.standard_normal((n_rows, DIM), dtype=np.float32)
+
+
+def recall_at_k(found, truth):
+    return float(np.mean([len(np.intersect1d(f, t)) / len(t) for f, t in zip(found, truth)]))
+
+
+def bench_recall(label, vectors, queries, index=None, k=15):
+    """recall@k and latency of the IVF index per nprobe, against ExactIndex."""
+    exact = ExactIndex(vectors)
+    ivf = index or build_ivf_index(vectors, normalized=True)
+    truth = [exact.search(q, k)[0] for q in queries]
+    exact_ms = time_per_query(lambda q: exact.search(q, k), queries)
+    print(f"{label}: {len(vectors)} rows, {ivf.n_lists} lists, exact {exact_ms:.2f} ms/query")
+    for nprobe in NPROBES:
+        if nprobe > ivf.n_lists:
+            break
+        found = [ivf.search(q, k, nprobe=nprobe)[0] for q in queries]
+        ivf_ms = time_per_query(lambda q: ivf.search(q, k, nprobe=nprobe), queries)
+        print(f"  nprobe {nprobe:>3}  recall@{k} {recall_at_k(found, truth):.3f}  {ivf_ms:7.2f} ms/query")
+
+
+def bench_recall_all(sizes, rng):
+    for n_rows in sizes:
+        bench_recall("random", normalize_rows(rng.standard_normal((n_rows, DIM), dtype=np.float32)),
+                     rng.standard_normal((N_QUERIES * 5, DIM), dtype=np.float32))
+        data = clustered(n_rows + N_QUERIES * 5, rng)
+        bench_recall("clustered", normalize_rows(data[:n_rows]), data[n_rows:])
+
+    data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+    store_path = os.path.join(data_dir, 'embedding_store', 'float32.npy')
+    index_path = os.path.join(data_dir, 'trial_index_ivf.npz')
+    if os.path.exists(store_path) and os.path.exists(index_path):
+        vectors = np.load(store_path, mmap_mode='r')
+        index = load_index(vectors, index_path)
+        if index.is_exact:
+            return
+        # Trial vectors nudged off their rows stand in for user queries
+        rows = rng.choice(len(vectors), min(N_QUERIES * 5, len(vectors)), replace=False)
+        queries = vectors[rows] + 0.02 * rng.standard_normal((len(rows), vectors.shape[1]), dtype=np.float32)
+        bench_recall("trial embeddings", vectors, queries, index=index)
+
+
+if __name__ == "__main__":
+    rng = np.random.default_rng(0)
+    if sys.argv[1:2] == ["--recall"]:
+        bench_recall_all([int(n) for n in sys.argv[2:]] or [100000], rng)
+        sys.exit(0)
+    sizes = [int(n) for n in sys.argv[1:]] or [50000, 500000]
+    for n_rows in sizes:
+        bench(n_rows, rng)
+    for n_rows in sizes:
+        bench_sharded(n_rows, rng)
@@ -0,0 +1,253 @@
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+from per_process import ThreadConnection
+
+# ── Caches ──────────────────────────────────────────────────────────────────
+# LRUCache lives inside one process. SharedCache is a small SQLite key/value
+# table (data/cache.db) that every gunicorn worker opens, so a value computed
+# by one worker is a cheap disk read for the others and survives restarts.
+
+
+class LRUCache:
+    """Thread-safe in-process LRU cache with an optional TTL (seconds)."""
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and (self.ttl is None or time.time() - entry[1] < self.ttl):
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.time())
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def values(self):
+        """A snapshot of the cached values, expired ones included."""
+        with self._lock:
+            return [value for value, _ in self._data.values()]
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {"size": len(self._data), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses}
+
+
+class SharedCache:
+    """SQLite-backed key/value store shared between worker processes.
+
+    Entries live in one table partitioned by `namespace`. Values are bytes;
+    callers serialize. Once a namespace grows past max_entries the oldest
+    writes are evicted.
+    """
+
+    def __init__(self, path, namespace, max_entries=100000, ttl=None):
+        self.path = path
+        self.namespace = namespace
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+        self._local = ThreadConnection(self._connect)
+        conn = self._conn()
+        conn.execute('''CREATE TABLE IF NOT EXISTS cache (
+                            namespace TEXT,
+                            key TEXT,
+                            value BLOB,
+                            created_at REAL,
+                            PRIMARY KEY (namespace, key)
+                        )''')
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_age ON cache (namespace, created_at)")
+        conn.commit()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=5)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _conn(self):
+        return self._local.get()
+
+    def get(self, key):
+        try:
+            row = self._conn().execute("SELECT value, created_at FROM cache WHERE namespace = ? AND key = ?",
+                                       (self.namespace, key)).fetchone()
+        except sqlite3.Error as e:
+            print(f"[CACHE ERROR] {self.namespace} read failed: {e}")
+            row = None
+        if row is not None and (self.ttl is None or time.time() - row[1] < self.ttl):
+            self.hits += 1
+            return row[0]
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        try:
+            conn = self._conn()
+            conn.execute("INSERT OR REPLACE INTO cache (namespace, key, value, created_at) VALUES (?, ?, ?, ?)",
+                         (self.namespace, key, value, time.time()))
+            conn.commit()
+        except sqlite3.Error as e:
+            print(f"[CACHE ERROR] {self.namespace} write failed: {e}")
+            return
+        self._writes += 1
+        if self._writes % 1000 == 0:
+            self.prune()
+
+    def prune(self):
+        """Drops expired entries and the oldest ones beyond max_entries."""
+        conn = self._conn()
+        if self.ttl is not None:
+            conn.execute("DELETE FROM cache WHERE namespace = ? AND created_at < ?",
+                         (self.namespace, time.time() - self.ttl))
+        conn.execute('''DELETE FROM cache WHERE namespace = ? AND key IN (
+                            SELECT key FROM cache WHERE namespace = ?
+                            ORDER BY created_at DESC LIMIT -1 OFFSET ?)''',
+                     (self.namespace, self.namespace, self.max_entries))
+        conn.commit()
+
+    def clear(self):
+        conn = self._conn()
+        conn.execute("DELETE FROM cache WHERE namespace = ?", (self.namespace,))
+        conn.commit()
+
+    def drop_older_versions(self, prefix):
+        """Deletes other namespaces starting with prefix, e.g. results for an old catalog."""
+        conn = self._conn()
+        deleted = conn.execute("DELETE FROM cache WHERE substr(namespace, 1, ?) = ? AND namespace != ?",
+                               (len(prefix), prefix, self.namespace)).rowcount
+        conn.commit()
+        return deleted
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+
+# ── Search results ──────────────────────────────────────────────────────────
+class ResultCache:
+    """Trial-id lists for finished searches, in memory and in the shared store.
+
+    The shared namespace should include a version of everything the results
+    depend on (catalog, embeddings, index settings), so rebuilding any of them
+    moves to a fresh namespace instead of serving stale matches.
+    """
+
+    def __init__(self, memory, shared=None):
+        self.memory = memory
+        self.shared = shared
+
+    def get(self, key):
+        ids = self.memory.get(key)
+        if ids is None and self.shared is not None:
+            blob = self.shared.get(key)
+            if blob is not None:
+                ids = tuple(np.frombuffer(blob, dtype=np.int64).tolist())
+                self.memory.put(key, ids)
+        return ids
+
+    def put(self, key, ids):
+        ids = tuple(int(i) for i in ids)
+        self.memory.put(key, ids)
+        if self.shared is not None:
+            self.shared.put(key, np.array(ids, dtype=np.int64).tobytes())
+
+    def stats(self):
+        return {
+            "memory": self.memory.stats(),
+            "shared": self.shared.stats() if self.shared is not None else None,
+        }
+
+
+# ── Query embeddings ────────────────────────────────────────────────────────
+def normalize_query(text):
+    """Cache key for a search query: lower-cased with whitespace collapsed."""
+    return " ".join(str(text).lower().split())
+
+
+class QueryEmbeddingCache:
+    """Embeds query text once and serves repeats from memory or the shared store."""
+
+    def __init__(self, encode, memory, shared=None):
+        self.encode = encode
+        self.memory = memory
+        self.shared = shared
+        self.encoded = 0
+
+    def _lookup(self, key):
+        vector = self.memory.get(key)
+        if vector is None and self.shared is not None:
+            blob = self.shared.get(key)
+            if blob is not None:
+                vector = np.frombuffer(blob, dtype=np.float32)
+                self.memory.put(key, vector)
+        return vector
+
+    def _store(self, key, vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        vector.flags.writeable = False
+        self.memory.put(key, vector)
+        if self.shared is not None:
+            self.shared.put(key, vector.tobytes())
+        return vector
+
+    def get(self, text):
+        key = normalize_query(text)
+        vector = self._lookup(key)
+        if vector is None:
+            vector = self._store(key, self.encode([key])[0])
+            self.encoded += 1
+        return vector
+
+    def _get_keys(self, keys):
+        """{key: vector} for distinct keys, encoding all of the missing ones in one batch."""
+        found = {key: self._lookup(key) for key in dict.fromkeys(keys)}
+        missing = [key for key, vector in found.items() if vector is None]
+        if missing:
+            for key, vector in zip(missing, self.encode(missing)):
+                found[key] = self._store(key, vector)
+            self.encoded += len(missing)
+        return found, len(missing)
+
+    def get_many(self, texts):
+        """Vectors for several queries as one (n, dim) array."""
+        keys = [normalize_query(t) for t in texts]
+        found, _ = self._get_keys(keys)
+        return np.array([found[key] for key in keys], dtype=np.float32)
+
+    def warm(self, texts):
+        """Loads the given queries, encoding all of the missing ones in one batch."""
+        found, n_missing = self._get_keys(normalize_query(t) for t in texts if t and str(t).strip())
+        return len(found), n_missing
+
+    def stats(self):
+        return {
+            "memory": self.memory.stats(),
+            "shared": self.shared.stats() if self.shared is not None else None,
+            "encoded": self.encoded,
+        }
@@ -0,0 +1,356 @@
+import csv
+import hashlib
+import io
+import json
+import mmap
+import os
+import struct
+import sys
+from datetime import datetime
+import numpy as np
+
+# ── Trial catalog: CSV reader and binary snapshot ───────────────────────────
+# `python catalog.py` compiles trials.csv into data/trials.snapshot, a
+# memory-mappable columnar file:
+#
+#   b"TRIALSNP" | version (u32) | header length (u32) | JSON header | columns
+#
+# The JSON header records the row count, the SHA-256/size/mtime of the CSV it
+# was built from, and for every column the byte position of an int64 offsets
+# array (n_rows + 1 entries) and of the UTF-8 string data those offsets index.
+# Values are also NUL-separated, so a whole column decodes with one split.
+# Sections are 8-byte aligned so the offsets can be viewed in place.
+
+SNAPSHOT_MAGIC = b"TRIALSNP"
+SNAPSHOT_VERSION = 1
+_PREAMBLE = struct.Struct("<8sII")
+
+# Trial dict key -> (CSV column, value used when the cell is empty)
+TRIAL_FIELDS = {
+    "title":           ("Brief Title", "No Title Available"),
+    "full_title":      ("Full Title", ""),
+    "condition":       ("Conditions", ""),
+    "description":     ("Intervention Description", ""),
+    "interventions":   ("Interventions", ""),
+    "eligibility":     ("Standard Age", ""),
+    "phase":           ("Phases", ""),
+    "status":          ("Overall Status", ""),
+    "location":        ("Organization Full Name", ""),
+    "duration":        ("Start Date", "N/A"),
+    "outcome_measure": ("Outcome Measure", ""),
+    "study_type":      ("Study Type", ""),
+    "primary_purpose": ("Primary Purpose", ""),
+}
+COMPENSATION = "Contact sponsor"
+
+
+def iter_csv_trials(csv_path):
+    """Yields one trial dict per CSV row, in file order, with ids starting at 1."""
+    with open(csv_path, newline='', encoding='utf-8') as f:
+        reader = csv.DictReader(f)
+        for i, row in enumerate(reader):
+            trial = {"id": i + 1}
+            for field, (column, default) in TRIAL_FIELDS.items():
+                trial[field] = row.get(column) or default
+            trial["compensation"] = COMPENSATION
+            yield trial
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _pad(f):
+    f.write(b"\0" * (-f.tell() % 8))
+
+
+def csv_source_info(csv_path):
+    stat = os.stat(csv_path)
+    return {"csv_sha256": file_sha256(csv_path), "csv_size": stat.st_size, "csv_mtime": stat.st_mtime}
+
+
+def encode_snapshot(trials, source_info):
+    """Encodes trial dicts into snapshot bytes. source_info describes the CSV."""
+    columns = {field: [] for field in TRIAL_FIELDS}
+    n_rows = 0
+    for trial in trials:
+        for field in TRIAL_FIELDS:
+            columns[field].append(trial[field].encode('utf-8'))
+        n_rows += 1
+
+    header = {
+        "n_rows": n_rows,
+        **source_info,
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "columns": {},
+    }
+
+    # offsets[i] is where value i starts; value i ends one byte (the NUL) before offsets[i + 1]
+    blobs = {field: b"\0".join(values) for field, values in columns.items()}
+    offsets = {field: np.concatenate([[0], np.cumsum([len(v) + 1 for v in values], dtype=np.int64)]).astype(np.int64)
+               for field, values in columns.items()}
+    del columns
+
+    def layout(header_len):
+        pos = _PREAMBLE.size + header_len
+        for field in TRIAL_FIELDS:
+            pos += -pos % 8
+            offsets_at = pos
+            pos += offsets[field].nbytes
+            data_at = pos
+            pos += len(blobs[field])
+            header["columns"][field] = {"offsets": offsets_at, "data": data_at, "size": len(blobs[field])}
+
+    # Section positions are written into the header itself; iterate until its length settles
+    header_len = 0
+    while True:
+        layout(header_len)
+        header_bytes = json.dumps(header).encode('utf-8')
+        header_bytes += b" " * (-(_PREAMBLE.size + len(header_bytes)) % 8)
+        if len(header_bytes) == header_len:
+            break
+        header_len = len(header_bytes)
+
+    f = io.BytesIO()
+    f.write(_PREAMBLE.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(header_bytes)))
+    f.write(header_bytes)
+    for field in TRIAL_FIELDS:
+        _pad(f)
+        f.write(offsets[field].tobytes())
+        f.write(blobs[field])
+    return f.getvalue()
+
+
+def compile_snapshot(csv_path, snapshot_path):
+    """Compiles trials.csv into a snapshot file and returns the opened snapshot."""
+    data = encode_snapshot(iter_csv_trials(csv_path), csv_source_info(csv_path))
+    tmp_path = snapshot_path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, snapshot_path)
+    return TrialSnapshot(data)
+
+
+class StringColumn:
+    """One snapshot column: UTF-8 strings addressed through an offsets array."""
+
+    __slots__ = ("_buf", "_offsets", "_data_at", "_size")
+
+    def __init__(self, buf, offsets, data_at, size):
+        self._buf = buf
+        self._offsets = offsets
+        self._data_at = data_at
+        self._size = size
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i):
+        start, end = self._offsets[i], self._offsets[i + 1] - 1
+        return self._buf[self._data_at + start:self._data_at + end].decode('utf-8')
+
+    def to_list(self):
+        if len(self) == 0:
+            return []
+        return self._buf[self._data_at:self._data_at + self._size].decode('utf-8').split("\0")
+
+
+class TrialSnapshot:
+    """Parsed snapshot over a read-only buffer (an mmap of the file, or bytes)."""
+
+    def __init__(self, buf):
+        self._buf = buf
+        magic, version, header_len = _PREAMBLE.unpack_from(buf, 0)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise ValueError(f"not a version {SNAPSHOT_VERSION} trial snapshot")
+        self.header = json.loads(buf[_PREAMBLE.size:_PREAMBLE.size + header_len])
+        self.n_rows = self.header["n_rows"]
+        self.columns = {}
+        for field, info in self.header["columns"].items():
+            offsets = np.frombuffer(buf, dtype=np.int64, count=self.n_rows + 1, offset=info["offsets"])
+            self.columns[field] = StringColumn(buf, offsets, info["data"], info["size"])
+
+    @classmethod
+    def open(cls, path):
+        with open(path, 'rb') as f:
+            return cls(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def __len__(self):
+        return self.n_rows
+
+    @property
+    def version(self):
+        return self.header.get("csv_sha256") or ""
+
+    def is_stale(self, csv_path):
+        """True when trials.csv changed since the snapshot was compiled."""
+        if not os.path.exists(csv_path):
+            return False
+        stat = os.stat(csv_path)
+        return stat.st_mtime > self.header["csv_mtime"] or stat.st_size != self.header["csv_size"]
+
+
+def open_snapshot(snapshot_path, csv_path):
+    """Returns the snapshot if it exists and is up to date with the CSV, else None."""
+    if not os.path.exists(snapshot_path):
+        return None
+    try:
+        snapshot = TrialSnapshot.open(snapshot_path)
+    except (ValueError, struct.error) as e:
+        print(f"[CATALOG] Ignoring unreadable snapshot {snapshot_path}: {e}")
+        return None
+    if snapshot.is_stale(csv_path):
+        print(f"[CATALOG] {csv_path} is newer than {snapshot_path}. "
+              "Run `python catalog.py` to rebuild it; reading the CSV for now.")
+        return None
+    return snapshot
+
+
+# ── Trial catalog ───────────────────────────────────────────────────────────
+# TrialCatalog holds every trial as snapshot columns (one offsets array and one
+# string buffer per field) instead of a dict per trial. Rows are handed out as
+# TrialRow views that read their fields on access, so templates keep using
+# trial.title / trial["status"] unchanged. Subsets such as ACTIVE_TRIALS are
+# TrialViews: a row-number array (or range) over the same catalog.
+
+class TrialRow:
+    __slots__ = ("_catalog", "_row")
+
+    def __init__(self, catalog, row):
+        self._catalog = catalog
+        self._row = row
+
+    def __getitem__(self, key):
+        return self._catalog.value(self._row, key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return key in ROW_KEYS
+
+    def __iter__(self):
+        return iter(ROW_KEYS)
+
+    def __len__(self):
+        return len(ROW_KEYS)
+
+    def keys(self):
+        return ROW_KEYS
+
+    def to_dict(self):
+        return {key: self[key] for key in ROW_KEYS}
+
+    def __eq__(self, other):
+        if isinstance(other, TrialRow):
+            return self._catalog is other._catalog and self._row == other._row
+        return NotImplemented
+
+    def __hash__(self):
+        return hash((id(self._catalog), self._row))
+
+    def __repr__(self):
+        return f"<TrialRow id={self['id']} {self['title']!r}>"
+
+
+ROW_KEYS = ("id", *TRIAL_FIELDS, "compensation")
+
+
+class TrialView:
+    """Read-only sequence of catalog rows (a range or an array of row numbers)."""
+
+    __slots__ = ("_catalog", "rows")
+
+    def __init__(self, catalog, rows):
+        self._catalog = catalog
+        self.rows = rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return TrialView(self._catalog, self.rows[i])
+        return TrialRow(self._catalog, int(self.rows[i]))
+
+    def __iter__(self):
+        catalog = self._catalog
+        for row in self.rows:
+            yield TrialRow(catalog, int(row))
+
+
+class TrialCatalog(TrialView):
+    __slots__ = ("_columns", "ids", "_id_to_row", "version")
+
+    def __init__(self, snapshot):
+        super().__init__(self, range(len(snapshot)))
+        self._columns = snapshot.columns
+        self.version = snapshot.version
+        # Trial ids are CSV row numbers starting at 1; the index array keeps the
+        # id -> row lookup O(1) without assuming that.
+        self.ids = np.arange(1, len(snapshot) + 1, dtype=np.int64)
+        self._id_to_row = np.full(len(snapshot) + 1, -1, dtype=np.int64)
+        self._id_to_row[self.ids] = np.arange(len(snapshot))
+
+    def value(self, row, key):
+        if key == "id":
+            return int(self.ids[row])
+        if key == "compensation":
+            return COMPENSATION
+        return self._columns[key][row]
+
+    def column(self, key):
+        """All values of one field as a list, in row order."""
+        if key == "id":
+            return self.ids.tolist()
+        if key == "compensation":
+            return [COMPENSATION] * len(self)
+        return self._columns[key].to_list()
+
+    def row_of(self, trial_id):
+        """Row number of the trial with this id, or -1."""
+        try:
+            trial_id = int(trial_id)
+        except (TypeError, ValueError):
+            return -1
+        if not 0 <= trial_id < len(self._id_to_row):
+            return -1
+        return int(self._id_to_row[trial_id])
+
+    def get(self, trial_id):
+        """The trial with this id, or None."""
+        row = self.row_of(trial_id)
+        return TrialRow(self, row) if row >= 0 else None
+
+    def view(self, rows):
+        return TrialView(self, rows)
+
+
+def load_catalog(snapshot_path, csv_path):
+    """Opens the trial snapshot, or builds the same columns in memory from the CSV."""
+    snapshot = open_snapshot(snapshot_path, csv_path)
+    if snapshot is not None:
+        print(f"[CATALOG] Reading trials from snapshot {snapshot_path}")
+    elif os.path.exists(csv_path):
+        snapshot = TrialSnapshot(encode_snapshot(iter_csv_trials(csv_path), csv_source_info(csv_path)))
+    else:
+        print(f"WARNING: trials.csv not found at {csv_path}")
+        snapshot = TrialSnapshot(encode_snapshot([], {}))
+    return TrialCatalog(snapshot)
+
+
+if __name__ == "__main__":
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    csv_path = sys.argv[1] if len(sys.argv) > 1 else os.path.join(base_dir, 'trials.csv')
+    snapshot_path = os.path.join(base_dir, 'data', 'trials.snapshot')
+    print(f"Compiling {csv_path}...")
+    snapshot = compile_snapshot(csv_path, snapshot_path)
+    print(f"Snapshot with {len(snapshot)} trials saved to {snapshot_path} "
+          f"(csv sha256 {snapshot.version[:12]}).")
@@ -0,0 +1,65 @@
+import json
+import markdown
+from summaries import COHERE_CHAT_URL
+
+# ── Streaming chat replies ──────────────────────────────────────────────────
+# /chat/stream proxies Cohere's streamed chat (stream=True: one JSON event per
+# line) to the browser as Server-Sent Events:
+#
+#   event: token   {"text": delta}              every text-generation event
+#   event: block   {"html": ..., "rest": ...}   markdown blocks that just ended
+#   event: done    {"reply": html}              the whole reply, rendered once
+#   event: error   {"reply": message}           upstream failure mid-stream
+#
+# A block ends at a blank line outside a ``` fence, so it can be rendered on
+# its own; "rest" is the raw text after it that the client keeps showing as
+# plain text until its block ends. The final "done" rendering replaces the
+# pieces, which fixes constructs a block split can break (e.g. loose lists).
+
+
+def stream_cohere_chat(client, payload, api_key, timeout, headers=None):
+    """Yields Cohere's streamed chat events for a payload, decoded from JSON."""
+    body = json.dumps({**payload, "stream": True}).encode("utf-8")
+    lines = client.stream("POST", COHERE_CHAT_URL, body=body, timeout=timeout, retries=0, headers={
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {api_key}",
+        **(headers or {}),
+    })
+    for line in lines:
+        if line.strip():
+            yield json.loads(line)
+
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+class MarkdownStream:
+    """Renders a streamed markdown reply one finished block at a time."""
+
+    def __init__(self):
+        self.text = ""
+        self.pending = ""
+
+    def feed(self, delta):
+        """Adds streamed text; returns the HTML of the blocks it finished, or ""."""
+        self.text += delta
+        self.pending += delta
+        boundary = None
+        offset = 0
+        in_fence = False
+        for line in self.pending.splitlines(keepends=True):
+            if not line.endswith("\n"):
+                break
+            offset += len(line)
+            if line.lstrip().startswith("```"):
+                in_fence = not in_fence
+            elif not in_fence and not line.strip():
+                boundary = offset
+        if boundary is None:
+            return ""
+        block, self.pending = self.pending[:boundary], self.pending[boundary:]
+        return markdown.markdown(block) if block.strip() else ""
+
+    def finish(self):
+        return markdown.markdown(self.text)
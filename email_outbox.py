@@ -0,0 +1,293 @@
+import os
+import random
+import smtplib
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from email.mime.text import MIMEText
+from email.mime.multipart import MIMEMultipart
+from per_process import PerProcess
+
+# ── Email outbox ────────────────────────────────────────────────────────────
+# Request handlers only insert a row into the email_outbox table of
+# database.db and return. EmailSender threads claim due rows in batches,
+# append them to server.log and deliver each batch over one authenticated
+# SMTP connection. The connection stays open for the next batch until it
+# has been idle for `idle_timeout` seconds.
+#
+#   pending   waiting for its first attempt or a retry (next_attempt_at)
+#   sending   claimed by a sender; reclaimed after `lease` seconds if that
+#             sender died mid-batch
+#   sent      delivered (sent_at)
+#   failed    refused permanently (5xx) or out of attempts (last_error)
+#
+# While SMTP_SERVER / SMTP_USERNAME / SMTP_PASSWORD are not set, claimed email
+# goes back to pending every `unconfigured_delay` seconds without using up an
+# attempt, so it is sent once they are.
+#
+# Temporary failures are retried with jittered exponential backoff. The table
+# lives in database.db, so queued mail survives restarts and any process can
+# send it: EMAIL_SENDER_WORKERS=0 turns the in-app senders off, and
+# `python email_outbox.py` runs them on their own.
+
+PENDING, SENDING, SENT, FAILED = "pending", "sending", "sent", "failed"
+NOT_CONFIGURED = "SMTP credentials missing in environment"
+
+
+class SMTPUnavailable(Exception):
+    """Connecting or logging in to the SMTP server failed; no email was refused."""
+
+
+def smtp_settings():
+    """(server, port, username, password) from the environment, or None if incomplete."""
+    server = os.getenv("SMTP_SERVER")
+    user = os.getenv("SMTP_USERNAME")
+    password = os.getenv("SMTP_PASSWORD")
+    if not all([server, user, password]):
+        return None
+    return server, int(os.getenv("SMTP_PORT", "587")), user, password
+
+
+def is_permanent(error):
+    """Whether retrying cannot help, e.g. a refused recipient."""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return True
+    return isinstance(error, smtplib.SMTPResponseException) and 500 <= error.smtp_code < 600
+
+
+class EmailOutbox:
+    def __init__(self, get_connection):
+        self.get_connection = get_connection
+
+    def enqueue(self, to_email, subject, body):
+        """Queues one email; returns its outbox id."""
+        now = time.time()
+        conn = self.get_connection()
+        try:
+            cur = conn.execute('''INSERT INTO email_outbox (to_email, subject, body, status, attempts,
+                                                           next_attempt_at, created_at)
+                                  VALUES (?, ?, ?, ?, 0, ?, ?)''', (to_email, subject, body, PENDING, now, now))
+            conn.commit()
+            return cur.lastrowid
+        finally:
+            conn.close()
+
+    def claim(self, limit, lease):
+        """Marks up to `limit` due emails as sending and returns them."""
+        now = time.time()
+        conn = self.get_connection()
+        try:
+            # IMMEDIATE takes the write lock first, so two senders never claim the same row
+            conn.execute("BEGIN IMMEDIATE")
+            rows = conn.execute('''SELECT id, to_email, subject, body, attempts, created_at, last_error FROM email_outbox
+                                   WHERE (status = ? AND next_attempt_at <= ?) OR (status = ? AND claimed_at < ?)
+                                   ORDER BY next_attempt_at LIMIT ?''',
+                                (PENDING, now, SENDING, now - lease, limit)).fetchall()
+            conn.executemany("UPDATE email_outbox SET status = ?, attempts = attempts + 1, claimed_at = ? WHERE id = ?",
+                             [(SENDING, now, row[0]) for row in rows])
+            conn.commit()
+            return [dict(zip(("id", "to_email", "subject", "body", "attempts", "created_at", "last_error"), row))
+                    for row in rows]
+        finally:
+            conn.close()
+
+    def record(self, updates):
+        """Stores outcomes: (id, status, error, next_attempt_at) tuples."""
+        if not updates:
+            return
+        now = time.time()
+        conn = self.get_connection()
+        try:
+            conn.executemany('''UPDATE email_outbox SET status = ?, last_error = ?, next_attempt_at = ?,
+                                       claimed_at = NULL, sent_at = CASE WHEN ? = 'sent' THEN ? ELSE sent_at END
+                                WHERE id = ?''',
+                             [(status, error, next_at, status, now, id_) for id_, status, error, next_at in updates])
+            conn.commit()
+        finally:
+            conn.close()
+
+    def postpone(self, ids, error, next_attempt_at):
+        """Puts claimed emails back as pending without using up an attempt."""
+        conn = self.get_connection()
+        try:
+            conn.executemany('''UPDATE email_outbox SET status = ?, attempts = attempts - 1, last_error = ?,
+                                       next_attempt_at = ?, claimed_at = NULL
+                                WHERE id = ?''', [(PENDING, error, next_attempt_at, id_) for id_ in ids])
+            conn.commit()
+        finally:
+            conn.close()
+
+    def stats(self):
+        conn = self.get_connection()
+        try:
+            return dict(conn.execute("SELECT status, COUNT(*) FROM email_outbox GROUP BY status").fetchall())
+        finally:
+            conn.close()
+
+
+class EmailSender:
+    def __init__(self, outbox, workers=2, batch_size=20, poll_interval=2.0, max_attempts=6,
+                 backoff=30.0, lease=300.0, idle_timeout=60.0, unconfigured_delay=60.0, log_path="server.log"):
+        self.outbox = outbox
+        self.workers = workers
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.lease = lease
+        self.idle_timeout = idle_timeout
+        self.unconfigured_delay = unconfigured_delay
+        self.log_path = log_path
+        self.counts = {"batches": 0, "sent": 0, "retried": 0, "failed": 0, "postponed": 0, "connections": 0}
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._threads = PerProcess(self._start_threads, alive=lambda threads: all(t.is_alive() for t in threads))
+        self._local = threading.local()  # each sender thread's SMTP connection
+
+    def start(self):
+        """Starts this process's sender threads, unless they are running."""
+        self._threads.get()
+
+    def _start_threads(self):
+        threads = [threading.Thread(target=self._run, name=f"email-sender-{i}", daemon=True)
+                   for i in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        return threads
+
+    def wake(self):
+        """Starts sending now instead of at the next poll."""
+        self._wake.set()
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self.counts[name] += n
+
+    def _run(self):
+        idle_since = time.monotonic()
+        while True:
+            try:
+                batch = self.outbox.claim(self.batch_size, self.lease)
+            except sqlite3.Error as e:
+                print(f"[EMAIL ERROR] Could not read the outbox: {e}")
+                batch = []
+            if not batch:
+                if time.monotonic() - idle_since > self.idle_timeout:
+                    self._disconnect()
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+                continue
+            self._deliver(batch)
+            idle_since = time.monotonic()
+
+    def _log(self, batch):
+        # First attempts only, so a retried or postponed email is logged once
+        with open(self.log_path, "a") as f:
+            for email in batch:
+                if email["attempts"] == 0 and email["last_error"] is None:
+                    f.write(f"\n--- EMAIL REQUEST AT {datetime.fromtimestamp(email['created_at'])} ---\n")
+                    f.write(email["body"])
+                    f.write("\n-----------------------------------\n")
+
+    def _disconnect(self):
+        smtp = getattr(self._local, "smtp", None)
+        self._local.smtp = None
+        if smtp is not None:
+            try:
+                smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                smtp.close()
+
+    def _send(self, msg, settings):
+        """Sends msg on this thread's connection, opening a new one if needed."""
+        smtp = getattr(self._local, "smtp", None)
+        if smtp is not None:
+            try:
+                smtp.send_message(msg)
+                return
+            except smtplib.SMTPServerDisconnected:
+                self._local.smtp = None  # dropped by the server while idle
+        server, port, user, password = settings
+        try:
+            smtp = smtplib.SMTP(server, port, timeout=30)
+            smtp.starttls()
+            smtp.login(user, password)
+        except (smtplib.SMTPException, OSError) as e:
+            raise SMTPUnavailable(f"cannot connect to {server}:{port}: {e}") from e
+        self._count("connections")
+        self._local.smtp, self._local.settings = smtp, settings
+        smtp.send_message(msg)
+
+    def _retry(self, email, error, permanent=False):
+        if permanent or email["attempts"] + 1 >= self.max_attempts:
+            self._count("failed")
+            print(f"[EMAIL ERROR] Giving up on email {email['id']} to {email['to_email']}: {error}")
+            return (email["id"], FAILED, str(error), None)
+        self._count("retried")
+        delay = min(self.backoff * 2 ** email["attempts"], 3600) * random.uniform(0.5, 1.5)
+        print(f"[EMAIL ERROR] Failed to send email {email['id']} to {email['to_email']}, retrying in {delay:.0f}s: {error}")
+        return (email["id"], PENDING, str(error), time.time() + delay)
+
+    def _deliver(self, batch):
+        self._count("batches")
+        try:
+            self._log(batch)
+        except OSError as e:
+            print(f"[EMAIL ERROR] Could not write server.log: {e}")
+
+        settings = smtp_settings()
+        if settings is None:
+            print(f"[EMAIL] Not sending yet: {NOT_CONFIGURED} ({len(batch)} emails kept pending).")
+            self.outbox.postpone([email["id"] for email in batch], NOT_CONFIGURED,
+                                 time.time() + self.unconfigured_delay * random.uniform(0.5, 1.5))
+            self._count("postponed", len(batch))
+            return
+        if getattr(self._local, "settings", None) != settings:
+            self._disconnect()
+
+        updates = []
+        for i, email in enumerate(batch):
+            msg = MIMEMultipart()
+            msg['From'] = settings[2]
+            msg['To'] = email["to_email"]
+            msg['Subject'] = email["subject"]
+            msg.attach(MIMEText(email["body"], 'plain'))
+            try:
+                self._send(msg, settings)
+            except SMTPUnavailable as e:
+                # Nothing in this batch can go out; try all of it again later
+                updates.extend(self._retry(rest, e) for rest in batch[i:])
+                break
+            except (smtplib.SMTPException, OSError) as e:
+                if not isinstance(e, smtplib.SMTPResponseException):
+                    self._disconnect()
+                updates.append(self._retry(email, e, permanent=is_permanent(e)))
+                continue
+            updates.append((email["id"], SENT, None, None))
+            self._count("sent")
+            print(f"[EMAIL] Successfully sent email to {email['to_email']}")
+        self.outbox.record(updates)
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counts, workers=sum(t.is_alive() for t in self._threads.peek() or []))
+
+
+if __name__ == "__main__":
+    # Sends queued email without the web app: python email_outbox.py [workers]
+    import sys
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    db_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'database.db')
+    sender = EmailSender(EmailOutbox(lambda: sqlite3.connect(db_file, timeout=30)),
+                         workers=int(sys.argv[1]) if len(sys.argv) > 1 else 2)
+    sender.start()
+    print(f"[EMAIL] Sending queued email from {db_file} with {sender.workers} workers; Ctrl+C to stop.")
+    try:
+        while True:
+            time.sleep(60)
+            print(f"[EMAIL] {sender.stats()} outbox={sender.outbox.stats()}")
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,120 @@
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import Future
+import numpy as np
+from per_process import PerProcess
+
+# ── Micro-batching embedding service ────────────────────────────────────────
+# Request threads used to call model.encode([text]) one query at a time, all
+# contending for the same torch thread pool. EmbeddingBatcher puts each text on
+# a bounded queue instead; a single worker thread drains it and encodes up to
+# max_batch_size texts per forward pass, waiting at most max_wait_ms after the
+# first one arrives for others to join. Every caller blocks only on its own
+# Future, so concurrent /patient requests share one batched encode.
+
+
+class EmbeddingQueueFull(RuntimeError):
+    """Raised when the embedding queue stays full for longer than submit_timeout."""
+
+
+class EmbeddingBatcher:
+    def __init__(self, encode, max_batch_size=32, max_wait_ms=5.0, max_queue=1024, submit_timeout=5.0):
+        self.encode_batch = encode
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.submit_timeout = submit_timeout
+        self.batches = 0
+        self.items = 0
+        self.largest_batch = 0
+        self.max_queue = max_queue
+        # (queue, thread) per process. The queue is made with its thread: one
+        # inherited across a fork still lists the parent's waiting worker,
+        # and put() would wake that one instead of the child's.
+        self._worker = PerProcess(self._start_worker, alive=lambda worker: worker[1].is_alive())
+
+    def _start_worker(self):
+        jobs = queue.Queue(maxsize=self.max_queue)
+        thread = threading.Thread(target=self._run, args=(jobs,), name="embedding-batcher", daemon=True)
+        thread.start()
+        return jobs, thread
+
+    def submit(self, text):
+        """Queues one text and returns a Future that resolves to its vector."""
+        jobs, _ = self._worker.get()
+        future = Future()
+        try:
+            jobs.put((str(text), future), timeout=self.submit_timeout)
+        except queue.Full:
+            raise EmbeddingQueueFull(f"embedding queue is full ({jobs.maxsize} pending)") from None
+        return future
+
+    def encode(self, texts, timeout=None):
+        """Encodes texts through the shared batches; returns an array of vectors."""
+        futures = [self.submit(text) for text in texts]
+        return np.array([future.result(timeout) for future in futures], dtype=np.float32)
+
+    def _collect(self, jobs):
+        batch = [jobs.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(jobs.get(timeout=remaining) if remaining > 0 else jobs.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self, jobs):
+        while True:
+            batch = self._collect(jobs)
+            # Identical texts in one batch (popular conditions) are encoded once
+            unique = list(dict.fromkeys(text for text, _ in batch))
+            try:
+                vectors = self.encode_batch(unique)
+            except Exception as e:
+                print(f"[EMBEDDING ERROR] Batch of {len(unique)} failed: {e}")
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            by_text = dict(zip(unique, vectors))
+            for text, future in batch:
+                future.set_result(np.asarray(by_text[text], dtype=np.float32))
+            self.batches += 1
+            self.items += len(batch)
+            self.largest_batch = max(self.largest_batch, len(batch))
+
+    def stats(self):
+        worker = self._worker.peek()
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "mean_batch": round(self.items / self.batches, 2) if self.batches else 0.0,
+            "largest_batch": self.largest_batch,
+            "pending": worker[0].qsize() if worker else 0,
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000.0,
+        }
+
+
+if __name__ == "__main__":
+    # Throughput with N concurrent callers, batch-of-one vs micro-batched:
+    #   python embedding_service.py [n_threads]      default: 64
+    from concurrent.futures import ThreadPoolExecutor
+    from sentence_transformers import SentenceTransformer
+
+    n_threads = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    model = SentenceTransformer('all-MiniLM-L6-v2')
+    texts = [f"condition {i} with persistent symptoms" for i in range(n_threads * 8)]
+    batcher = EmbeddingBatcher(lambda batch: model.encode(batch, show_progress_bar=False))
+
+    for label, fn in (("batch of one", lambda t: model.encode([t], show_progress_bar=False)[0]),
+                      ("micro-batched", lambda t: batcher.encode([t])[0])):
+        fn(texts[0])  # warm-up
+        start = time.perf_counter()
+        with ThreadPoolExecutor(n_threads) as pool:
+            list(pool.map(fn, texts))
+        elapsed = time.perf_counter() - start
+        print(f"{label:>14}: {len(texts) / elapsed:8.1f} queries/s with {n_threads} threads")
+    print(batcher.stats())
@@ -0,0 +1,168 @@
+import os
+import numpy as np
+from vector_index import normalize_rows, normalize_vector, top_k
+
+# ── Memory-mapped embedding store ───────────────────────────────────────────
+# precompute.py writes the normalized trial matrix to data/embedding_store/ in
+# plain .npy files:
+#
+#   float32.npy                    exact vectors, used to re-rank shortlists
+#   float16.npy                    half-precision copy (2x smaller)
+#   int8.npy + int8_scale.npy      scalar-quantized copy (4x smaller)
+#
+# app.py opens them with mmap_mode="r", so every gunicorn worker maps the same
+# files and the kernel keeps a single page-cache copy for all of them. Full
+# scans only touch the low-precision file; the float32 file is read just for
+# the handful of rows in each shortlist.
+
+PRECISIONS = ("float32", "float16", "int8")
+STORE_DIR_NAME = "embedding_store"
+
+
+def write_embedding_store(vectors, store_dir, precisions=("float16", "int8"), block_size=8192):
+    """Writes normalized float32 vectors plus the requested low-precision copies.
+
+    Works block by block, so `vectors` can itself be a memmap larger than RAM.
+    Files are written under temporary names and swapped in at the end; workers
+    still mapping the old files keep reading them until they restart.
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    n_rows, dim = len(vectors), (vectors.shape[1] if len(vectors) else 384)
+    blocks = [slice(start, start + block_size) for start in range(0, n_rows, block_size)]
+    written = []
+
+    def create(name, dtype):
+        path = os.path.join(store_dir, name + ".tmp")
+        written.append(path)
+        return np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=(n_rows, dim))
+
+    f32 = create("float32.npy", np.float32)
+    absmax = np.zeros(dim, dtype=np.float32)
+    for block in blocks:
+        normalized = normalize_rows(vectors[block])
+        f32[block] = normalized
+        absmax = np.maximum(absmax, np.abs(normalized).max(axis=0))
+
+    if "float16" in precisions:
+        f16 = create("float16.npy", np.float16)
+        for block in blocks:
+            f16[block] = f32[block].astype(np.float16)
+        f16.flush()
+    if "int8" in precisions:
+        # Symmetric per-dimension scale: x ≈ codes * scale
+        scale = absmax / 127.0
+        scale[scale == 0] = 1.0
+        codes = create("int8.npy", np.int8)
+        for block in blocks:
+            codes[block] = np.clip(np.rint(f32[block] / scale), -127, 127).astype(np.int8)
+        codes.flush()
+        np.save(os.path.join(store_dir, "int8_scale.npy"), scale.astype(np.float32))
+    f32.flush()
+
+    for path in written:
+        os.replace(path, path[:-len(".tmp")])
+
+
+class QuantizedMatrix:
+    """Read-only low-precision trial matrix that scores queries block by block.
+
+    Numpy has no fast float16/int8 matmul, so each block is widened to float32
+    before the BLAS call. Working memory stays at one block, not the full matrix.
+    """
+
+    def __init__(self, codes, scale=None, block_size=4096):
+        self.codes = codes
+        self.scale = scale
+        self.block_size = block_size
+
+    def __len__(self):
+        return len(self.codes)
+
+    @property
+    def dtype(self):
+        return self.codes.dtype
+
+    def dot(self, q):
+        # Folding the int8 scale into the query keeps the blocks scale-free
+        q = q * self.scale if self.scale is not None else q
+        scores = np.empty(len(self.codes), dtype=np.float32)
+        for start in range(0, len(self.codes), self.block_size):
+            block = np.asarray(self.codes[start:start + self.block_size], dtype=np.float32)
+            scores[start:start + len(block)] = block @ q
+        return scores
+
+
+class QuantizedIndex:
+    """Brute-force search over a QuantizedMatrix with exact float32 re-ranking."""
+
+    is_exact = True  # scores every row, if only at low precision first
+
+    def __init__(self, vectors, coarse, rerank_factor=4):
+        self.vectors = vectors
+        self.coarse = coarse
+        self.rerank_factor = rerank_factor
+
+    @property
+    def kind(self):
+        return f"exact-{self.coarse.dtype}"
+
+    def __len__(self):
+        return len(self.coarse)
+
+    def search(self, query_vec, k, mask=None):
+        if len(self.coarse) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        q = normalize_vector(query_vec)
+        approx = self.coarse.dot(q)
+        n_candidates = len(approx)
+        if mask is not None:
+            approx = np.where(mask[:len(approx)], approx, -np.inf)
+            n_candidates = int(np.count_nonzero(mask[:len(approx)]))
+
+        shortlist = np.sort(top_k(approx, min(k * self.rerank_factor, n_candidates)))
+        sims = np.asarray(self.vectors[shortlist], dtype=np.float32) @ q
+        top = top_k(sims, k)
+        return shortlist[top], sims[top]
+
+
+class EmbeddingStore:
+    def __init__(self, vectors, coarse=None):
+        self.vectors = vectors
+        self.coarse = coarse
+
+    def __len__(self):
+        return len(self.vectors)
+
+    @staticmethod
+    def exists(store_dir):
+        return os.path.exists(os.path.join(store_dir, "float32.npy"))
+
+    @classmethod
+    def open(cls, store_dir, precision="int8"):
+        """Memory-maps the store; precision picks the matrix used for full scans."""
+        if precision not in PRECISIONS:
+            raise ValueError(f"Unknown embedding precision {precision!r}, expected one of {PRECISIONS}")
+        vectors = np.load(os.path.join(store_dir, "float32.npy"), mmap_mode="r")
+        coarse = None
+        codes_path = os.path.join(store_dir, f"{precision}.npy")
+        if precision != "float32":
+            if os.path.exists(codes_path):
+                codes = np.load(codes_path, mmap_mode="r")
+                scale = np.load(os.path.join(store_dir, "int8_scale.npy")) if precision == "int8" else None
+                if len(codes) == len(vectors):
+                    coarse = QuantizedMatrix(codes, scale)
+                else:
+                    print(f"[STORE] {codes_path} has {len(codes)} rows, float32.npy has {len(vectors)}. "
+                          "Using float32 for search.")
+            else:
+                print(f"[STORE] {codes_path} not found. Using float32 for search.")
+        return cls(vectors, coarse)
+
+
+if __name__ == "__main__":
+    # Convert existing embeddings without re-encoding: python embedding_store.py
+    data_dir = os.path.join(os.path.dirname(__file__), 'data')
+    store_dir = os.path.join(data_dir, STORE_DIR_NAME)
+    vectors = np.load(os.path.join(data_dir, 'trial_embeddings.npy'))
+    write_embedding_store(vectors, store_dir)
+    print(f"Embedding store for {len(vectors)} trials written to {store_dir}.")
@@ -0,0 +1,99 @@
+import re
+import numpy as np
+
+# ── Facet bitsets for filtered trial search ─────────────────────────────────
+# Built once at startup from the ALL_TRIALS catalog columns. Every (facet, value) pair gets a
+# packed bitset with one bit per trial row, so a filter such as
+# "ADULT, RECRUITING, PHASE2" is a couple of byte-wise ANDs followed by one
+# unpack into a boolean row mask that the vector index applies before top-k.
+
+AGE_GROUPS = ("CHILD", "ADULT", "OLDER_ADULT")
+ACTIVE_STATUSES = ("RECRUITING", "NOT_YET_RECRUITING")
+
+# Catalog field for each facet
+FACET_FIELDS = {
+    "status":          "status",
+    "phase":           "phase",
+    "study_type":      "study_type",
+    "primary_purpose": "primary_purpose",
+}
+
+_SPLIT = re.compile(r"[|,]")
+
+
+def _split_values(raw):
+    return {v.strip() for v in _SPLIT.split(raw or "") if v.strip()}
+
+
+def age_group_for(age):
+    """Age group facet value for a patient's age, or "" when the age is unknown."""
+    age = str(age or "").strip()
+    if not age.isdigit():
+        return ""
+    age = int(age)
+    if age < 18:
+        return "CHILD"
+    if age >= 65:
+        return "OLDER_ADULT"
+    return "ADULT"
+
+
+def _age_groups(eligibility):
+    # Trials without an age restriction stay visible to every age group,
+    # same as the old per-row `age_group not in eligibility` check.
+    return {group for group in AGE_GROUPS if not eligibility or group in eligibility}
+
+
+def _value_masks(column, values_of):
+    """Boolean row mask per facet value, computed once per distinct raw string."""
+    codes = {}
+    inverse = np.fromiter((codes.setdefault(raw, len(codes)) for raw in column), dtype=np.int64, count=len(column))
+    distinct = list(codes)
+    lookups = {}
+    for j, raw in enumerate(distinct):
+        for value in values_of(raw):
+            lookups.setdefault(value, np.zeros(len(distinct), dtype=bool))[j] = True
+    return {value: lookup[inverse] for value, lookup in lookups.items()}
+
+
+class FacetIndex:
+    def __init__(self, catalog):
+        self.n_rows = len(catalog)
+        self._bitsets = {}
+
+        for group, bits in _value_masks(catalog.column("eligibility"), _age_groups).items():
+            self._bitsets[("age_group", group)] = np.packbits(bits)
+        for facet, field in FACET_FIELDS.items():
+            for value, bits in _value_masks(catalog.column(field), _split_values).items():
+                self._bitsets[(facet, value)] = np.packbits(bits)
+
+    def values(self, facet):
+        return sorted(value for f, value in self._bitsets if f == facet)
+
+    def _facet_bits(self, facet, wanted):
+        if isinstance(wanted, str):
+            wanted = (wanted,)
+        combined = np.zeros((self.n_rows + 7) // 8, dtype=np.uint8)
+        for value in wanted:
+            bits = self._bitsets.get((facet, value))
+            if bits is not None:
+                combined |= bits
+        return combined
+
+    def mask(self, **filters):
+        """Returns a boolean row mask for the given facet filters, or None.
+
+        Each keyword is a facet name (age_group, status, phase, study_type,
+        primary_purpose) mapped to one value or a collection of values. Values
+        of one facet are OR-ed together, different facets are AND-ed. Empty
+        filters are ignored; None means "no filtering".
+        """
+        combined = None
+        for facet, wanted in filters.items():
+            if not wanted:
+                continue
+            bits = self._facet_bits(facet, wanted)
+            combined = bits if combined is None else combined & bits
+        if combined is None:
+            return None
+        return np.unpackbits(combined, count=self.n_rows).astype(bool)
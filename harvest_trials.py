@@ -0,0 +1,116 @@
+import os
+import time
+import random
+import argparse
+import http.client
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from catalog import load_catalog
+from http_client import HTTPClient, HTTPStatusError, RateLimiter
+from trial_api import DEFAULT_BASE_URL, TrialApiStore, fetch_study
+
+# ── Bulk clinicaltrials.gov harvester ───────────────────────────────────────
+# Looks up every trial title in the catalog with the same query app.py uses
+# and stores the results in data/trial_api.db, which app.py reads directly.
+#
+#   python harvest_trials.py [--workers 8] [--rate 8] [--base-url URL]
+#
+# Lookups run on a thread pool with at most 2 * workers in flight, spaced by a
+# shared rate limiter. Failed requests are retried with exponential backoff
+# and jitter (honouring Retry-After on 429/503). Results are committed every
+# --batch titles, and titles already in the store are skipped, so an
+# interrupted run resumes where it stopped. Titles that still fail after all
+# retries are left out and picked up by the next run.
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+STORE_PATH = os.path.join(DATA_DIR, 'trial_api.db')
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+def fetch_with_retry(title, client, base_url, limiter, retries=4, backoff=1.0, timeout=15):
+    """fetch_study() with rate limiting and retries; raises after the last attempt."""
+    for attempt in range(retries + 1):
+        limiter.wait()
+        try:
+            return fetch_study(title, client, base_url=base_url, timeout=timeout)
+        except HTTPStatusError as e:
+            if e.code not in RETRY_STATUSES or attempt == retries:
+                raise
+            retry_after = e.headers.get("Retry-After", "")
+            delay = float(retry_after) if retry_after.isdigit() else backoff * 2 ** attempt
+        except (OSError, http.client.HTTPException):
+            if attempt == retries:
+                raise
+            delay = backoff * 2 ** attempt
+        time.sleep(delay * random.uniform(0.5, 1.5))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Prefetch clinicaltrials.gov data for every catalog trial.")
+    parser.add_argument("--base-url", default=os.getenv("CLINICALTRIALS_API_URL", DEFAULT_BASE_URL),
+                        help=f"API root (default: {DEFAULT_BASE_URL})")
+    parser.add_argument("--store", default=STORE_PATH, help=f"output database (default: {STORE_PATH})")
+    parser.add_argument("--workers", type=int, default=8, help="concurrent requests (default: 8)")
+    parser.add_argument("--rate", type=float, default=8.0, help="max requests per second (default: 8, 0 = unlimited)")
+    parser.add_argument("--retries", type=int, default=4, help="retries per title (default: 4)")
+    parser.add_argument("--batch", type=int, default=200, help="titles per checkpoint commit (default: 200)")
+    parser.add_argument("--max-age-days", type=float, default=30.0,
+                        help="re-fetch titles harvested longer ago than this (default: 30)")
+    parser.add_argument("--limit", type=int, default=0, help="harvest only the first N titles (0 = all)")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    catalog = load_catalog(os.path.join(DATA_DIR, 'trials.snapshot'), os.path.join(base_dir, 'trials.csv'))
+
+    store = TrialApiStore(args.store)
+    store.create()
+    done = store.harvested_since(time.time() - args.max_age_days * 86400)
+    titles = [t for t in dict.fromkeys(catalog.column("title")) if t not in done]
+    if args.limit:
+        titles = titles[:args.limit]
+    print(f"{len(done)} titles already harvested, {len(titles)} to fetch from {args.base_url}")
+
+    limiter = RateLimiter(args.rate)
+    # Keep-alive connections only; retries and backoff are handled above
+    client = HTTPClient(retries=0, pool_size=args.workers, failure_threshold=args.workers * 4)
+    pending, failed = [], 0
+    fetched = 0
+    started = time.time()
+
+    def checkpoint():
+        nonlocal pending
+        if pending:
+            store.put_many(pending)
+            pending = []
+        rate = fetched / max(time.time() - started, 1e-9)
+        print(f"  {fetched}/{len(titles)} titles ({failed} failed, {rate:.1f}/s)")
+
+    with ThreadPoolExecutor(args.workers) as pool:
+        in_flight = deque()
+
+        def collect(title, future):
+            nonlocal fetched, failed
+            try:
+                pending.append((title, future.result()))
+                fetched += 1
+            except Exception as e:
+                failed += 1
+                print(f"[HARVEST ERROR] {title!r}: {e}")
+            if len(pending) >= args.batch:
+                checkpoint()
+
+        for title in titles:
+            in_flight.append((title, pool.submit(fetch_with_retry, title, client, args.base_url, limiter, args.retries)))
+            if len(in_flight) >= 2 * args.workers:
+                collect(*in_flight.popleft())
+        while in_flight:
+            collect(*in_flight.popleft())
+    checkpoint()
+    print(f"Done. Harvested data is in {args.store}." + (" Re-run to retry failed titles." if failed else ""))
+
+
+if __name__ == "__main__":
+    main()
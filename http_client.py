@@ -0,0 +1,345 @@
+import http.client
+import json
+import queue
+import random
+import select
+import ssl
+import threading
+import time
+import urllib.parse
+from per_process import PerProcess
+
+# ── Outbound HTTP client ────────────────────────────────────────────────────
+# One HTTPClient is shared by every outbound call in app.py (Cohere and
+# clinicaltrials.gov). Per host it keeps:
+#
+#   a pool of idle keep-alive connections, so repeat calls skip the TCP and
+#     TLS handshakes (the SSL context is created once per client);
+#   a circuit breaker that, after `failure_threshold` consecutive failed
+#     calls (a call counts once, however many attempts it made), fails
+#     calls immediately for `reset_timeout` seconds and then lets a single
+#     trial call through.
+#
+# `timeout` is one deadline for a whole call, retries included; socket
+# timeouts are set to whatever is left of it. Only requests the server cannot
+# have acted on are retried: failures to connect and 429/502/503/504 answers,
+# with jittered exponential backoff while the deadline allows. An error after
+# the request went out (a read timeout, a dropped response) is raised, never
+# resent. Only idempotent methods get `retries` by default; a POST is sent
+# once unless the caller passes retries. Idle connections the server has
+# already closed are dropped before use; if one still fails as stale, it is
+# replaced and the request resent at once, but only when resending is
+# allowed (an idempotent method or retries > 0).
+# Errors are raised as HTTPStatusError (status >= 400), CircuitOpenError, or
+# the underlying OSError / http.client.HTTPException. stream() hands out a
+# response body line by line for streaming APIs (Cohere chat with stream=True).
+
+RETRY_STATUSES = (429, 502, 503, 504)
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE")
+# What a keep-alive connection the server already closed fails with
+STALE_CONNECTION_ERRORS = (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError)
+
+
+class RateLimiter:
+    """Spaces calls at least 1/rate seconds apart across all threads."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class HTTPStatusError(Exception):
+    def __init__(self, url, code, headers, body):
+        super().__init__(f"HTTP {code} from {url}")
+        self.url = url
+        self.code = code
+        self.headers = headers
+        self.body = body
+
+    def read(self):
+        return self.body
+
+
+class CircuitOpenError(ConnectionError):
+    """Raised without calling the host while its circuit breaker is open."""
+
+
+class HTTPResponse:
+    __slots__ = ("status", "headers", "body")
+
+    def __init__(self, status, headers, body):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    def json(self):
+        return json.loads(self.body.decode("utf-8"))
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        return "half-open" if time.monotonic() - self.opened_at >= self.reset_timeout else "open"
+
+    def allow(self):
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half-open" and not self._trial_running:
+                self._trial_running = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_running = False
+            if self.failures >= self.failure_threshold or self.opened_at is not None:
+                self.opened_at = time.monotonic()
+
+
+def is_dropped(conn):
+    """Whether an idle connection is unusable: closed, or readable (the server hung up)."""
+    if conn.sock is None:
+        return True
+    try:
+        return bool(select.select([conn.sock], [], [], 0)[0])
+    except (OSError, ValueError):
+        return True
+
+
+class ConnectionPool:
+    """Idle keep-alive connections to one scheme://host:port."""
+
+    def __init__(self, scheme, host, port, ssl_context, maxsize=10):
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.ssl_context = ssl_context
+        self._idle = queue.LifoQueue(maxsize)
+        self.created = 0
+        self.reused = 0
+
+    def get(self, timeout):
+        """Returns (connection, reused)."""
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            if is_dropped(conn):
+                conn.close()
+                continue
+            conn.sock.settimeout(timeout)
+            self.reused += 1
+            return conn, True
+        self.created += 1
+        if self.scheme == "https":
+            return http.client.HTTPSConnection(self.host, self.port, timeout=timeout, context=self.ssl_context), False
+        return http.client.HTTPConnection(self.host, self.port, timeout=timeout), False
+
+    def put(self, conn):
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+
+class HTTPClient:
+    def __init__(self, timeout=15.0, retries=2, backoff=0.5, pool_size=10,
+                 failure_threshold=5, reset_timeout=30.0):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.pool_size = pool_size
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.ssl_context = ssl.create_default_context()
+        self.retried = 0
+        # Sockets inherited across a fork must not be shared with the parent
+        self._pools = PerProcess(dict)
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def _host_state(self, scheme, host, port):
+        pools = self._pools.get()
+        with self._lock:
+            key = (scheme, host, port)
+            if key not in pools:
+                pools[key] = ConnectionPool(scheme, host, port, self.ssl_context, self.pool_size)
+            if host not in self._breakers:
+                self._breakers[host] = CircuitBreaker(self.failure_threshold, self.reset_timeout)
+            return pools[key], self._breakers[host]
+
+    def _sleep_before_retry(self, attempt, deadline, retry_after=None):
+        """Backs off before the next attempt; False if that would pass the deadline."""
+        delay = float(retry_after) if retry_after and retry_after.isdigit() else self.backoff * 2 ** attempt
+        delay *= random.uniform(0.5, 1.5)
+        if time.monotonic() + delay >= deadline:
+            return False
+        self.retried += 1
+        time.sleep(delay)
+        return True
+
+    @staticmethod
+    def _remaining(deadline, url):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError(f"timed out calling {url}")
+        return remaining
+
+    def _release(self, pool, conn, resp):
+        if resp.will_close:
+            conn.close()
+        else:
+            pool.put(conn)
+
+    def _send(self, method, url, body, headers, timeout, retries, stream):
+        """Sends a request with retries; returns (pool, conn, resp, body).
+
+        `timeout` is one deadline for the whole call, retries and backoff
+        included. With stream=True a successful response is returned with its
+        body unread (body is None) and conn still checked out of the pool.
+        """
+        parts = urllib.parse.urlsplit(url)
+        scheme = parts.scheme or "http"
+        port = parts.port or (443 if scheme == "https" else 80)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        deadline = time.monotonic() + (self.timeout if timeout is None else timeout)
+        if retries is None:
+            retries = self.retries if method in IDEMPOTENT_METHODS else 0
+        pool, breaker = self._host_state(scheme, parts.hostname, port)
+
+        # Whether a stale connection may be replaced by resending the request
+        may_resend = method in IDEMPOTENT_METHODS or retries > 0
+
+        if not breaker.allow():
+            raise CircuitOpenError(f"circuit open for {parts.hostname}; not calling {url}")
+        # One outcome per call, recorded however it ends, so retries do not
+        # count as extra failures and a half-open trial call always finishes
+        succeeded = False
+        try:
+            attempt = 0
+            while True:
+                conn, reused = pool.get(self._remaining(deadline, url))
+                if conn.sock is None:
+                    try:
+                        conn.connect()
+                    except OSError:
+                        # Nothing was sent, so trying again is safe
+                        conn.close()
+                        if attempt >= retries or not self._sleep_before_retry(attempt, deadline):
+                            raise
+                        attempt += 1
+                        continue
+                try:
+                    conn.request(method, path, body=body, headers=headers or {})
+                    conn.sock.settimeout(self._remaining(deadline, url))
+                    resp = conn.getresponse()
+                    if not (stream and resp.status < 400):
+                        if conn.sock is not None:
+                            conn.sock.settimeout(self._remaining(deadline, url))
+                        data = resp.read()
+                    else:
+                        data = None
+                except (OSError, http.client.HTTPException) as e:
+                    conn.close()
+                    if reused and may_resend and isinstance(e, STALE_CONNECTION_ERRORS):
+                        # The server closed this idle connection; try again on a fresh one
+                        continue
+                    # The server may have received the request (or be working on it): never resent
+                    raise
+
+                if data is not None:
+                    self._release(pool, conn, resp)
+
+                if resp.status in RETRY_STATUSES and attempt < retries \
+                        and self._sleep_before_retry(attempt, deadline, resp.headers.get("Retry-After")):
+                    attempt += 1
+                    continue
+                succeeded = resp.status < 500 and resp.status != 429
+                if resp.status >= 400:
+                    raise HTTPStatusError(url, resp.status, resp.headers, data)
+                return pool, conn, resp, data
+        finally:
+            if succeeded:
+                breaker.record_success()
+            else:
+                breaker.record_failure()
+
+    def request(self, method, url, body=None, headers=None, timeout=None, retries=None):
+        _, _, resp, data = self._send(method, url, body, headers, timeout, retries, stream=False)
+        return HTTPResponse(resp.status, resp.headers, data)
+
+    def stream(self, method, url, body=None, headers=None, timeout=None, retries=None):
+        """Yields the response body line by line as it arrives.
+
+        Retries only happen before the first line. `timeout` is the deadline
+        for the response headers; after that it bounds each read, not the
+        whole response. The connection goes back to the pool only if the body
+        is read to the end; closing the generator early drops it.
+        """
+        pool, conn, resp, _ = self._send(method, url, body, headers, timeout, retries, stream=True)
+        if conn.sock is not None:
+            conn.sock.settimeout(self.timeout if timeout is None else timeout)
+        try:
+            while True:
+                line = resp.readline()
+                if not line:
+                    break
+                yield line
+        except BaseException:
+            conn.close()
+            raise
+        self._release(pool, conn, resp)
+
+    def get_json(self, url, headers=None, **kwargs):
+        return self.request("GET", url, headers={"Accept": "application/json", **(headers or {})}, **kwargs).json()
+
+    def post_json(self, url, payload, headers=None, **kwargs):
+        body = payload if isinstance(payload, bytes) else json.dumps(payload).encode("utf-8")
+        return self.request("POST", url, body=body,
+                            headers={"Content-Type": "application/json", **(headers or {})}, **kwargs).json()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "retried": self.retried,
+                "hosts": {
+                    f"{scheme}://{host}:{port}": {
+                        "connections_created": pool.created,
+                        "connections_reused": pool.reused,
+                        "idle": pool._idle.qsize(),
+                        "breaker": self._breakers[host].state,
+                    }
+                    for (scheme, host, port), pool in self._pools.get().items()
+                },
+            }
@@ -0,0 +1,214 @@
+import argparse
+import os
+import sqlite3
+import sys
+
+# ── Schema migrations for database.db ───────────────────────────────────────
+# MIGRATIONS run once each, in order, every one in its own transaction;
+# PRAGMA user_version holds the number of the last one applied. To change the
+# schema, append a migration; never edit one that has already shipped.
+#
+# Migration 1 is the schema as it was before versioning. Databases from that
+# time have user_version 0 but may already contain any part of it, so it only
+# creates what is missing.
+#
+#   python migrations.py [--db PATH]     migrate a database (default: data/database.db)
+#   python migrations.py --check         show and verify the hot queries' plans
+
+
+def _add_missing_columns(conn, table, columns):
+    existing = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+    for name, definition in columns:
+        if name not in existing:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
+
+
+def baseline(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS patients (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        name TEXT,
+                        email TEXT UNIQUE,
+                        condition TEXT,
+                        organization TEXT,
+                        password TEXT
+                    )''')
+    _add_missing_columns(conn, "patients", [("organization", "TEXT"), ("age", "TEXT")])
+    conn.execute('''CREATE TABLE IF NOT EXISTS doctors (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        name TEXT,
+                        email TEXT UNIQUE,
+                        organization TEXT,
+                        password TEXT
+                    )''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS consents (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        patient_name TEXT,
+                        patient_email TEXT,
+                        condition TEXT,
+                        patient_age TEXT,
+                        patient_gender TEXT,
+                        trial_id TEXT,
+                        trial_title TEXT,
+                        decision TEXT,
+                        timestamp TEXT,
+                        enrolled BOOLEAN
+                    )''')
+
+    # Condition embedding per patient (float16 bytes), see patient_matching.py
+    conn.execute('''CREATE TABLE IF NOT EXISTS patient_embeddings (
+                        email TEXT PRIMARY KEY,
+                        condition TEXT,
+                        embedding BLOB
+                    )''')
+
+    # Queued outgoing email, see email_outbox.py
+    conn.execute('''CREATE TABLE IF NOT EXISTS email_outbox (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        to_email TEXT NOT NULL,
+                        subject TEXT NOT NULL,
+                        body TEXT NOT NULL,
+                        status TEXT NOT NULL,
+                        attempts INTEGER NOT NULL DEFAULT 0,
+                        next_attempt_at REAL,
+                        claimed_at REAL,
+                        last_error TEXT,
+                        created_at REAL NOT NULL,
+                        sent_at REAL
+                    )''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_email_outbox_due ON email_outbox (status, next_attempt_at)")
+
+
+def unique_consents(conn):
+    """One consent per patient and trial, so /consent can upsert instead of DELETE + INSERT."""
+    # Keep the latest row of any duplicates, as the old DELETE + INSERT would have
+    deleted = conn.execute('''DELETE FROM consents WHERE id NOT IN (
+                                  SELECT MAX(id) FROM consents GROUP BY patient_email, trial_id
+                              )''').rowcount
+    if deleted:
+        print(f"[DB] Removed {deleted} duplicate consent rows")
+    conn.execute("CREATE UNIQUE INDEX ux_consents_patient_trial ON consents (patient_email, trial_id)")
+
+
+def hot_query_indexes(conn):
+    conn.execute("CREATE INDEX idx_patients_organization ON patients (organization, email)")
+    conn.execute("CREATE INDEX idx_consents_decision ON consents (decision)")
+
+
+def requeue_skipped_email(conn):
+    """Email marked 'skipped' while SMTP was not configured is sent after all."""
+    requeued = conn.execute("""UPDATE email_outbox SET status = 'pending', next_attempt_at = created_at
+                               WHERE status = 'skipped'""").rowcount
+    if requeued:
+        print(f"[DB] Re-queued {requeued} emails skipped while SMTP was not configured")
+
+
+MIGRATIONS = [
+    (1, "baseline schema", baseline),
+    (2, "unique consent per patient and trial", unique_consents),
+    (3, "indexes for the doctor and consent queries", hot_query_indexes),
+    (4, "re-queue email skipped without SMTP settings", requeue_skipped_email),
+]
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn):
+    """Applies pending migrations; returns the versions applied.
+
+    Each one re-reads user_version after taking the write lock, so workers
+    starting at the same time apply every migration exactly once.
+    """
+    if schema_version(conn) >= LATEST_VERSION:
+        return []
+    applied = []
+    for version, name, apply in MIGRATIONS:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if schema_version(conn) >= version:
+                conn.rollback()
+                continue
+            apply(conn)
+            conn.execute(f"PRAGMA user_version = {version}")
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        applied.append(version)
+        print(f"[DB] Applied migration {version}: {name}")
+    return applied
+
+
+# ── Query-plan check ────────────────────────────────────────────────────────
+# The per-request queries on consents and patients with the index each must
+# use; --check fails if SQLite plans a full table scan for any of them.
+
+HOT_QUERIES = [
+    ("consent conflict lookup", "ux_consents_patient_trial",
+     "SELECT id FROM consents WHERE patient_email = ? AND trial_id = ?", ("p@x.com", "1")),
+    ("enroll lookup", "ux_consents_patient_trial",
+     "SELECT * FROM consents WHERE patient_email = ? AND trial_id = ?", ("p@x.com", "1")),
+    ("patient dashboard", "ux_consents_patient_trial",
+     "SELECT * FROM consents WHERE patient_email = ?", ("p@x.com",)),
+    ("accepted count", "idx_consents_decision",
+     "SELECT COUNT(*) FROM consents WHERE decision = 'accepted'", ()),
+    ("organization patients", "idx_patients_organization",
+     "SELECT * FROM patients WHERE organization = ?", ("Org",)),
+    ("organization consents", "idx_patients_organization",
+     '''SELECT c.* FROM consents c JOIN patients p ON c.patient_email = p.email
+        WHERE p.organization = ?''', ("Org",)),
+    ("patient matching", "idx_patients_organization",
+     '''SELECT p.*, e.condition AS embedded_condition, e.embedding
+        FROM patients p LEFT JOIN patient_embeddings e ON e.email = p.email
+        WHERE p.organization = ?''', ("Org",)),
+]
+
+
+def query_plan(conn, sql, params=()):
+    return [row[-1] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params)]
+
+
+def check_query_plans(conn):
+    """(name, plan, problem or None) for every HOT_QUERIES entry."""
+    results = []
+    for name, index, sql, params in HOT_QUERIES:
+        plan = query_plan(conn, sql, params)
+        if not any(index in step for step in plan):
+            problem = f"does not use {index}"
+        elif any(step.startswith("SCAN") and " INDEX " not in step for step in plan):
+            problem = "scans a table"
+        else:
+            problem = None
+        results.append((name, plan, problem))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate database.db or check the hot queries' plans.")
+    parser.add_argument("--db", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'database.db'))
+    parser.add_argument("--check", action="store_true",
+                        help="verify query plans on a freshly migrated in-memory database")
+    args = parser.parse_args()
+
+    if not args.check:
+        conn = sqlite3.connect(args.db, timeout=30)
+        applied = migrate(conn)
+        print(f"{args.db} is at schema version {schema_version(conn)}"
+              + (f" (applied {', '.join(map(str, applied))})" if applied else ""))
+        return
+
+    conn = sqlite3.connect(":memory:")
+    migrate(conn)
+    failed = 0
+    for name, plan, problem in check_query_plans(conn):
+        failed += problem is not None
+        print(f"{'FAIL' if problem else 'ok':>4}  {name}" + (f": {problem}" if problem else ""))
+        for step in plan:
+            print(f"        {step}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+import threading
+import numpy as np
+from cache import LRUCache
+from facets import age_group_for
+
+# ── Patient × trial match matrix ────────────────────────────────────────────
+# The doctor dashboard shows the best trials for every patient of the doctor's
+# organization. Instead of one /patient-style search per patient, the patients
+# are grouped by age group, their conditions are embedded in one batch, and each
+# group is scored against the full trial matrix with one blockwise GEMM (see
+# TrialSearchEngine.search_batch).
+#
+# Results are cached per organization together with the (condition, age group)
+# they were computed from. Every dashboard load diffs the current patient rows
+# against that: only new or changed patients are re-scored, and removed ones are
+# dropped. Signup and condition changes update the cache eagerly through
+# update_patient, so the next dashboard load usually has nothing left to do.
+# At most `max_organizations` organizations are kept, least recently used
+# first out.
+
+
+def patient_query(patient):
+    """Text embedded for a patient row: the condition, as on /patient."""
+    return (patient.get("condition") or "").strip().lower()
+
+
+class PatientMatcher:
+    def __init__(self, engine, facets, embed_many, k=10, min_score=0.01, max_organizations=256):
+        self.engine = engine
+        self.facets = facets
+        self.embed_many = embed_many
+        self.k = k
+        self.min_score = min_score
+        self.rescored = 0
+        self._orgs = LRUCache(maxsize=max_organizations)
+        self._lock = threading.Lock()
+
+    def _score(self, patients):
+        """{email: (trial rows, scores)} for patients given as (email, query, age group)."""
+        matches = {}
+        by_group = {}
+        for email, query, age_group in patients:
+            if query:
+                by_group.setdefault(age_group, []).append((email, query))
+            else:
+                matches[email] = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32))
+        for age_group, members in by_group.items():
+            query_vecs = self.embed_many([query for _, query in members])
+            rows, scores = self.engine.search_batch(query_vecs, self.k, exact=True,
+                                                    mask=self.facets.mask(age_group=age_group))
+            for (email, _), r, s in zip(members, rows, scores):
+                keep = s > self.min_score
+                matches[email] = (r[keep], s[keep])
+        self.rescored += len(patients)
+        return matches
+
+    def for_organization(self, organization, patients):
+        """Top-k (trial rows, scores) per patient email for an organization's patient rows."""
+        wanted = {p["email"]: (patient_query(p), age_group_for(p.get("age"))) for p in patients}
+        with self._lock:
+            cached = self._orgs.get(organization, {})
+            stale = [(email, *key) for email, key in wanted.items()
+                     if email not in cached or cached[email][0] != key]
+        scored = self._score(stale) if stale and len(self.engine) else {}
+        with self._lock:
+            # Patients no longer in the org are dropped
+            entries = {email: entry for email, entry in self._orgs.get(organization, {}).items() if email in wanted}
+            for email, query, age_group in stale:
+                if email in scored:
+                    entries[email] = ((query, age_group), scored[email])
+            self._orgs.put(organization, entries)
+            return {email: entries[email][1] for email in wanted if email in entries}
+
+    def update_patient(self, organization, patient):
+        """Re-scores one patient after signup or a condition change, if the org is cached."""
+        with self._lock:
+            if self._orgs.get(organization) is None:
+                return
+        email, key = patient["email"], (patient_query(patient), age_group_for(patient.get("age")))
+        scored = self._score([(email, *key)]) if len(self.engine) else {}
+        with self._lock:
+            entries = self._orgs.get(organization)
+            if entries is not None and email in scored:
+                entries[email] = (key, scored[email])
+
+    def stats(self):
+        with self._lock:
+            return {
+                "organizations": len(self._orgs),
+                "patients": sum(len(entries) for entries in self._orgs.values()),
+                "max_organizations": self._orgs.maxsize,
+                "rescored": self.rescored,
+            }
+
+
+# ── Reverse matching: trial → patients ──────────────────────────────────────
+# Each patient's condition embedding is stored next to the patients table in
+# patient_embeddings, as float16 bytes (768 bytes for 384 dimensions) tagged
+# with the condition text it was computed from. It is written at signup and
+# whenever /patient changes the condition. Finding the best patients of an
+# organization for a trial is then one query for the org's blobs plus one
+# matrix-vector product. Rows that are missing or whose condition changed
+# since (e.g. patients created before this table existed) are re-embedded in
+# one batch on first use.
+
+EMBEDDING_DTYPE = np.float16
+
+
+class PatientEmbeddings:
+    def __init__(self, get_connection, embed_many):
+        self.get_connection = get_connection
+        self.embed_many = embed_many
+
+    def _store(self, conn, rows):
+        """Embeds and upserts (email, query) pairs."""
+        vectors = self.embed_many([query for _, query in rows]).astype(EMBEDDING_DTYPE)
+        conn.executemany('''INSERT INTO patient_embeddings (email, condition, embedding) VALUES (?, ?, ?)
+                            ON CONFLICT(email) DO UPDATE SET condition = excluded.condition,
+                                                             embedding = excluded.embedding''',
+                         [(email, query, vector.tobytes()) for (email, query), vector in zip(rows, vectors)])
+        conn.commit()
+        return vectors
+
+    def update(self, email, condition):
+        """Stores the embedding for a patient's (new) condition."""
+        query = patient_query({"condition": condition})
+        conn = self.get_connection()
+        try:
+            if query:
+                self._store(conn, [(email, query)])
+            else:
+                conn.execute("DELETE FROM patient_embeddings WHERE email = ?", (email,))
+                conn.commit()
+        finally:
+            conn.close()
+
+    def top_patients(self, organization, trial_vec, k):
+        """Best-matching patients of an organization as [(patient row, score)], best first."""
+        conn = self.get_connection()
+        try:
+            rows = conn.execute('''SELECT p.*, e.condition AS embedded_condition, e.embedding
+                                   FROM patients p LEFT JOIN patient_embeddings e ON e.email = p.email
+                                   WHERE p.organization = ?''', (organization,)).fetchall()
+            patients, blobs, stale = [], [], []
+            for row in map(dict, rows):
+                blob, embedded_condition = row.pop("embedding"), row.pop("embedded_condition")
+                query = patient_query(row)
+                if not query:
+                    continue
+                patients.append(row)
+                if blob is None or embedded_condition != query:
+                    stale.append((len(blobs), row["email"], query))
+                blobs.append(blob)
+            if not patients:
+                return []
+            if stale:
+                vectors = self._store(conn, [(email, query) for _, email, query in stale])
+                for (i, _, _), vector in zip(stale, vectors):
+                    blobs[i] = vector.tobytes()
+        finally:
+            conn.close()
+
+        matrix = np.frombuffer(b"".join(blobs), dtype=EMBEDDING_DTYPE).reshape(len(blobs), -1).astype(np.float32)
+        q = np.asarray(trial_vec, dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1) * (np.linalg.norm(q) or 1.0)
+        scores = (matrix @ q) / np.where(norms == 0, 1.0, norms)
+        order = np.argsort(-scores)[:max(k, 0)]
+        return [(patients[i], float(scores[i])) for i in order]
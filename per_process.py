@@ -0,0 +1,58 @@
+import os
+import threading
+
+# ── Per-process threads, pools and connections ──────────────────────────────
+# gunicorn imports app.py once and then forks its workers. Threads, and so
+# thread pools, do not survive a fork: a child inherits the parent's Thread
+# objects and executors, but nothing runs them. Open sockets and SQLite
+# connections do survive, and must not be used by both processes. PerProcess
+# creates its value lazily, on first use in each process, and again in a
+# child after a fork; ThreadConnection builds a connection per thread on it.
+
+
+class PerProcess:
+    """factory()'s result, created once per process.
+
+    `alive(value)`, if given, is checked on every get(); a value that fails
+    it (e.g. a worker thread that died) is replaced as well.
+    """
+
+    def __init__(self, factory, alive=None):
+        self.factory = factory
+        self.alive = alive
+        self._current = (None, None)  # (pid, value), swapped as one tuple
+        self._lock = threading.Lock()
+
+    def _valid(self, pid, value):
+        return pid == os.getpid() and (self.alive is None or self.alive(value))
+
+    def get(self):
+        pid, value = self._current
+        if self._valid(pid, value):
+            return value
+        with self._lock:
+            pid, value = self._current
+            if not self._valid(pid, value):
+                value = self.factory()
+                self._current = (os.getpid(), value)
+            return value
+
+    def peek(self):
+        """This process's value, or None if get() has not created it yet."""
+        pid, value = self._current
+        return value if pid == os.getpid() else None
+
+
+class ThreadConnection:
+    """One connection per thread and process, opened by connect() on first use."""
+
+    def __init__(self, connect):
+        self.connect = connect
+        self._local = PerProcess(threading.local)
+
+    def get(self):
+        local = self._local.get()
+        conn = getattr(local, "conn", None)
+        if conn is None:
+            conn = local.conn = self.connect()
+        return conn
@@ -1,47 +1,274 @@
 import os
 import csv
+import shutil
+import argparse
+import hashlib
+import multiprocessing
+from array import array
+from collections import deque
 import numpy as np
 from sentence_transformers import SentenceTransformer
+from vector_index import build_ivf_index, save_ivf_index
+from embedding_store import write_embedding_store, STORE_DIR_NAME
 
-def load_trials_for_encoding():
-    trials = []
+MODEL_NAME = 'all-MiniLM-L6-v2'
+EMBEDDING_DIM = 384
+
+DATA_DIR = 'data'
+EMBEDDINGS_PATH = os.path.join(DATA_DIR, 'trial_embeddings.npy')
+# Per-row trial id + SHA-1 of the exact text that was embedded for it
+MANIFEST_PATH = os.path.join(DATA_DIR, 'trial_embeddings_manifest.npz')
+STORE_DIR = os.path.join(DATA_DIR, STORE_DIR_NAME)
+IVF_INDEX_PATH = os.path.join(DATA_DIR, 'trial_index_ivf.npz')
+# Finished shards are checkpointed here until they are merged
+SHARD_DIR = os.path.join(DATA_DIR, 'embedding_shards')
+# Rows copied per step when carrying unchanged vectors over
+CHUNK_ROWS = 8192
+
+# ── Streaming input ─────────────────────────────────────────────────────────
+# trials.csv is read lazily, twice: one pass to hash every row and one pass to
+# collect the texts that actually need encoding, a shard at a time. Nothing
+# proportional to the catalog is held in memory except the 20-byte hash and
+# the trial id of each row; vectors go straight into a preallocated .npy memmap.
+
+def iter_trials_for_encoding(limit=None):
+    """Yields (trial id, embedding text) per CSV row, in file order."""
     csv_path = os.path.join(os.path.dirname(__file__), 'trials.csv')
     with open(csv_path, newline='', encoding='utf-8') as f:
         reader = csv.DictReader(f)
         for i, row in enumerate(reader):
-            trials.append({
+            if limit and i >= limit:
+                break
+            yield i + 1, trial_text({
                 "title":        row.get("Brief Title") or "",
                 "condition":    row.get("Conditions") or "",
                 "description":  row.get("Intervention Description") or "",
             })
-    return trials
-
-print("Loading trials...")
-ALL_TRIALS = load_trials_for_encoding()
-MATCHING_SAMPLE_SIZE = 50000 
-matching_trials = ALL_TRIALS[:MATCHING_SAMPLE_SIZE]
 
-# Build the text strings exactly how app.py does it
-trial_texts = [
-    " ".join(filter(None, [
+def trial_text(t):
+    return " ".join(filter(None, [
         str(t.get("title", "")),
         str(t.get("condition", "")),
         str(t.get("description", "")),
     ]))
-    for t in matching_trials
-]
 
-print("Loading SentenceTransformer model...")
-model = SentenceTransformer('all-MiniLM-L6-v2')
+def content_hash(text):
+    return hashlib.sha1(text.encode('utf-8')).digest()
+
+def scan_trials(limit):
+    """First pass over the CSV: returns (trial ids, content hashes) arrays."""
+    ids = array('q')
+    hashes = bytearray()
+    for trial_id, text in iter_trials_for_encoding(limit):
+        ids.append(trial_id)
+        hashes += content_hash(text)
+    return np.frombuffer(ids, dtype=np.int64), np.frombuffer(bytes(hashes), dtype='S20')
+
+def load_previous_embeddings():
+    """Returns (content hashes, vectors memmap) from the last run, or (None, None)."""
+    if not (os.path.exists(MANIFEST_PATH) and os.path.exists(EMBEDDINGS_PATH)):
+        return None, None
+    with np.load(MANIFEST_PATH) as manifest:
+        hashes = manifest["hashes"]
+        model_name = str(manifest["model"])
+    vectors = np.load(EMBEDDINGS_PATH, mmap_mode='r')
+    if model_name != MODEL_NAME or len(hashes) != len(vectors):
+        print("Previous embeddings do not match the manifest or model; re-encoding everything.")
+        return None, None
+    return hashes, vectors
+
+def match_previous(hashes, previous_hashes):
+    """Row in the previous embeddings with the same content hash, or -1, per row."""
+    if previous_hashes is None or len(previous_hashes) == 0:
+        return np.full(len(hashes), -1, dtype=np.int64)
+    order = np.argsort(previous_hashes)
+    ordered = previous_hashes[order]
+    pos = np.minimum(np.searchsorted(ordered, hashes), len(ordered) - 1)
+    return np.where(ordered[pos] == hashes, order[pos], -1)
+
+# ── Sharded encoding ────────────────────────────────────────────────────────
+# The texts to encode are cut into fixed-size shards. Each shard is named after
+# the content hashes it covers and saved to SHARD_DIR as soon as it is done, so
+# a crashed or interrupted run picks up where it stopped: shards whose file
+# already exists are not encoded again.
+
+_worker_model = None
+
+def _init_worker(threads):
+    global _worker_model
+    import torch
+    torch.set_num_threads(threads)
+    _worker_model = SentenceTransformer(MODEL_NAME)
+
+def _encode_shard(task):
+    shard_path, texts = task
+    vectors = _worker_model.encode(texts, batch_size=32, show_progress_bar=False)
+    np.save(shard_path + '.tmp.npy', np.asarray(vectors, dtype=np.float32))
+    os.replace(shard_path + '.tmp.npy', shard_path)
+    return shard_path
+
+def shard_path(hashes, rows):
+    name = hashlib.sha1(b"".join(hashes[rows].tolist())).hexdigest()
+    return os.path.join(SHARD_DIR, f"{name}.npy")
+
+def iter_shards(limit, needs_encoding, hashes, shard_size):
+    """Second pass over the CSV: yields (rows, checkpoint path, texts) per shard."""
+    rows, texts = [], []
+    for row, (_, text) in enumerate(iter_trials_for_encoding(limit)):
+        if needs_encoding[row]:
+            rows.append(row)
+            texts.append(text)
+        if len(rows) == shard_size:
+            yield np.array(rows), shard_path(hashes, rows), texts
+            rows, texts = [], []
+    if rows:
+        yield np.array(rows), shard_path(hashes, rows), texts
+
+def encode_into(out, shards, workers, threads):
+    """Encodes shards on a worker pool and writes each one into `out` as it finishes."""
+    os.makedirs(SHARD_DIR, exist_ok=True)
+    pool = None
+    in_flight = deque()
+    # Only a couple of shards per worker are queued at a time, so the CSV is
+    # never read further ahead than that
+    max_in_flight = 2 * workers
+    resumed = encoded = 0
+
+    def store(rows, path):
+        nonlocal encoded
+        out[rows] = np.load(path)
+        encoded += 1
+        print(f"  shard {encoded} encoded and checkpointed ({len(rows)} trials)")
+
+    for rows, path, texts in shards:
+        if os.path.exists(path):
+            out[rows] = np.load(path)
+            resumed += 1
+        elif workers == 1:
+            if _worker_model is None:
+                _init_worker(threads)
+            store(rows, _encode_shard((path, texts)))
+        else:
+            if pool is None:
+                # spawn: every worker gets a fresh interpreter and its own model copy
+                pool = multiprocessing.get_context("spawn").Pool(workers, _init_worker, (threads,))
+            in_flight.append((rows, pool.apply_async(_encode_shard, ((path, texts),))))
+            if len(in_flight) >= max_in_flight:
+                rows, result = in_flight.popleft()
+                store(rows, result.get())
+
+    while in_flight:
+        rows, result = in_flight.popleft()
+        store(rows, result.get())
+    if pool is not None:
+        pool.close()
+        pool.join()
+    if resumed:
+        print(f"Resumed {resumed} shard(s) from earlier checkpoints.")
+
+def save_manifest(ids, hashes):
+    np.savez(MANIFEST_PATH + '.tmp.npz', ids=ids, hashes=hashes, model=np.array(MODEL_NAME))
+    os.replace(MANIFEST_PATH + '.tmp.npz', MANIFEST_PATH)
+
+def npy_rows(path):
+    """Number of rows in an .npy file, or None if there is none."""
+    return len(np.load(path, mmap_mode='r')) if os.path.exists(path) else None
+
+def search_files_match(n_rows):
+    """Whether the embedding store and the IVF index both exist and cover n_rows trials."""
+    if any(npy_rows(os.path.join(STORE_DIR, f"{name}.npy")) != n_rows for name in ("float32", "float16", "int8")):
+        return False
+    if not os.path.exists(IVF_INDEX_PATH):
+        return False
+    with np.load(IVF_INDEX_PATH) as data:
+        return int(data["n_rows"]) == n_rows
+
+def build_search_files(vectors_path):
+    """Writes the embedding store and the IVF index for the vectors in an .npy file."""
+    print("Writing memory-mapped embedding store (float32 + float16 + int8)...")
+    write_embedding_store(np.load(vectors_path, mmap_mode='r'), STORE_DIR)
+    print(f"Embedding store saved to {STORE_DIR}.")
+
+    print("Building IVF search index...")
+    normalized = np.load(os.path.join(STORE_DIR, 'float32.npy'), mmap_mode='r')
+    index = build_ivf_index(normalized, normalized=True)
+    save_ivf_index(index, IVF_INDEX_PATH)
+    print(f"IVF index with {index.n_lists} lists saved to {IVF_INDEX_PATH}.")
+
+def parse_args():
+    cpus = os.cpu_count() or 1
+    parser = argparse.ArgumentParser(description="Pre-compute trial embeddings for app.py.")
+    parser.add_argument("--workers", type=int, default=max(1, cpus // 4),
+                        help="encoding processes, each with its own model (default: cpus / 4)")
+    parser.add_argument("--threads", type=int, default=None,
+                        help="torch threads per worker (default: cpus / workers)")
+    parser.add_argument("--shard-size", type=int, default=2000,
+                        help="trials per checkpointed shard (default: 2000)")
+    parser.add_argument("--limit", type=int, default=0,
+                        help="embed only the first N trials (default: 0 = all)")
+    args = parser.parse_args()
+    args.threads = args.threads or max(1, cpus // args.workers)
+    return args
+
+def main():
+    args = parse_args()
+
+    print("Scanning trials...")
+    ids, hashes = scan_trials(args.limit)
+    if len(ids) == 0:
+        print("No trials found in trials.csv; nothing to embed.")
+        return
+
+    # Reuse vectors for every trial whose embedded text has not changed
+    previous_hashes, previous_vectors = load_previous_embeddings()
+    reuse_rows = match_previous(hashes, previous_hashes)
+    needs_encoding = reuse_rows < 0
+    n_encode = int(np.count_nonzero(needs_encoding))
+    dropped = 0 if previous_hashes is None else \
+        len(np.unique(previous_hashes)) - len(np.unique(hashes[~needs_encoding]))
+    print(f"{len(ids) - n_encode} unchanged, {n_encode} new or changed, "
+          f"{dropped} removed since the last run.")
+
+    if n_encode == 0 and np.array_equal(reuse_rows, np.arange(len(previous_vectors))):
+        if search_files_match(len(ids)):
+            print("Embeddings are already up to date.")
+            return
+        print("Embeddings are up to date, but the embedding store or IVF index is missing or stale.")
+        del previous_vectors
+        build_search_files(EMBEDDINGS_PATH)
+        print("You can now safely run app.py.")
+        return
+
+    # Vectors are written straight into the final file; only one chunk or
+    # shard of them is ever in memory
+    os.makedirs(DATA_DIR, exist_ok=True)
+    tmp_path = EMBEDDINGS_PATH + '.tmp.npy'
+    out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=(len(ids), EMBEDDING_DIM))
+    for start in range(0, len(ids), CHUNK_ROWS):
+        rows = np.arange(start, min(start + CHUNK_ROWS, len(ids)))
+        rows = rows[reuse_rows[rows] >= 0]
+        if len(rows):
+            out[rows] = previous_vectors[reuse_rows[rows]]
 
-print(f"Encoding {len(trial_texts)} trials (This takes time, but only happens once!)...")
-# batch_size=32 is the magic number to stop your RAM from crashing
-trial_vectors = model.encode(trial_texts, batch_size=32, show_progress_bar=True)
+    if n_encode:
+        print(f"Encoding {n_encode} trials in shards of up to {args.shard_size} "
+              f"on {args.workers} worker(s) x {args.threads} thread(s)...")
+        encode_into(out, iter_shards(args.limit, needs_encoding, hashes, args.shard_size),
+                    args.workers, args.threads)
+    out.flush()
+    del out, previous_vectors
 
-# Save to your data directory
-os.makedirs('data', exist_ok=True)
-save_path = os.path.join('data', 'trial_embeddings.npy')
-np.save(save_path, trial_vectors)
+    # The manifest goes last: it marks the embeddings, store and index as one
+    # finished run, so a run that stops before it leaves the old manifest next
+    # to the old embeddings and is simply picked up again.
+    build_search_files(tmp_path)
+    if os.path.exists(MANIFEST_PATH):
+        os.remove(MANIFEST_PATH)  # never pair the old manifest with the new vectors
+    os.replace(tmp_path, EMBEDDINGS_PATH)
+    save_manifest(ids, hashes)
+    shutil.rmtree(SHARD_DIR, ignore_errors=True)
+    print(f"\nSuccess! Embeddings saved to {EMBEDDINGS_PATH} (trial ids and content hashes in {MANIFEST_PATH}).")
+    print("You can now safely run app.py.")
 
-print(f"\nSuccess! Embeddings saved to {save_path}.")
-print("You can now safely run app.py.")
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+import numpy as np
+from vector_index import DEFAULT_NPROBE, ExactIndex, ShardedIndex, load_index, normalize_rows, shard_bounds
+from embedding_store import QuantizedIndex, QuantizedMatrix
+
+# ── Trial search engine ─────────────────────────────────────────────────────
+# Owns the trial embedding matrix, L2-normalized to float32 exactly once at
+# startup, plus the vector index built over it. A search is one GEMV (or one
+# GEMM for a batch of queries) followed by a partial top-k selection, and
+# results come back as numpy (indices, scores) arrays ordered best first.
+#
+# When built from an EmbeddingStore the matrix is a read-only memmap that is
+# already normalized, and brute-force scans run on its float16/int8 copy with
+# float32 re-ranking of the shortlist (see embedding_store.py).
+#
+# With shards > 1, brute-force scans are split across a thread pool by row
+# range (ShardedIndex), so the whole catalog is searched in roughly the time
+# one shard takes. The IVF index is left as is; it only scores a few lists.
+
+
+class TrialSearchEngine:
+    def __init__(self, vectors, index_path=None, index_kind="auto", nprobe=DEFAULT_NPROBE,
+                 normalized=False, coarse=None, rerank_factor=4, shards=1):
+        self.vectors = vectors if normalized else normalize_rows(vectors)
+        if index_path:
+            self.index = load_index(self.vectors, index_path, kind=index_kind, nprobe=nprobe)
+        else:
+            self.index = ExactIndex(self.vectors)
+        if self.index.is_exact:
+            bounds = shard_bounds(len(self.vectors), shards)
+            indexes = [self._brute_force(start, stop, coarse, rerank_factor) for start, stop in bounds]
+            self.index = indexes[0] if len(indexes) == 1 else ShardedIndex(indexes, bounds)
+
+    def _brute_force(self, start, stop, coarse, rerank_factor):
+        """Exact (or quantized + re-ranked) index over rows [start, stop)."""
+        vectors = self.vectors[start:stop]
+        if coarse is None:
+            return ExactIndex(vectors)
+        shard_coarse = QuantizedMatrix(coarse.codes[start:stop], coarse.scale, coarse.block_size)
+        return QuantizedIndex(vectors, shard_coarse, rerank_factor=rerank_factor)
+
+    @classmethod
+    def from_store(cls, store, **kwargs):
+        return cls(store.vectors, normalized=True, coarse=store.coarse, **kwargs)
+
+    def __len__(self):
+        return len(self.vectors)
+
+    @property
+    def kind(self):
+        return self.index.kind
+
+    def search(self, query_vec, k, mask=None):
+        """Top-k trials for one query vector as (row indices, cosine scores)."""
+        return self.index.search(query_vec, k, mask=mask)
+
+    def search_batch(self, query_vecs, k, mask=None, exact=False, block_rows=65536):
+        """Top-k trials for several queries at once.
+
+        Returns (indices, scores) arrays of shape (n_queries, k'), where
+        k' = min(k, number of searchable trials). With a brute-force index
+        (exact or quantized, sharded or not), or exact=True, all queries are
+        scored by one float32 matrix multiply per block of block_rows trials,
+        keeping a running top-k per query; other indexes are searched one
+        query at a time.
+        """
+        query_vecs = np.atleast_2d(np.asarray(query_vecs, dtype=np.float32))
+        if not self.index.is_exact and not exact:
+            results = [self.index.search(q, k, mask=mask) for q in query_vecs]
+            width = min(len(r[0]) for r in results) if results else 0
+            return (np.array([r[0][:width] for r in results], dtype=np.int64).reshape(len(results), width),
+                    np.array([r[1][:width] for r in results], dtype=np.float32).reshape(len(results), width))
+
+        q = normalize_rows(query_vecs)
+        n_candidates = len(self.vectors)
+        if mask is not None:
+            mask = mask[:len(self.vectors)]
+            n_candidates = int(np.count_nonzero(mask))
+        k = min(k, n_candidates)
+        best_idx = np.empty((len(q), 0), dtype=np.int64)
+        best_scores = np.empty((len(q), 0), dtype=np.float32)
+        if k <= 0:
+            return best_idx, best_scores
+
+        for start in range(0, len(self.vectors), block_rows):
+            block = np.asarray(self.vectors[start:start + block_rows], dtype=np.float32)
+            sims = q @ block.T
+            if mask is not None:
+                sims[:, ~mask[start:start + len(block)]] = -np.inf
+            # Only this block's own top-k per query is merged with the running
+            # top-k, so no more than n_queries x 2k candidates are ever copied
+            if sims.shape[1] > k:
+                idx = np.argpartition(sims, -k, axis=1)[:, -k:]
+                sims = np.take_along_axis(sims, idx, axis=1)
+                idx += start
+            else:
+                idx = np.broadcast_to(np.arange(start, start + len(block)), sims.shape)
+            scores = np.concatenate([best_scores, sims], axis=1)
+            idx = np.concatenate([best_idx, idx], axis=1)
+            if scores.shape[1] > k:
+                part = np.argpartition(scores, -k, axis=1)[:, -k:]
+                scores = np.take_along_axis(scores, part, axis=1)
+                idx = np.take_along_axis(idx, part, axis=1)
+            best_scores, best_idx = scores, idx
+
+        order = np.argsort(-best_scores, axis=1)
+        return np.take_along_axis(best_idx, order, axis=1), np.take_along_axis(best_scores, order, axis=1)
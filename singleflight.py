@@ -0,0 +1,68 @@
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+
+# ── Single-flight call coalescing ───────────────────────────────────────────
+# When several request threads need the same outbound result at once (a
+# popular trial's clinicaltrials.gov record, the Cohere summary of a trial),
+# only the first thread makes the call. The others wait on its Future and get
+# the same result or exception. Keys are forgotten as soon as the call ends,
+# so this is not a cache: it only merges calls that overlap in time.
+
+
+class SingleFlight:
+    def __init__(self, name, timeout=None):
+        self.name = name
+        self.timeout = timeout
+        self.calls = 0
+        self.executed = 0
+        self.suppressed = 0
+        self.timeouts = 0
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, timeout=None):
+        """Returns fn() for key, sharing one execution between concurrent callers.
+
+        Callers that join an existing call wait at most `timeout` seconds (or
+        the instance default) and then raise TimeoutError; the call itself
+        keeps running for the caller that started it.
+        """
+        with self._lock:
+            self.calls += 1
+            future = self._in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = self._in_flight[key] = Future()
+                self.executed += 1
+            else:
+                self.suppressed += 1
+
+        if not leader:
+            try:
+                return future.result(timeout if timeout is not None else self.timeout)
+            except FutureTimeout:
+                with self._lock:
+                    self.timeouts += 1
+                raise TimeoutError(f"{self.name}: timed out waiting for in-flight call {key!r}") from None
+
+        try:
+            result = fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "executed": self.executed,
+                "suppressed": self.suppressed,
+                "timeouts": self.timeouts,
+                "in_flight": len(self._in_flight),
+            }
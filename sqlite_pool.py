@@ -0,0 +1,155 @@
+import os
+import queue
+import sqlite3
+import sys
+import threading
+import time
+from per_process import PerProcess
+
+# ── Pooled SQLite connections ───────────────────────────────────────────────
+# get_db_connection() used to open database.db for every request, in the
+# default rollback-journal mode, where a write locks out every reader. An
+# SQLitePool keeps opened connections for reuse, each set up once with:
+#
+#   journal_mode=WAL        readers and the writer no longer block each other
+#   synchronous=NORMAL      fsync at checkpoints rather than every commit; with
+#                           WAL a power cut can lose the last commits but
+#                           never corrupts the database
+#   cache_size, mmap_size   a bigger page cache and memory-mapped reads
+#   busy_timeout            writers queue for the write lock instead of
+#                           failing at once with "database is locked"
+#
+# plus a larger per-connection prepared-statement cache (cached_statements),
+# so the routes' fixed queries are compiled once per connection.
+#
+# Callers keep the connect/close pattern: close() rolls back whatever was
+# left uncommitted and hands the connection back to the pool.
+
+
+class PooledConnection:
+    """A connection checked out of an SQLitePool; close() returns it."""
+
+    __slots__ = ("_pool", "_conn", "_idle")
+
+    def __init__(self, pool, conn, idle):
+        self._pool = pool
+        self._conn = conn
+        self._idle = idle  # the idle queue it came from
+
+    def __getattr__(self, name):
+        if self._conn is None:
+            raise sqlite3.ProgrammingError("Cannot operate on a closed database.")
+        return getattr(self._conn, name)
+
+    def __enter__(self):
+        self._conn.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        return self._conn.__exit__(*exc_info)
+
+    def close(self):
+        conn, self._conn = self._conn, None
+        if conn is not None:
+            self._pool._release(conn, self._idle)
+
+
+class SQLitePool:
+    def __init__(self, path, max_idle=16, busy_timeout=10.0, cache_size_kib=65536,
+                 mmap_size=256 << 20, cached_statements=256):
+        self.path = path
+        self.max_idle = max_idle
+        self.busy_timeout = busy_timeout
+        self.cache_size_kib = cache_size_kib
+        self.mmap_size = mmap_size
+        self.cached_statements = cached_statements
+        self.created = 0
+        self.reused = 0
+        # Connections must not cross a gunicorn fork; a child starts empty
+        self._idle = PerProcess(lambda: queue.LifoQueue(self.max_idle))
+        self._lock = threading.Lock()
+
+    def _open(self):
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout, check_same_thread=False,
+                               cached_statements=self.cached_statements)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA cache_size=-{int(self.cache_size_kib)}")
+        conn.execute(f"PRAGMA mmap_size={int(self.mmap_size)}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        with self._lock:
+            self.created += 1
+        return conn
+
+    def connection(self):
+        """An open connection (rows as sqlite3.Row); call close() to give it back."""
+        idle = self._idle.get()
+        try:
+            conn = idle.get_nowait()
+            with self._lock:
+                self.reused += 1
+        except queue.Empty:
+            conn = self._open()
+        return PooledConnection(self, conn, idle)
+
+    def _release(self, conn, idle):
+        if idle is not self._idle.peek():
+            return  # checked out before a fork
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            idle.put_nowait(conn)
+        except (sqlite3.Error, queue.Full):
+            conn.close()
+
+    def stats(self):
+        return {"connections_created": self.created, "connections_reused": self.reused,
+                "idle": self._idle.get().qsize()}
+
+
+if __name__ == "__main__":
+    # Mixed read/write throughput with N threads, connect-per-request vs pooled:
+    #   python sqlite_pool.py [n_threads]      default: 16
+    import tempfile
+    from concurrent.futures import ThreadPoolExecutor
+
+    n_threads = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    n_ops = 4000
+
+    def setup(path):
+        conn = sqlite3.connect(path)
+        conn.execute("CREATE TABLE patients (email TEXT PRIMARY KEY, organization TEXT)")
+        conn.execute("CREATE TABLE consents (id INTEGER PRIMARY KEY, patient_email TEXT, trial_id TEXT, decision TEXT)")
+        conn.executemany("INSERT INTO patients VALUES (?, ?)", [(f"p{i}@x.com", f"org{i % 20}") for i in range(2000)])
+        conn.executemany("INSERT INTO consents (patient_email, trial_id, decision) VALUES (?, ?, 'accepted')",
+                         [(f"p{i % 2000}@x.com", str(i)) for i in range(20000)])
+        conn.commit()
+        conn.close()
+
+    def op(get_connection, i):
+        conn = get_connection()
+        if i % 10 == 0:  # one write (a /consent) per nine reads (logins, patient lookups)
+            conn.execute("INSERT INTO consents (patient_email, trial_id, decision) VALUES (?, ?, 'accepted')",
+                         (f"p{i % 2000}@x.com", str(i)))
+            conn.commit()
+        else:
+            conn.execute("SELECT * FROM patients WHERE email = ? AND organization = ?",
+                         (f"p{i % 2000}@x.com", f"org{i % 20}")).fetchone()
+        conn.close()
+
+    def connect(path):
+        conn = sqlite3.connect(path)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for label in ("connect per request", "pooled (WAL)"):
+            path = os.path.join(tmp, label.split()[0] + ".db")
+            setup(path)
+            get_connection = (lambda: connect(path)) if label.startswith("connect") else SQLitePool(path).connection
+            start = time.perf_counter()
+            with ThreadPoolExecutor(n_threads) as pool:
+                list(pool.map(lambda i: op(get_connection, i), range(n_ops)))
+            elapsed = time.perf_counter() - start
+            print(f"{label:>20}: {n_ops / elapsed:8.1f} ops/s with {n_threads} threads")
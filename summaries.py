@@ -0,0 +1,139 @@
+import os
+import sys
+import time
+import hashlib
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# ── Patient-friendly trial summaries ────────────────────────────────────────
+# Summaries are generated offline by `python summaries.py` and kept in the
+# shared data/cache.db under the "trial_summaries" namespace, keyed by trial
+# id plus a hash of the description they summarize. An edited description
+# gets a new key, so it is summarized again on the next run instead of
+# serving a summary of the old text. app.py only reads this store.
+
+# COHERE_API_URL points at another API root, e.g. a local stand-in
+COHERE_CHAT_URL = os.getenv("COHERE_API_URL", "https://api.cohere.com/v1").rstrip("/") + "/chat"
+COHERE_MODEL = "command-r7b-12-2024"
+SUMMARY_NAMESPACE = "trial_summaries"
+SUMMARY_PROMPT = ("Please provide a concise, patient-friendly summary of the following clinical trial "
+                  "description in 2-3 sentences:\n\n{description}")
+
+
+def post_cohere_chat(client, payload, api_key, timeout, headers=None):
+    """POSTs a payload to Cohere's chat endpoint through an HTTPClient; returns the decoded JSON.
+
+    Sent once: a retried chat call could be answered (and billed) twice.
+    """
+    return client.post_json(COHERE_CHAT_URL, payload, timeout=timeout, retries=0, headers={
+        "Authorization": f"Bearer {api_key}",
+        **(headers or {}),
+    })
+
+
+def summary_key(trial):
+    digest = hashlib.sha1(trial["description"].encode("utf-8")).hexdigest()
+    return f"{trial['id']}:{digest}"
+
+
+def fallback_summary(trial):
+    if not trial["description"].strip():
+        return "No summary available."
+    return trial["description"][:200] + "..."
+
+
+def generate_summary(trial, client, api_key, timeout=30):
+    payload = {
+        "model": COHERE_MODEL,
+        "message": SUMMARY_PROMPT.format(description=trial["description"]),
+        "temperature": 0.3,
+    }
+    return post_cohere_chat(client, payload, api_key, timeout)["text"]
+
+
+class SummaryStore:
+    def __init__(self, shared):
+        self.shared = shared
+
+    def get(self, trial):
+        """The stored summary for the trial's current description, or None."""
+        summary = self.shared.get(summary_key(trial))
+        return summary.decode("utf-8") if isinstance(summary, bytes) else summary
+
+    def put(self, trial, summary):
+        self.shared.put(summary_key(trial), summary)
+
+    def stats(self):
+        return self.shared.stats()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Pre-generate patient-friendly trial summaries with Cohere.")
+    parser.add_argument("--workers", type=int, default=4, help="concurrent Cohere calls (default: 4)")
+    parser.add_argument("--rate", type=float, default=2.0, help="max calls per second (default: 2, 0 = unlimited)")
+    parser.add_argument("--all", action="store_true", help="summarize every trial, not only active ones")
+    parser.add_argument("--limit", type=int, default=0, help="summarize at most N trials (0 = all)")
+    return parser.parse_args()
+
+
+def main():
+    from dotenv import load_dotenv
+    import numpy as np
+    from cache import SharedCache
+    from catalog import load_catalog
+    from facets import FacetIndex, ACTIVE_STATUSES
+    from http_client import HTTPClient, RateLimiter
+
+    load_dotenv()
+    args = parse_args()
+    api_key = os.getenv("COHERE_API_KEY")
+    if not api_key:
+        sys.exit("COHERE_API_KEY is not set; nothing to do.")
+
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    data_dir = os.path.join(base_dir, 'data')
+    catalog = load_catalog(os.path.join(data_dir, 'trials.snapshot'), os.path.join(base_dir, 'trials.csv'))
+    trials = catalog if args.all else \
+        catalog.view(np.flatnonzero(FacetIndex(catalog).mask(status=ACTIVE_STATUSES)))
+
+    store = SummaryStore(SharedCache(os.path.join(data_dir, 'cache.db'), SUMMARY_NAMESPACE, max_entries=2000000))
+    todo = [trial for trial in trials if trial["description"] and store.get(trial) is None]
+    if args.limit:
+        todo = todo[:args.limit]
+    print(f"{len(trials)} trials, {len(todo)} without a summary for their current description")
+
+    client = HTTPClient(timeout=30, pool_size=args.workers)
+    limiter = RateLimiter(args.rate)
+    done = failed = 0
+    started = time.time()
+
+    def summarize(trial):
+        limiter.wait()
+        store.put(trial, generate_summary(trial, client, api_key))
+
+    with ThreadPoolExecutor(args.workers) as pool:
+        in_flight = deque()
+
+        def collect(trial, future):
+            nonlocal done, failed
+            try:
+                future.result()
+                done += 1
+            except Exception as e:
+                failed += 1
+                print(f"[SUMMARY ERROR] Trial {trial['id']}: {e}")
+            if (done + failed) % 100 == 0:
+                print(f"  {done + failed}/{len(todo)} ({failed} failed, {done / (time.time() - started):.1f}/s)")
+
+        for trial in todo:
+            in_flight.append((trial, pool.submit(summarize, trial)))
+            if len(in_flight) >= 2 * args.workers:
+                collect(*in_flight.popleft())
+        while in_flight:
+            collect(*in_flight.popleft())
+    print(f"Done: {done} summaries stored, {failed} failed." + (" Re-run to retry them." if failed else ""))
+
+
+if __name__ == "__main__":
+    main()
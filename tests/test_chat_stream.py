@@ -0,0 +1,107 @@
+import json
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import markdown
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import chat_stream
+from chat_stream import MarkdownStream, sse_event, stream_cohere_chat
+from http_client import HTTPClient, HTTPStatusError
+
+EVENTS = [
+    {"event_type": "stream-start"},
+    {"event_type": "text-generation", "text": "Hello"},
+    {"event_type": "text-generation", "text": " there"},
+    {"event_type": "stream-end", "finish_reason": "COMPLETE"},
+]
+
+
+class CohereHandler(BaseHTTPRequestHandler):
+    """Streams EVENTS one JSON line per chunk, like Cohere's chat with stream=True."""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self.server.requests.append((json.loads(self.rfile.read(int(self.headers["Content-Length"]))),
+                                     self.headers["Authorization"]))
+        if self.server.status != 200:
+            body = b'{"message": "overloaded"}'
+            self.send_response(self.server.status)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/stream+json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for event in EVENTS:
+            line = json.dumps(event).encode("utf-8") + b"\n"
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(line), line))
+            self.wfile.flush()
+        self.wfile.write(b"0\r\n\r\n")
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def cohere(monkeypatch):
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), CohereHandler)
+    httpd.daemon_threads = True
+    httpd.requests = []
+    httpd.status = 200
+    threading.Thread(target=httpd.serve_forever, args=(0.05,), daemon=True).start()
+    monkeypatch.setattr(chat_stream, "COHERE_CHAT_URL", f"http://127.0.0.1:{httpd.server_address[1]}/v1/chat")
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_stream_cohere_chat_yields_events(cohere):
+    client = HTTPClient(timeout=5)
+    events = list(stream_cohere_chat(client, {"message": "hi"}, "key", timeout=5))
+    assert events == EVENTS
+    payload, authorization = cohere.requests[0]
+    assert payload == {"message": "hi", "stream": True}
+    assert authorization == "Bearer key"
+
+    # A stream read to the end hands its connection back for the next call
+    list(stream_cohere_chat(client, {"message": "again"}, "key", timeout=5))
+    host = next(iter(client.stats()["hosts"].values()))
+    assert (host["connections_created"], host["connections_reused"]) == (1, 1)
+
+
+def test_stream_cohere_chat_is_not_retried(cohere):
+    cohere.status = 503
+    client = HTTPClient(timeout=5, retries=2, backoff=0.01)
+    with pytest.raises(HTTPStatusError) as e:
+        list(stream_cohere_chat(client, {"message": "hi"}, "key", timeout=5))
+    assert e.value.code == 503
+    assert len(cohere.requests) == 1
+
+
+def test_sse_event():
+    assert sse_event("token", {"text": "a\nb"}) == 'event: token\ndata: {"text": "a\\nb"}\n\n'
+
+
+def test_markdown_stream_renders_finished_blocks():
+    stream = MarkdownStream()
+    assert stream.feed("# Trial") == ""
+    assert stream.feed("s\n\nSome ") == "<h1>Trials</h1>"
+    assert stream.pending == "Some "
+    assert stream.feed("text.\n\n") == "<p>Some text.</p>"
+    assert stream.finish() == "<h1>Trials</h1>\n<p>Some text.</p>"
+
+
+def test_markdown_stream_keeps_code_fences_whole():
+    stream = MarkdownStream()
+    assert stream.feed("```\nline one\n\nline two\n") == ""
+    # The blank line inside the fence does not end a block; the one after it does
+    assert stream.feed("```\n\n") == markdown.markdown("```\nline one\n\nline two\n```\n")
+    assert stream.pending == ""
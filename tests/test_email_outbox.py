@@ -0,0 +1,191 @@
+import os
+import smtplib
+import socketserver
+import sqlite3
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from email_outbox import FAILED, NOT_CONFIGURED, PENDING, SENT, EmailOutbox, EmailSender
+from migrations import migrate
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    """Just enough SMTP for smtplib: EHLO, AUTH PLAIN, one message at a time."""
+
+    def reply(self, line):
+        self.wfile.write(line.encode("ascii") + b"\r\n")
+
+    def handle(self):
+        self.server.connections += 1
+        self.reply("220 stub ready")
+        recipients = []
+        while True:
+            line = self.rfile.readline().decode("ascii").rstrip("\r\n")
+            if not line:
+                return
+            command = line.split(" ", 1)[0].upper()
+            if command == "EHLO":
+                self.reply("250-stub")
+                self.reply("250 AUTH PLAIN")
+            elif command == "AUTH":
+                self.reply("235 authenticated")
+            elif command == "MAIL":
+                recipients = []
+                self.reply("250 ok")
+            elif command == "RCPT":
+                if "refused" in line:
+                    self.reply("550 no such user")
+                else:
+                    recipients.append(line.split(":", 1)[1].strip("<> "))
+                    self.reply("250 ok")
+            elif command == "DATA":
+                self.reply("354 go ahead")
+                while self.rfile.readline() != b".\r\n":
+                    pass
+                self.server.delivered.extend(recipients)
+                self.reply("250 queued")
+            elif command == "QUIT":
+                self.reply("221 bye")
+                return
+            else:  # RSET, NOOP
+                self.reply("250 ok")
+
+
+@pytest.fixture
+def smtp_server(monkeypatch):
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), SMTPHandler)
+    server.daemon_threads = True
+    server.connections = 0
+    server.delivered = []
+    threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True).start()
+    # The stub speaks plain text; STARTTLS is the one step it cannot do
+    monkeypatch.setattr(smtplib.SMTP, "starttls", lambda self, *args, **kwargs: (220, b"ready"))
+    monkeypatch.setenv("SMTP_SERVER", "127.0.0.1")
+    monkeypatch.setenv("SMTP_PORT", str(server.server_address[1]))
+    monkeypatch.setenv("SMTP_USERNAME", "trials@example.org")
+    monkeypatch.setenv("SMTP_PASSWORD", "secret")
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def outbox(tmp_path):
+    db_file = str(tmp_path / "database.db")
+    conn = sqlite3.connect(db_file)
+    migrate(conn)
+    conn.close()
+    return EmailOutbox(lambda: sqlite3.connect(db_file))
+
+
+def rows(outbox):
+    conn = outbox.get_connection()
+    try:
+        return conn.execute("SELECT to_email, status, attempts, last_error, next_attempt_at FROM email_outbox "
+                            "ORDER BY id").fetchall()
+    finally:
+        conn.close()
+
+
+def sender_for(outbox, tmp_path, **kwargs):
+    return EmailSender(outbox, workers=0, log_path=str(tmp_path / "server.log"), **kwargs)
+
+
+def test_batch_is_sent_over_one_connection(smtp_server, outbox, tmp_path):
+    for i in range(5):
+        outbox.enqueue(f"patient{i}@example.org", "Consent request", f"Body {i}")
+    sender = sender_for(outbox, tmp_path)
+    sender._deliver(outbox.claim(10, lease=300))
+    assert smtp_server.delivered == [f"patient{i}@example.org" for i in range(5)]
+    assert smtp_server.connections == 1
+    assert [status for _, status, _, _, _ in rows(outbox)] == [SENT] * 5
+
+    # The connection stays open for the next batch
+    outbox.enqueue("patient5@example.org", "Consent request", "Body 5")
+    sender._deliver(outbox.claim(10, lease=300))
+    assert smtp_server.connections == 1
+    assert sender.stats()["sent"] == 6
+
+    with open(tmp_path / "server.log") as f:
+        assert f.read().count("--- EMAIL REQUEST AT") == 6
+
+
+def test_refused_recipient_fails_and_the_rest_is_sent(smtp_server, outbox, tmp_path):
+    outbox.enqueue("refused@example.org", "Consent request", "Body")
+    outbox.enqueue("patient@example.org", "Consent request", "Body")
+    sender = sender_for(outbox, tmp_path)
+    sender._deliver(outbox.claim(10, lease=300))
+    (_, first, _, error, _), (_, second, _, _, _) = rows(outbox)
+    assert (first, second) == (FAILED, SENT)
+    assert "no such user" in error
+    assert smtp_server.delivered == ["patient@example.org"]
+
+
+def test_server_down_leaves_batch_pending_with_backoff(outbox, tmp_path, monkeypatch):
+    monkeypatch.setenv("SMTP_SERVER", "127.0.0.1")
+    monkeypatch.setenv("SMTP_PORT", "9")  # discard port: nothing listens
+    monkeypatch.setenv("SMTP_USERNAME", "trials@example.org")
+    monkeypatch.setenv("SMTP_PASSWORD", "secret")
+    outbox.enqueue("a@example.org", "Consent request", "Body")
+    outbox.enqueue("b@example.org", "Consent request", "Body")
+    sender = sender_for(outbox, tmp_path, backoff=30.0, max_attempts=2)
+    sender._deliver(outbox.claim(10, lease=300))
+    now = time.time()
+    for _, status, attempts, error, next_attempt_at in rows(outbox):
+        assert (status, attempts) == (PENDING, 1)
+        assert "cannot connect" in error
+        assert next_attempt_at > now
+    assert outbox.claim(10, lease=300) == []  # not due yet
+    assert sender.stats()["retried"] == 2
+
+
+def test_out_of_attempts_fails(outbox, tmp_path, monkeypatch):
+    monkeypatch.setenv("SMTP_SERVER", "127.0.0.1")
+    monkeypatch.setenv("SMTP_PORT", "9")
+    monkeypatch.setenv("SMTP_USERNAME", "trials@example.org")
+    monkeypatch.setenv("SMTP_PASSWORD", "secret")
+    outbox.enqueue("a@example.org", "Consent request", "Body")
+    sender = sender_for(outbox, tmp_path, max_attempts=1)
+    sender._deliver(outbox.claim(10, lease=300))
+    assert rows(outbox)[0][1] == FAILED
+
+
+def test_unconfigured_smtp_keeps_email_pending(smtp_server, outbox, tmp_path, monkeypatch):
+    monkeypatch.delenv("SMTP_PASSWORD")
+    outbox.enqueue("a@example.org", "Consent request", "Body")
+    sender = sender_for(outbox, tmp_path, unconfigured_delay=60.0)
+    sender._deliver(outbox.claim(10, lease=300))
+    [(_, status, attempts, error, next_attempt_at)] = rows(outbox)
+    assert (status, attempts, error) == (PENDING, 0, NOT_CONFIGURED)
+    assert next_attempt_at > time.time()
+    assert sender.stats()["postponed"] == 1
+
+    # Sent once SMTP is configured, and logged only the first time
+    monkeypatch.setenv("SMTP_PASSWORD", "secret")
+    conn = outbox.get_connection()
+    conn.execute("UPDATE email_outbox SET next_attempt_at = 0")
+    conn.commit()
+    conn.close()
+    sender._deliver(outbox.claim(10, lease=300))
+    assert rows(outbox)[0][1] == SENT
+    assert smtp_server.delivered == ["a@example.org"]
+    with open(tmp_path / "server.log") as f:
+        assert f.read().count("--- EMAIL REQUEST AT") == 1
+
+
+def test_sender_threads_deliver_queued_email(smtp_server, outbox, tmp_path):
+    sender = EmailSender(outbox, workers=2, poll_interval=0.05, log_path=str(tmp_path / "server.log"))
+    sender.start()
+    for i in range(3):
+        outbox.enqueue(f"patient{i}@example.org", "Consent request", "Body")
+    sender.wake()
+    deadline = time.monotonic() + 5
+    while len(smtp_server.delivered) < 3 and time.monotonic() < deadline:
+        time.sleep(0.02)
+    assert sorted(smtp_server.delivered) == [f"patient{i}@example.org" for i in range(3)]
+    assert sender.stats()["workers"] == 2
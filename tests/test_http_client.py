@@ -0,0 +1,143 @@
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cache import SharedCache
+from http_client import CircuitOpenError, HTTPClient, HTTPStatusError
+from trial_api import TrialApiCache
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def _answer(self):
+        self.server.hits.append((self.command, self.path))
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            self.rfile.read(length)
+        status = self.server.statuses.pop(0) if self.server.statuses else 200
+        body = b'{"ok": true}'
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = _answer
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    httpd.daemon_threads = True
+    httpd.connections = 0
+    httpd.hits = []
+    httpd.statuses = []
+    thread = threading.Thread(target=httpd.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    httpd.url = f"http://127.0.0.1:{httpd.server_address[1]}"
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_keep_alive_reuses_one_connection(server):
+    client = HTTPClient(timeout=5)
+    for _ in range(3):
+        assert client.get_json(server.url + "/studies") == {"ok": True}
+    host = client.stats()["hosts"][f"http://127.0.0.1:{server.server_address[1]}"]
+    assert (host["connections_created"], host["connections_reused"]) == (1, 2)
+    assert server.connections == 1
+
+
+def test_get_is_retried_on_503(server):
+    server.statuses = [503, 503]
+    client = HTTPClient(timeout=5, retries=2, backoff=0.01)
+    assert client.request("GET", server.url + "/").status == 200
+    assert len(server.hits) == 3
+    assert client.stats()["retried"] == 2
+
+
+def test_post_is_sent_once_unless_retries_given(server):
+    server.statuses = [503, 503]
+    client = HTTPClient(timeout=5, retries=2, backoff=0.01)
+    with pytest.raises(HTTPStatusError) as e:
+        client.post_json(server.url + "/chat", {"message": "hi"})
+    assert e.value.code == 503
+    assert len(server.hits) == 1
+    assert client.post_json(server.url + "/chat", {"message": "hi"}, retries=1) == {"ok": True}
+    assert len(server.hits) == 3
+
+
+def test_failed_connect_is_retried():
+    client = HTTPClient(timeout=5, retries=2, backoff=0.01)
+    with pytest.raises(OSError):
+        client.request("GET", "http://127.0.0.1:9/")  # discard port: nothing listens
+    assert client.stats()["retried"] == 2
+
+
+def test_breaker_opens_after_failed_calls_and_closes_after_a_trial(server):
+    server.statuses = [500, 500]
+    client = HTTPClient(timeout=5, retries=0, failure_threshold=2, reset_timeout=0.2)
+    for _ in range(2):
+        with pytest.raises(HTTPStatusError):
+            client.request("GET", server.url + "/")
+    with pytest.raises(CircuitOpenError):
+        client.request("GET", server.url + "/")
+    assert len(server.hits) == 2
+
+    time.sleep(0.25)
+    assert client.request("GET", server.url + "/").status == 200
+    host = client.stats()["hosts"][f"http://127.0.0.1:{server.server_address[1]}"]
+    assert host["breaker"] == "closed"
+
+
+def test_retries_count_as_one_breaker_failure(server):
+    server.statuses = [503, 503, 503]
+    client = HTTPClient(timeout=5, retries=2, backoff=0.01, failure_threshold=2)
+    with pytest.raises(HTTPStatusError):
+        client.request("GET", server.url + "/")
+    assert len(server.hits) == 3
+    assert client.request("GET", server.url + "/").status == 200
+
+
+def test_trial_api_cache_serves_stale_and_refreshes(tmp_path):
+    calls = []
+
+    def fetch(title):
+        calls.append(title)
+        if title == "down":
+            raise ConnectionError("API unreachable")
+        return {"nct_id": f"NCT{len(calls)}"} if title != "unknown" else None
+
+    cache = TrialApiCache(SharedCache(str(tmp_path / "cache.db"), "trial_api"), fetch, ttl=0.2, negative_ttl=60)
+    assert cache.get("aspirin") == {"nct_id": "NCT1"}
+    assert cache.get("aspirin") == {"nct_id": "NCT1"}
+    assert cache.get("unknown") is None
+    assert cache.get("unknown") is None
+    assert calls == ["aspirin", "unknown"]
+
+    time.sleep(0.25)
+    assert cache.get("aspirin") == {"nct_id": "NCT1"}  # stale copy, refreshed in the background
+    deadline = time.monotonic() + 5
+    while cache.stats()["refreshing"] and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert cache.get("aspirin") == {"nct_id": "NCT3"}
+
+    assert cache.get("down") is None
+    assert cache.get("down") is None
+    assert calls.count("down") == 2  # errors are not cached
+    assert cache.stats()["errors"] == 2
@@ -0,0 +1,21 @@
+import os
+import sqlite3
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from migrations import LATEST_VERSION, MIGRATIONS, check_query_plans, migrate, schema_version
+
+
+def test_hot_queries_use_their_indexes():
+    conn = sqlite3.connect(":memory:")
+    migrate(conn)
+    assert schema_version(conn) == LATEST_VERSION
+    problems = [(name, problem, plan) for name, plan, problem in check_query_plans(conn) if problem]
+    assert problems == []
+
+
+def test_migrate_is_idempotent():
+    conn = sqlite3.connect(":memory:")
+    assert migrate(conn) == [version for version, _, _ in MIGRATIONS]
+    assert migrate(conn) == []
@@ -0,0 +1,216 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from per_process import PerProcess, ThreadConnection
+
+# ── clinicaltrials.gov API v2 ───────────────────────────────────────────────
+# fetch_study() looks a trial up by title and returns the fields the trial
+# pages and /chat use. TrialApiCache keeps those lookups in data/cache.db,
+# shared by every worker and kept across restarts:
+#
+#   fresh copy (younger than ttl)       returned as is
+#   stale copy                          returned as is; refreshed in the background
+#   no copy                             fetched inline (the only case that waits)
+#
+# "Not found" answers are cached too (for negative_ttl), so trials that have
+# no API record do not cost a request on every page view. Network errors are
+# never cached: the stale copy, if any, keeps being served. With a SingleFlight,
+# concurrent misses and refreshes for the same title share one request.
+
+DEFAULT_BASE_URL = "https://clinicaltrials.gov/api/v2"
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
+
+
+def parse_study(study):
+    """The API fields used by app.py, from one `studies` entry."""
+    protocol = study.get("protocolSection", {})
+
+    # Extract relevant modules for RAG
+    description_module = protocol.get("descriptionModule", {})
+    conditions_module = protocol.get("conditionsModule", {})
+    design_module = protocol.get("designModule", {})
+    arms_interventions_module = protocol.get("armsInterventionsModule", {})
+    eligibility_module = protocol.get("eligibilityModule", {})
+
+    return {
+        "nct_id": protocol.get("identificationModule", {}).get("nctId", ""),
+        "detailed_description": description_module.get("detailedDescription", ""),
+        "brief_summary": description_module.get("briefSummary", ""),
+        "conditions": ", ".join(conditions_module.get("conditions", [])),
+        "study_type": design_module.get("studyType", ""),
+        "phases": ", ".join(design_module.get("phases", [])),
+        "eligibility_criteria": eligibility_module.get("eligibilityCriteria", ""),
+        "interventions": [
+            f"{i.get('type')}: {i.get('name')} ({i.get('description', '')})"
+            for i in arms_interventions_module.get("interventions", [])
+        ]
+    }
+
+
+def fetch_study(title, client, base_url=DEFAULT_BASE_URL, timeout=15):
+    """Best-matching study for a title, or None when the API has no match.
+
+    `client` is an http_client.HTTPClient. Network and HTTP errors propagate
+    so callers can tell them apart from "not found".
+    """
+    params = {
+        "query.term": title,
+        "pageSize": 1
+    }
+    url = f"{base_url.rstrip('/')}/studies?{urllib.parse.urlencode(params)}"
+    data = client.get_json(url, headers={"User-Agent": USER_AGENT}, timeout=timeout)
+    if data.get("studies"):
+        return parse_study(data["studies"][0])
+    return None
+
+
+class TrialApiCache:
+    """Stale-while-revalidate cache of fetch_study() results in a SharedCache."""
+
+    def __init__(self, shared, fetch, ttl=7 * 86400, negative_ttl=86400, refresh_workers=2, flights=None):
+        self.shared = shared
+        self.fetch = fetch
+        self.flights = flights
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.refresh_workers = refresh_workers
+        self.counts = {"fresh": 0, "stale": 0, "miss": 0, "refreshed": 0, "errors": 0}
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self._pool = PerProcess(lambda: ThreadPoolExecutor(self.refresh_workers,
+                                                           thread_name_prefix="trial-api-refresh"))
+
+    def _read(self, title):
+        blob = self.shared.get(title)
+        return json.loads(blob) if blob is not None else None
+
+    def _fetch_and_store(self, title):
+        def fetch():
+            data = self.fetch(title)
+            self.shared.put(title, json.dumps({"fetched_at": time.time(), "data": data}))
+            return data
+        return self.flights.do(title, fetch) if self.flights is not None else fetch()
+
+    def _refresh(self, title):
+        try:
+            self._fetch_and_store(title)
+            self.counts["refreshed"] += 1
+        except Exception as e:
+            self.counts["errors"] += 1
+            print(f"[API ERROR] Background refresh failed for {title!r}: {e}")
+        finally:
+            with self._lock:
+                self._refreshing.discard(title)
+
+    def _schedule_refresh(self, title):
+        with self._lock:
+            if title in self._refreshing:
+                return
+            self._refreshing.add(title)
+            self._pool.get().submit(self._refresh, title)
+
+    def get(self, title):
+        """API data for a trial title (None if the API has no such trial)."""
+        entry = self._read(title)
+        if entry is not None:
+            ttl = self.ttl if entry["data"] is not None else self.negative_ttl
+            if time.time() - entry["fetched_at"] < ttl:
+                self.counts["fresh"] += 1
+            else:
+                self.counts["stale"] += 1
+                self._schedule_refresh(title)
+            return entry["data"]
+
+        self.counts["miss"] += 1
+        try:
+            return self._fetch_and_store(title)
+        except Exception as e:
+            self.counts["errors"] += 1
+            print(f"[API ERROR] Failed to fetch from clinicaltrials.gov: {e}")
+            return None
+
+    def stats(self):
+        return dict(self.counts, refreshing=len(self._refreshing))
+
+
+# ── Harvested store ─────────────────────────────────────────────────────────
+# harvest_trials.py looks up every catalog trial ahead of time and writes the
+# results to data/trial_api.db, one row per title (found = 0 records that the
+# API has no match). app.py reads this store first and only falls back to
+# TrialApiCache for titles the harvester has not reached.
+
+API_FIELDS = ("nct_id", "detailed_description", "brief_summary", "conditions", "study_type",
+              "phases", "eligibility_criteria", "interventions")
+NOT_HARVESTED = object()
+
+
+class TrialApiStore:
+    def __init__(self, path):
+        self.path = path
+        self._local = ThreadConnection(self._connect)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def _conn(self):
+        return self._local.get()
+
+    def create(self):
+        conn = self._conn()
+        conn.execute('''CREATE TABLE IF NOT EXISTS studies (
+                            title TEXT PRIMARY KEY,
+                            found INTEGER,
+                            nct_id TEXT,
+                            detailed_description TEXT,
+                            brief_summary TEXT,
+                            conditions TEXT,
+                            study_type TEXT,
+                            phases TEXT,
+                            eligibility_criteria TEXT,
+                            interventions TEXT,
+                            fetched_at REAL
+                        )''')
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_studies_nct_id ON studies (nct_id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_studies_fetched_at ON studies (fetched_at)")
+        conn.commit()
+
+    def get(self, title):
+        """API data for a title, None if the API had no match, or NOT_HARVESTED."""
+        if not os.path.exists(self.path):
+            return NOT_HARVESTED
+        try:
+            row = self._conn().execute(f"SELECT found, {', '.join(API_FIELDS)} FROM studies WHERE title = ?",
+                                       (title,)).fetchone()
+        except sqlite3.Error as e:
+            print(f"[API STORE ERROR] {e}")
+            return NOT_HARVESTED
+        if row is None:
+            return NOT_HARVESTED
+        if not row[0]:
+            return None
+        data = dict(zip(API_FIELDS, row[1:]))
+        data["interventions"] = json.loads(data["interventions"] or "[]")
+        return data
+
+    def harvested_since(self, since):
+        """Titles fetched at or after `since` (a timestamp)."""
+        return {title for (title,) in self._conn().execute("SELECT title FROM studies WHERE fetched_at >= ?", (since,))}
+
+    def put_many(self, results):
+        """Stores (title, data or None) pairs in one transaction."""
+        now = time.time()
+        rows = []
+        for title, data in results:
+            data = data or {}
+            rows.append((title, int(bool(data)), *[data.get(f) for f in API_FIELDS[:-1]],
+                         json.dumps(data.get("interventions", [])), now))
+        conn = self._conn()
+        conn.executemany(f'''INSERT OR REPLACE INTO studies (title, found, {', '.join(API_FIELDS)}, fetched_at)
+                             VALUES ({', '.join('?' * (len(API_FIELDS) + 3))})''', rows)
+        conn.commit()
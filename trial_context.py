@@ -0,0 +1,215 @@
+import hashlib
+import json
+import re
+import threading
+import numpy as np
+
+# ── Trial context documents for /chat ───────────────────────────────────────
+# A trial's chat context is compiled once from its catalog row and its
+# clinicaltrials.gov data, then cached (in memory and in data/cache.db) under
+# a hash of those inputs, so an edited trial or refreshed API record gets a
+# new document. CONTEXT_VERSION is part of the namespace; bump it when the
+# layout below changes.
+#
+# The document is a list of labelled sections with priorities. Short facts
+# and summaries (priority <= CORE_PRIORITY) come first and are kept whole;
+# long sections are split into chunks of about `chunk_tokens` tokens.
+# render() spends a token budget on the core sections first, then on whole
+# chunks in priority order, skipping any chunk that no longer fits. A core
+# section is only cut (at a word boundary) if it alone overflows the budget. With a question vector it ranks the
+# chunks by similarity to the question instead, so a question about
+# eligibility gets the eligibility text rather than the detailed description.
+#
+# Tokens are estimated at CHARS_PER_TOKEN characters each; no tokenizer for
+# the chat model is available here, and English prose averages about four.
+
+CONTEXT_VERSION = 1
+CONTEXT_NAMESPACE = f"trial_context:v{CONTEXT_VERSION}"
+CHARS_PER_TOKEN = 4
+CORE_PRIORITY = 1
+MIN_SECTION_TOKENS = 24  # a section cut shorter than this is left out
+
+SENTENCE_END = re.compile(r"(?<=[.!?;:])\s+|\n+")
+
+
+def estimate_tokens(text):
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+
+def trial_sections(trial, api_data=None):
+    """(priority, label, text) for every non-empty section; a lower priority is kept first."""
+    api = api_data or {}
+    sections = [
+        (0, "Title", trial["title"]),
+        (0, "Full Title", trial.get("full_title")),
+        (0, "Status", trial["status"]),
+        (0, "Phase", trial["phase"]),
+        (0, "Condition", trial["condition"]),
+        (0, "Study Type", trial.get("study_type")),
+        (0, "Primary Purpose", trial.get("primary_purpose")),
+        (1, "Brief Summary", api.get("brief_summary")),
+        (1, "Description", trial["description"]),
+        (2, "Eligibility", trial["eligibility"]),
+        (2, "Interventions", trial.get("interventions")),
+        (2, "Interventions from ClinicalTrials.gov", "; ".join(api.get("interventions") or [])),
+        (3, "Eligibility Criteria from ClinicalTrials.gov", api.get("eligibility_criteria")),
+        (3, "Outcome Measures", trial.get("outcome_measure")),
+        (3, "Location", trial["location"]),
+        (4, "Phases from ClinicalTrials.gov", api.get("phases")),
+        (4, "Conditions from ClinicalTrials.gov", api.get("conditions")),
+        (5, "Detailed Description", api.get("detailed_description")),
+    ]
+    return [(priority, label, str(text).strip()) for priority, label, text in sections
+            if text and str(text).strip()]
+
+
+def chunk_text(text, chunk_tokens):
+    """Splits text into pieces of about chunk_tokens tokens at sentence ends."""
+    chunks, current = [], ""
+    for sentence in SENTENCE_END.split(text):
+        if current and estimate_tokens(current) + estimate_tokens(sentence) > chunk_tokens:
+            chunks.append(current)
+            current = ""
+        current = f"{current} {sentence}" if current else sentence
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def fit_text(text, tokens):
+    """text cut to about `tokens` tokens, at a word boundary."""
+    limit = tokens * CHARS_PER_TOKEN
+    if len(text) <= limit:
+        return text
+    cut = text.rfind(" ", 0, limit - 2)
+    return text[:cut if cut > 0 else limit - 2].rstrip() + " …"
+
+
+def context_key(trial, api_data):
+    source = json.dumps([{key: trial[key] for key in trial}, api_data], sort_keys=True, default=str)
+    return f"{trial['id']}:{hashlib.sha1(source.encode('utf-8')).hexdigest()}"
+
+
+class TrialContext:
+    """A compiled context document: labelled parts, core sections first."""
+
+    __slots__ = ("parts", "vectors", "n_core")
+
+    def __init__(self, parts, vectors=None):
+        self.parts = parts
+        self.vectors = vectors
+        self.n_core = sum(1 for priority, _, _ in parts if priority <= CORE_PRIORITY)
+
+    @classmethod
+    def build(cls, trial, api_data=None, chunk_tokens=120, embed_many=None):
+        parts = []
+        for priority, label, text in sorted(trial_sections(trial, api_data), key=lambda s: s[0]):
+            if priority <= CORE_PRIORITY:
+                parts.append((priority, label, text))
+            else:
+                parts.extend((priority, label, chunk) for chunk in chunk_text(text, chunk_tokens))
+        context = cls(parts)
+        if embed_many is not None and len(parts) > context.n_core:
+            vectors = np.asarray(embed_many([f"{label}: {text}" for _, label, text in parts[context.n_core:]]),
+                                 dtype=np.float32)
+            vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+            context.vectors = vectors.astype(np.float16)
+        return context
+
+    def to_bytes(self):
+        header = json.dumps({"parts": self.parts,
+                             "dim": 0 if self.vectors is None else self.vectors.shape[1]}).encode("utf-8")
+        return header + b"\0" + (b"" if self.vectors is None else self.vectors.tobytes())
+
+    @classmethod
+    def from_bytes(cls, blob):
+        header, _, vectors = bytes(blob).partition(b"\0")
+        header = json.loads(header)
+        parts = [tuple(part) for part in header["parts"]]
+        if not header["dim"]:
+            return cls(parts)
+        return cls(parts, np.frombuffer(vectors, dtype=np.float16).reshape(-1, header["dim"]))
+
+    def render(self, budget, query_vec=None):
+        """The document within `budget` tokens, with chunks ranked by query_vec if given."""
+        order = list(range(len(self.parts)))
+        if query_vec is not None and self.vectors is not None:
+            query = np.asarray(query_vec, dtype=np.float32).ravel()
+            query = query / max(float(np.linalg.norm(query)), 1e-12)
+            scores = self.vectors.astype(np.float32) @ query
+            order = order[:self.n_core] + (self.n_core + np.argsort(-scores, kind="stable")).tolist()
+
+        chosen = {}
+        left = budget
+        # Core sections first, whole; only one that alone overflows what is
+        # left of the budget is cut, and then nothing else fits anyway
+        for i in order[:self.n_core]:
+            _, label, text = self.parts[i]
+            cost = estimate_tokens(label) + estimate_tokens(text) + 1
+            if cost > left:
+                room = left - estimate_tokens(label) - 1
+                if room >= MIN_SECTION_TOKENS:
+                    chosen[i] = fit_text(text, room)
+                left = 0
+                break
+            chosen[i] = text
+            left -= cost
+        # Then whole chunks in rank order, skipping any too big for what is left
+        for i in order[self.n_core:]:
+            _, label, text = self.parts[i]
+            cost = estimate_tokens(label) + estimate_tokens(text) + 1
+            if cost <= left:
+                chosen[i] = text
+                left -= cost
+
+        lines = []
+        previous = None
+        for i in sorted(chosen):
+            label = self.parts[i][1]
+            if previous is not None and self.parts[previous][1] == label:
+                # Chunks of one section; " … " marks the ones left out in between
+                lines[-1] += (" " if previous == i - 1 else " … ") + chosen[i]
+            else:
+                lines.append(f"{label}: {chosen[i]}")
+            previous = i
+        return "\n".join(lines)
+
+
+class TrialContextCache:
+    """Compiled TrialContexts, in memory and in a SharedCache."""
+
+    def __init__(self, memory, shared, chunk_tokens=120, embed_many=None):
+        self.memory = memory
+        self.shared = shared
+        self.chunk_tokens = chunk_tokens
+        self.embed_many = embed_many
+        self.counts = {"memory_hits": 0, "shared_hits": 0, "built": 0}
+        self._lock = threading.Lock()
+
+    def get(self, trial, api_data=None):
+        key = context_key(trial, api_data)
+        context = self.memory.get(key)
+        if context is not None:
+            self._count("memory_hits")
+            return context
+
+        blob = self.shared.get(key)
+        context = TrialContext.from_bytes(blob) if blob is not None else None
+        if context is not None and self.embed_many is not None and context.vectors is None \
+                and len(context.parts) > context.n_core:
+            context = None  # compiled while retrieval was off
+        if context is not None:
+            self._count("shared_hits")
+        else:
+            context = TrialContext.build(trial, api_data, self.chunk_tokens, self.embed_many)
+            self.shared.put(key, context.to_bytes())
+            self._count("built")
+        self.memory.put(key, context)
+        return context
+
+    def _count(self, name):
+        with self._lock:
+            self.counts[name] += 1
+
+    def stats(self):
+        return dict(self.counts)
@@ -0,0 +1,249 @@
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from per_process import PerProcess
+
+# ── Vector indexes for semantic trial search ────────────────────────────────
+# Both index types expose the same `search(query_vec, k, mask=None)` call and
+# return (row indices, cosine scores) ordered best match first, so app.py does
+# not care which one it was given. `mask` is an optional boolean row filter
+# (see facets.py) applied before the top-k selection.
+#
+# Indexes expect rows that are already L2-normalized float32 (see
+# search_engine.TrialSearchEngine, which owns that matrix) so the dot product
+# is the cosine similarity and nothing is re-normalized per query.
+#
+#   ExactIndex  scores every trial vector (brute force, always exact).
+#   IVFIndex    groups the trial vectors into k-means clusters offline and
+#               only scores the `nprobe` clusters closest to the query.
+#               Raising nprobe trades latency for recall; nprobe == n_lists
+#               is an exact search. Recall depends on how clustered the
+#               vectors are: `python bench_search.py --recall` measures
+#               recall@k against ExactIndex for a range of nprobe values,
+#               on data/ embeddings when they exist.
+#   ShardedIndex  splits a brute-force index into contiguous row shards that
+#               are scored in parallel on a thread pool, then merges the
+#               per-shard top-k lists.
+
+DEFAULT_NPROBE = 8
+
+
+def normalize_rows(vectors):
+    """Returns an L2-normalized float32 copy of a 2-D array (zero rows stay zero)."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def normalize_vector(vector):
+    vector = np.asarray(vector, dtype=np.float32).ravel()
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def top_k(scores, k):
+    """Indices of the k largest scores, best first, without sorting all of them."""
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    if k < len(scores):
+        part = np.argpartition(scores, -k)[-k:]
+    else:
+        part = np.arange(len(scores))
+    return part[np.argsort(scores[part])[::-1]]
+
+
+class ExactIndex:
+    kind = "exact"
+    is_exact = True  # scores every row
+
+    def __init__(self, vectors):
+        self.vectors = vectors
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def search(self, query_vec, k, mask=None):
+        if len(self.vectors) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        q = normalize_vector(query_vec)
+        sims = self.vectors @ q
+        if mask is not None:
+            sims = np.where(mask[:len(sims)], sims, -np.inf)
+            k = min(k, int(np.count_nonzero(mask[:len(sims)])))
+        top = top_k(sims, k)
+        return top, sims[top]
+
+
+class IVFIndex:
+    kind = "ivf"
+    is_exact = False
+
+    def __init__(self, vectors, centroids, list_offsets, list_rows, nprobe=DEFAULT_NPROBE):
+        self.vectors = vectors
+        self.centroids = np.asarray(centroids, dtype=np.float32)
+        self.list_offsets = np.asarray(list_offsets, dtype=np.int64)
+        self.list_rows = np.asarray(list_rows, dtype=np.int64)
+        self.nprobe = nprobe
+
+    def __len__(self):
+        return len(self.vectors)
+
+    @property
+    def n_lists(self):
+        return len(self.centroids)
+
+    def search(self, query_vec, k, mask=None, nprobe=None):
+        nprobe = min(nprobe or self.nprobe, self.n_lists)
+        q = normalize_vector(query_vec)
+
+        # Pick the clusters whose centroids sit closest to the query
+        centroid_sims = self.centroids @ q
+        probe = top_k(centroid_sims, nprobe)
+        rows = np.concatenate([
+            self.list_rows[self.list_offsets[p]:self.list_offsets[p + 1]] for p in probe
+        ])
+        if mask is not None:
+            mask = mask[:len(self.vectors)]
+            rows = rows[mask[rows]]
+        if len(rows) < k:
+            # The probed lists are too small (or the filter too selective);
+            # score every (matching) trial instead of returning a short list.
+            rows = np.arange(len(self.vectors)) if mask is None else np.flatnonzero(mask)
+
+        sims = self.vectors[rows] @ q
+        top = top_k(sims, k)
+        return rows[top], sims[top]
+
+
+def shard_bounds(n_rows, n_shards):
+    """(start, stop) row ranges of n_shards near-equal contiguous shards."""
+    n_shards = max(1, min(n_shards, n_rows))
+    edges = np.linspace(0, n_rows, n_shards + 1).astype(np.int64)
+    return list(zip(edges[:-1].tolist(), edges[1:].tolist()))
+
+
+class ShardedIndex:
+    """Brute-force search over row shards, scored concurrently.
+
+    Each shard is its own index (exact or quantized) over a slice of the same
+    matrix, so nothing is copied. numpy releases the GIL in the matrix-vector
+    products, so a thread per shard keeps every core busy on one query. Each
+    shard returns its own top-k and the merge only sees n_shards * k rows.
+    """
+
+    def __init__(self, shards, bounds, workers=None):
+        self.shards = shards
+        self.bounds = bounds
+        self.workers = workers or len(shards)
+        self._pool = PerProcess(lambda: ThreadPoolExecutor(self.workers, thread_name_prefix="search-shard"))
+
+    @property
+    def kind(self):
+        return f"{self.shards[0].kind} x{len(self.shards)} shards"
+
+    @property
+    def is_exact(self):
+        return self.shards[0].is_exact
+
+    def __len__(self):
+        return self.bounds[-1][1] if self.bounds else 0
+
+    def search(self, query_vec, k, mask=None):
+        pool = self._pool.get()
+        futures = [pool.submit(shard.search, query_vec, k, None if mask is None else mask[start:stop])
+                   for shard, (start, stop) in zip(self.shards, self.bounds)]
+        rows, sims = [], []
+        for future, (start, _) in zip(futures, self.bounds):
+            shard_rows, shard_sims = future.result()
+            rows.append(shard_rows + start)
+            sims.append(shard_sims)
+        if not rows:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        rows, sims = np.concatenate(rows), np.concatenate(sims)
+        top = top_k(sims, k)
+        return rows[top], sims[top]
+
+
+# ── Offline build (spherical k-means) ───────────────────────────────────────
+def _assign(vectors, centroids, block_size=8192):
+    labels = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), block_size):
+        block = vectors[start:start + block_size]
+        labels[start:start + block_size] = np.argmax(block @ centroids.T, axis=1)
+    return labels
+
+
+def build_ivf_index(vectors, n_lists=None, n_iter=20, train_size=None, seed=0, nprobe=DEFAULT_NPROBE,
+                    normalized=False):
+    """Clusters the trial vectors with spherical k-means and returns an IVFIndex.
+
+    Pass normalized=True for rows that are already unit length (for example
+    the embedding store's float32 memmap) to avoid an in-memory copy.
+    """
+    if not normalized:
+        vectors = normalize_rows(vectors)
+    n_rows = len(vectors)
+    if n_lists is None:
+        n_lists = max(1, int(np.sqrt(n_rows)))
+    n_lists = min(n_lists, n_rows)
+
+    rng = np.random.default_rng(seed)
+    train_size = min(n_rows, train_size or n_lists * 64)
+    train = np.asarray(vectors[np.sort(rng.choice(n_rows, train_size, replace=False))], dtype=np.float32)
+    centroids = train[rng.choice(train_size, n_lists, replace=False)].copy()
+
+    for _ in range(n_iter):
+        labels = _assign(train, centroids)
+        for c in range(n_lists):
+            members = train[labels == c]
+            if len(members):
+                centroids[c] = members.sum(axis=0)
+            else:
+                # Re-seed empty clusters so every list stays useful
+                centroids[c] = train[rng.integers(train_size)]
+        centroids = normalize_rows(centroids)
+
+    labels = _assign(vectors, centroids)
+    list_rows = np.argsort(labels, kind="stable")
+    counts = np.bincount(labels, minlength=n_lists)
+    list_offsets = np.concatenate([[0], np.cumsum(counts)])
+    return IVFIndex(vectors, centroids, list_offsets, list_rows, nprobe=nprobe)
+
+
+def save_ivf_index(index, path):
+    np.savez(path,
+             centroids=index.centroids,
+             list_offsets=index.list_offsets,
+             list_rows=index.list_rows,
+             n_rows=np.array(len(index)))
+
+
+def load_index(vectors, index_path, kind="auto", nprobe=DEFAULT_NPROBE):
+    """Loads the offline IVF index for normalized `vectors`, falling back to an ExactIndex.
+
+    kind="exact" always returns the brute-force index. An IVF file built for a
+    different number of trials is ignored rather than returning wrong rows.
+    """
+    if kind != "exact" and os.path.exists(index_path):
+        with np.load(index_path) as data:
+            if int(data["n_rows"]) == len(vectors):
+                return IVFIndex(vectors, data["centroids"], data["list_offsets"], data["list_rows"], nprobe=nprobe)
+            print(f"[INDEX] {index_path} was built for {int(data['n_rows'])} trials, "
+                  f"embeddings have {len(vectors)}. Falling back to exact search.")
+    return ExactIndex(vectors)
+
+
+if __name__ == "__main__":
+    # Rebuild the IVF index from existing embeddings without re-encoding:
+    #   python vector_index.py [n_lists]
+    data_dir = os.path.join(os.path.dirname(__file__), 'data')
+    vectors = np.load(os.path.join(data_dir, 'trial_embeddings.npy'))
+    n_lists = int(sys.argv[1]) if len(sys.argv) > 1 else None
+    print(f"Building IVF index over {len(vectors)} trial embeddings...")
+    index = build_ivf_index(vectors, n_lists=n_lists)
+    save_path = os.path.join(data_dir, 'trial_index_ivf.npz')
+    save_ivf_index(index, save_path)
+    print(f"IVF index with {index.n_lists} lists saved to {save_path}.")